@@ -8,10 +8,17 @@ resource "aws_lambda_function" "loader" {
 
   memory_size = 2048
 
+  # /tmp holds the GeoIP databases and the decompressed data of large S3
+  # objects which is spilled from memory, for up to record_concurrency objects
+  ephemeral_storage {
+    size = 2048
+  }
+
   role = aws_iam_role.cds_siem_loader_role.arn
 
   environment {
     variables = {
+      DEAD_LETTER_BUCKET           = aws_s3_bucket.cds_siem_dead_letters.id
       ES_ENDPOINT                  = var.es_endpoint
       LOG_LEVEL                    = "info"
       GEOIP_BUCKET                 = var.ip_geolocation_bucket
@@ -24,13 +31,15 @@ resource "aws_lambda_function" "loader" {
 }
 
 resource "aws_lambda_event_source_mapping" "cds_siem_split_logs" {
-  event_source_arn = aws_sqs_queue.cds_siem_split_logs.arn
-  function_name    = aws_lambda_function.loader.arn
+  event_source_arn        = aws_sqs_queue.cds_siem_split_logs.arn
+  function_name           = aws_lambda_function.loader.arn
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
 resource "aws_lambda_event_source_mapping" "cds_siem_dead_letter_queue" {
-  event_source_arn = aws_sqs_queue.cds_siem_dead_letter_queue.arn
-  function_name    = aws_lambda_function.loader.arn
+  event_source_arn        = aws_sqs_queue.cds_siem_dead_letter_queue.arn
+  function_name           = aws_lambda_function.loader.arn
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
 resource "aws_lambda_permission" "cds_siem_log_trigger" {
@@ -45,4 +45,27 @@ resource "aws_s3_bucket" "cds_siem_snapshots" {
       days = 90
     }
   }
-}
\ No newline at end of file
+}
+
+###
+# AWS S3 bucket - ElasticSearch loader dead letters
+###
+
+resource "aws_s3_bucket" "cds_siem_dead_letters" {
+  bucket = "cds-siem-${var.env}-${var.account_id}-dead-letters"
+  acl    = "private"
+  server_side_encryption_configuration {
+    rule {
+      apply_server_side_encryption_by_default {
+        sse_algorithm = "AES256"
+      }
+    }
+  }
+  lifecycle_rule {
+    enabled = true
+
+    expiration {
+      days = 90
+    }
+  }
+}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Compare merge_dicts and the path writer to build ECS fields per logtype.
+
+A synthetic record which has a value for every ecs field of a logtype is
+mapped N times by both builders. Time per record and the peak of memory
+allocated per record, which tracemalloc reports, are printed.
+
+usage: python3 bench/bench_document_builder.py [logtype ...]
+"""
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from siem import utils  # noqa: E402
+
+N = 1000
+
+
+def create_record(ecs_plan):
+    record = {}
+    for ecs_keys, original_keys_list, is_ip in ecs_plan["ecs"]:
+        original_keys = original_keys_list[0]
+        if any(isinstance(key, int) for key in original_keys):
+            continue
+        value = "192.0.2.1" if is_ip else "value"
+        utils.merge_value_into_nesteddict(record, original_keys, value)
+    return record
+
+
+def build_with_merge_dicts(record, ecs_plan):
+    ecs_dict = {}
+    for ecs_keys, original_keys_list, is_ip in ecs_plan["ecs"]:
+        for original_keys in original_keys_list:
+            v = utils.value_from_nesteddict_by_keys(record, original_keys)
+            if v:
+                new_ecs_dict = utils.put_value_into_nesteddict(".".join(ecs_keys), v)
+                ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
+                break
+    for static_ecs_keys, value in ecs_plan["static_ecs"]:
+        new_ecs_dict = utils.put_value_into_nesteddict(".".join(static_ecs_keys), value)
+        ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
+    return utils.merge_dicts(record, ecs_dict)
+
+
+def build_with_path_writer(record, ecs_plan):
+    ecs_dict = {}
+    for ecs_keys, original_keys_list, is_ip in ecs_plan["ecs"]:
+        for original_keys in original_keys_list:
+            v = utils.value_from_nesteddict_by_keys(record, original_keys)
+            if v:
+                utils.merge_value_into_nesteddict(
+                    ecs_dict, ecs_keys, utils.convert_value_for_nesteddict(v)
+                )
+                break
+    for static_ecs_keys, value in ecs_plan["static_ecs"]:
+        utils.merge_value_into_nesteddict(ecs_dict, static_ecs_keys, value)
+    return utils.merge_dicts(record, ecs_dict)
+
+
+def measure(builder, record, ecs_plan):
+    records = [copy.deepcopy(record) for _ in range(N)]
+    start = time.perf_counter()
+    for r in records:
+        builder(r, ecs_plan)
+    elapsed = time.perf_counter() - start
+
+    records = [copy.deepcopy(record) for _ in range(N)]
+    tracemalloc.start()
+    for r in records:
+        builder(r, ecs_plan)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / N * 1_000_000, peak / N
+
+
+def main(logtypes):
+    etl_config = utils.get_etl_config()
+    print(
+        f"{'logtype':<28} {'fields':>6} {'merge us':>9} {'path us':>8} "
+        f"{'merge B':>8} {'path B':>7}"
+    )
+    for logtype in logtypes or etl_config.sections():
+        ecs_plan = utils.compile_ecs_plan(etl_config[logtype])
+        if not ecs_plan["ecs"]:
+            continue
+        record = create_record(ecs_plan)
+        merge_us, merge_bytes = measure(build_with_merge_dicts, record, ecs_plan)
+        path_us, path_bytes = measure(build_with_path_writer, record, ecs_plan)
+        print(
+            f"{logtype:<28} {len(ecs_plan['ecs']):>6} {merge_us:>9.2f} "
+            f"{path_us:>8.2f} {merge_bytes:>8.0f} {path_bytes:>7.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Run the loader end to end on synthetic S3 objects.
+
+For each logtype, compression and size, an object from bench/generators.py
+is served by a fake S3 client and goes through the same path as
+process_record: LogS3 (download and decompression), log count,
+get_es_entries (parse, ECS mapping, sf script, GeoIP and serialization) and
+bulkloads_into_elasticsearch against the local bulk stub of
+bench/es_stub.py. Each case runs in a forked process so that its peak RSS is
+its own.
+
+Records/s, MB/s of decompressed data, peak RSS and the time of each stage
+are printed. The results are compared with bench/baseline.json and the exit
+status is 1 if records/s of a case dropped more than --tolerance. Each case
+runs --repeat times and the fastest run is kept to reduce noise.
+Baselines are only comparable on the same machine, so the baseline is not
+committed. It is written on the first run, and for cases which are not in
+it yet. --save-baseline overwrites it with the results.
+
+usage: python3 bench/bench_loader.py [--logtype LOGTYPE ...]
+           [--compression gzip|bzip2|zip|text ...] [--size small|medium|large ...]
+           [--latency SECONDS] [--reject-rate RATE] [--seed SEED]
+           [--repeat N] [--save-baseline] [--tolerance RATIO]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import time
+from multiprocessing import get_context
+
+LOADER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, LOADER_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# index reads aws.ini by relative path and needs an ES endpoint and region
+os.chdir(LOADER_DIR)
+os.environ.setdefault("ES_ENDPOINT", "bench.us-east-1.es.amazonaws.com")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.pop("AWS_EXECUTION_ENV", None)
+
+from elasticsearch import Elasticsearch, RequestsHttpConnection  # noqa: E402
+
+import es_stub  # noqa: E402
+import generators  # noqa: E402
+import index  # noqa: E402
+import siem  # noqa: E402
+from siem import utils  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = {"small": 1000, "medium": 10000, "large": 100000}
+STAGES = ("extract", "count", "parse", "load")
+
+
+class FakeS3Client:
+    """return one object for any key like boto3 S3 client."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.data
+        if Range:
+            data = data[int(Range[len("bytes=") :].split("-")[0]) :]
+        return {
+            "Body": io.BytesIO(data),
+            "ResponseMetadata": {"HTTPHeaders": {"content-length": str(len(data))}},
+        }
+
+
+def run_case(logtype, compression, count, seed, port):
+    key, body = generators.generate(logtype, count, seed)
+    data = generators.compress(body, compression)
+    routed = utils.get_logtype_from_s3key(key, index.logtype_router)
+    if routed != logtype:
+        raise Exception(f"{key} was routed to {routed}, not {logtype}")
+    index.es_conn = Elasticsearch(
+        hosts=[{"host": "127.0.0.1", "port": port}],
+        http_compress=True,
+        connection_class=RequestsHttpConnection,
+        timeout=60,
+    )
+    record = {
+        "s3": {"bucket": {"name": "bench-bucket"}, "object": {"key": key}},
+    }
+    logconfig = index.create_logconfig(logtype)
+    timings = {}
+
+    start = time.perf_counter()
+    logfile = siem.LogS3(record, logtype, logconfig, FakeS3Client(data), None)
+    timings["extract"] = time.perf_counter() - start
+    if logfile.is_ignored:
+        raise Exception(f"{key} was ignored because {logfile.ignored_reason}")
+
+    start = time.perf_counter()
+    logfile.log_count
+    timings["count"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = list(index.get_es_entries(logfile, index.exclude_log_patterns))
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    collected_metrics, _ = index.bulkloads_into_elasticsearch(
+        iter(entries), {}, logconfig
+    )
+    timings["load"] = time.perf_counter() - start
+
+    # header lines are counted by log_count but not parsed
+    log_count = logfile.total_log_count
+    total = sum(timings.values())
+    return {
+        "records": log_count,
+        "entries": len(entries),
+        "errors": collected_metrics["error_count"],
+        "retries": collected_metrics["retry_count"],
+        "compressed_bytes": len(data),
+        "bytes": logfile.rawdata_size,
+        "records_per_sec": log_count / total,
+        "mb_per_sec": logfile.rawdata_size / total / 1048576,
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "timings": timings,
+    }
+
+
+def case_worker(conn, *args):
+    try:
+        conn.send(run_case(*args))
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+
+def run_case_in_process(*args):
+    ctx = get_context("fork")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=case_worker, args=(send_conn, *args))
+    process.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = {"error": f"case process exited with {process.exitcode}"}
+    process.join()
+    return result
+
+
+def run_fastest_case(repeat, *args):
+    fastest = None
+    for _ in range(repeat):
+        result = run_case_in_process(*args)
+        if "error" in result:
+            return result
+        if not fastest or result["records_per_sec"] > fastest["records_per_sec"]:
+            fastest = result
+    return fastest
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or "error" in result:
+            continue
+        base = baseline[name]["records_per_sec"]
+        if result["records_per_sec"] < base * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['records_per_sec']:.0f} records/s is "
+                f"{1 - result['records_per_sec'] / base:.0%} slower than "
+                f"{base:.0f} records/s of baseline"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--logtype", nargs="+", default=list(generators.GENERATORS))
+    parser.add_argument(
+        "--compression", nargs="+", default=["gzip"], choices=generators.COMPRESSIONS
+    )
+    parser.add_argument("--size", nargs="+", default=["medium"], choices=SIZES)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    stub = es_stub.BulkStub(args.latency, args.reject_rate, args.seed).start()
+    results = {}
+    print(
+        f"{'case':<40} {'records':>8} {'rec/s':>9} {'MB/s':>7} {'RSS MB':>7} "
+        + " ".join(f"{stage:>7}" for stage in STAGES)
+    )
+    for logtype in args.logtype:
+        for compression in args.compression:
+            for size in args.size:
+                name = f"{logtype}/{compression}/{size}"
+                result = run_fastest_case(
+                    args.repeat, logtype, compression, SIZES[size], args.seed, stub.port
+                )
+                results[name] = result
+                if "error" in result:
+                    print(f"{name:<40} {result['error']}")
+                    continue
+                print(
+                    f"{name:<40} {result['records']:>8} "
+                    f"{result['records_per_sec']:>9.0f} "
+                    f"{result['mb_per_sec']:>7.2f} {result['peak_rss_mb']:>7.0f} "
+                    + " ".join(f"{result['timings'][stage]:>7.3f}" for stage in STAGES)
+                )
+                if result["errors"] or result["entries"] != result["records"]:
+                    print(
+                        f"{'':<40} {result['entries']} entries, "
+                        f"{result['errors']} errors, {result['retries']} retries"
+                    )
+    stub.shutdown()
+    print(f"bulk stub: {stub.requests} requests, {stub.documents} documents")
+
+    failed = [name for name, result in results.items() if "error" in result]
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    regressions = []
+    if not args.save_baseline:
+        regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    saved = [
+        name
+        for name, result in results.items()
+        if "error" not in result and (args.save_baseline or name not in baseline)
+    ]
+    if saved:
+        for name in saved:
+            baseline[name] = results[name]
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"saved {len(saved)} cases to {BASELINE}")
+    return 1 if regressions or failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
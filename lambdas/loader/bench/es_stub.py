@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Local stub of the bulk API of Amazon ES.
+
+Every document of a bulk request is accepted after latency seconds. With
+reject_rate, documents are rejected with 429 as a busy cluster does, so the
+retries of bulkloads_into_elasticsearch are exercised. Rejections are drawn
+from a seeded random generator.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REJECTED = {
+    "status": 429,
+    "error": {
+        "type": "es_rejected_execution_exception",
+        "reason": "rejected execution of coordinating operation",
+    },
+}
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if not self.path.split("?")[0].endswith("/_bulk"):
+            self.reply(404, {"error": f"unsupported path {self.path}"})
+            return
+        count = body.count(b"\n") // 2
+        self.server.record(count, len(body))
+        time.sleep(self.server.latency)
+        items, errors = [], False
+        for _ in range(count):
+            if self.server.reject():
+                items.append({"index": REJECTED})
+                errors = True
+            else:
+                items.append({"index": {"status": 201}})
+        took = int(self.server.latency * 1000)
+        self.reply(200, {"took": took, "errors": errors, "items": items})
+
+    def do_HEAD(self):
+        self.reply(200, {})
+
+    def reply(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BulkStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, reject_rate=0.0, seed=0):
+        super().__init__(("127.0.0.1", 0), BulkHandler)
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.documents = 0
+        self.bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, count, size):
+        with self.lock:
+            self.requests += 1
+            self.documents += count
+            self.bytes += size
+
+    def reject(self):
+        if not self.reject_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.reject_rate
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
@@ -0,0 +1,756 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Seeded synthetic S3 objects of the log types in aws.ini.
+
+Each generator returns the S3 key and the uncompressed body of an object
+with count logs. The same seed always gives the same bytes. compress()
+wraps a body in gzip, bzip2 or zip as the log sources deliver it.
+"""
+import bz2
+import gzip
+import io
+import json
+import random
+import zipfile
+
+ACCOUNT = "123456789012"
+REGION = "ca-central-1"
+# 2021-01-01T00:00:00Z
+BASE_EPOCH = 1609459200
+
+COMPRESSIONS = ("gzip", "bzip2", "zip", "text")
+
+PUBLIC_FIRST_OCTETS = (3, 13, 18, 35, 52, 54, 99, 104, 142, 151, 185, 203)
+HTTP_METHODS = ("GET", "GET", "GET", "POST", "PUT", "DELETE", "HEAD")
+HTTP_STATUSES = (200, 200, 200, 200, 201, 301, 304, 403, 404, 500, 503)
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/14.0.2 Safari/605.1.15",
+    "curl/7.64.1",
+    "aws-cli/2.1.15 Python/3.7.4 Linux/4.14.203 botocore/2.0.0",
+)
+PATHS = ("/", "/index.html", "/api/v1/items", "/login", "/static/app.js")
+
+
+def public_ip(rng):
+    return (
+        f"{rng.choice(PUBLIC_FIRST_OCTETS)}.{rng.randrange(256)}."
+        f"{rng.randrange(256)}.{rng.randrange(1, 255)}"
+    )
+
+
+def private_ip(rng):
+    return f"10.0.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+
+
+def hexstr(rng, length):
+    return "".join(rng.choice("0123456789abcdef") for _ in range(length))
+
+
+def epoch(i):
+    return BASE_EPOCH + i // 10
+
+
+def iso8601(i, sep="T", fraction=True):
+    seconds = epoch(i)
+    days, seconds = divmod(seconds - BASE_EPOCH, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    text = f"2021-01-{1 + days % 28:02d}{sep}{hours:02d}:{minutes:02d}:{seconds:02d}"
+    if fraction:
+        text += f".{i % 1000:03d}"
+    return text
+
+
+def lines(rows):
+    return "".join(row + "\n" for row in rows).encode()
+
+
+def cwl_wrap(rng, loggroup, logstream, messages, batch=100):
+    """wrap messages as CloudWatch Logs subscription data via Firehose."""
+    objs = []
+    for start in range(0, len(messages), batch):
+        events = [
+            {
+                "id": str(rng.randrange(10 ** 55)),
+                "timestamp": (BASE_EPOCH + start + i) * 1000,
+                "message": message,
+            }
+            for i, message in enumerate(messages[start : start + batch])
+        ]
+        objs.append(
+            json.dumps(
+                {
+                    "messageType": "DATA_MESSAGE",
+                    "owner": ACCOUNT,
+                    "logGroup": loggroup,
+                    "logStream": logstream,
+                    "subscriptionFilters": ["bench"],
+                    "logEvents": events,
+                }
+            )
+        )
+    # Firehose concatenates records without delimiter
+    return "".join(objs).encode()
+
+
+###############################################################################
+# Generators
+###############################################################################
+def gen_vpcflowlogs(rng, count):
+    rows = [
+        "version account-id interface-id srcaddr dstaddr srcport dstport "
+        "protocol packets bytes start end action log-status"
+    ]
+    for i in range(count):
+        rows.append(
+            f"2 {ACCOUNT} eni-{hexstr(rng, 17)} {public_ip(rng)} {private_ip(rng)} "
+            f"{rng.randrange(1024, 65536)} {rng.choice((22, 80, 443, 3389))} "
+            f"{rng.choice((6, 6, 17, 1))} {rng.randrange(1, 100)} "
+            f"{rng.randrange(40, 100000)} {epoch(i) - 60} {epoch(i)} "
+            f"{rng.choice(('ACCEPT', 'REJECT'))} OK"
+        )
+    key = (
+        f"AWSLogs/{ACCOUNT}/vpcflowlogs/{REGION}/2021/01/01/{ACCOUNT}_vpcflowlogs_"
+        f"{REGION}_fl-0123456789abcdef0_20210101T0000Z_{hexstr(rng, 8)}.log.gz"
+    )
+    return key, lines(rows)
+
+
+def gen_cloudtrail(rng, count):
+    records = []
+    for i in range(count):
+        record = {
+            "eventVersion": "1.08",
+            "userIdentity": {
+                "type": "IAMUser",
+                "principalId": "AIDA" + hexstr(rng, 16).upper(),
+                "arn": f"arn:aws:iam::{ACCOUNT}:user/bench-{rng.randrange(20)}",
+                "accountId": ACCOUNT,
+                "accessKeyId": "AKIA" + hexstr(rng, 16).upper(),
+                "userName": f"bench-{rng.randrange(20)}",
+            },
+            "eventTime": iso8601(i, fraction=False) + "Z",
+            "eventSource": rng.choice(
+                ("ec2.amazonaws.com", "s3.amazonaws.com", "iam.amazonaws.com")
+            ),
+            "eventName": rng.choice(
+                ("DescribeInstances", "GetObject", "ListUsers", "RunInstances")
+            ),
+            "awsRegion": REGION,
+            "sourceIPAddress": public_ip(rng),
+            "userAgent": rng.choice(USER_AGENTS),
+            "requestParameters": {
+                "instanceId": f"i-{hexstr(rng, 17)}",
+                "filter": {"name": "instance-state-name", "values": ["running"]},
+            },
+            "responseElements": None,
+            "requestID": hexstr(rng, 32),
+            "eventID": hexstr(rng, 32),
+            "readOnly": True,
+            "eventType": "AwsApiCall",
+            "recipientAccountId": ACCOUNT,
+        }
+        if rng.random() < 0.1:
+            record["errorCode"] = "AccessDenied"
+            record["errorMessage"] = "User is not authorized to perform this action"
+        records.append(record)
+    body = b""
+    # CloudTrail delivers files of up to a few thousand records
+    for start in range(0, count, 1000):
+        body += json.dumps({"Records": records[start : start + 1000]}).encode()
+        body += b"\n"
+    key = (
+        f"AWSLogs/{ACCOUNT}/CloudTrail/{REGION}/2021/01/01/{ACCOUNT}_CloudTrail_"
+        f"{REGION}_20210101T0000Z_{hexstr(rng, 16)}.json.gz"
+    )
+    return key, body
+
+
+def gen_networkfirewall(rng, count):
+    rows = []
+    for i in range(count):
+        event = {
+            "timestamp": iso8601(i) + "000+0000",
+            "flow_id": rng.randrange(10 ** 15),
+            "event_type": rng.choice(("alert", "netflow")),
+            "src_ip": public_ip(rng),
+            "src_port": rng.randrange(1024, 65536),
+            "dest_ip": private_ip(rng),
+            "dest_port": rng.choice((80, 443)),
+            "proto": rng.choice(("TCP", "UDP")),
+            "app_proto": "http",
+            "alert": {
+                "action": "blocked",
+                "signature_id": rng.randrange(1, 10),
+                "rev": 1,
+                "signature": "bench signature",
+                "category": "",
+                "severity": 3,
+            },
+            "http": {
+                "hostname": "www.example.com",
+                "url": rng.choice(PATHS),
+                "http_user_agent": rng.choice(USER_AGENTS),
+                "http_method": rng.choice(HTTP_METHODS),
+            },
+        }
+        rows.append(
+            json.dumps(
+                {
+                    "firewall_name": "bench-firewall",
+                    "availability_zone": REGION + "a",
+                    "event_timestamp": str(epoch(i)),
+                    "event": event,
+                }
+            )
+        )
+    key = (
+        f"AWSLogs/{ACCOUNT}/network-firewall/alert/{REGION}/2021/01/01/00/"
+        f"{ACCOUNT}_network-firewall_alert_{REGION}_bench_202101010000_"
+        f"{hexstr(rng, 8)}.log.gz"
+    )
+    return key, lines(rows)
+
+
+def guardduty_finding(rng, i):
+    return {
+        "schemaVersion": "2.0",
+        "accountId": ACCOUNT,
+        "region": REGION,
+        "partition": "aws",
+        "id": hexstr(rng, 32),
+        "arn": f"arn:aws:guardduty:{REGION}:{ACCOUNT}:detector/bench/finding/x",
+        "type": "Recon:EC2/PortProbeUnprotectedPort",
+        "resource": {
+            "resourceType": "Instance",
+            "instanceDetails": {
+                "instanceId": f"i-{hexstr(rng, 17)}",
+                "networkInterfaces": [
+                    {"privateIpAddress": private_ip(rng), "publicIp": public_ip(rng)}
+                ],
+            },
+        },
+        "service": {
+            "serviceName": "guardduty",
+            "action": {
+                "actionType": "PORT_PROBE",
+                "portProbeAction": {
+                    "portProbeDetails": [
+                        {
+                            "localPortDetails": {"port": 22, "portName": "SSH"},
+                            "remoteIpDetails": {
+                                "ipAddressV4": public_ip(rng),
+                                "country": {"countryName": "Canada"},
+                            },
+                        }
+                    ],
+                    "blocked": False,
+                },
+            },
+            "count": rng.randrange(1, 100),
+            "additionalInfo": {"threatListName": "ProofPoint"},
+        },
+        "severity": rng.choice((2, 5, 8)),
+        "createdAt": iso8601(i) + "Z",
+        "updatedAt": iso8601(i) + "Z",
+        "title": "Unprotected port on EC2 instance is being probed.",
+        "description": "EC2 instance has an unprotected port which is being probed.",
+    }
+
+
+def gen_guardduty(rng, count):
+    rows = [json.dumps(guardduty_finding(rng, i)) for i in range(count)]
+    key = f"AWSLogs/{ACCOUNT}/GuardDuty/{REGION}/2021/01/01/{hexstr(rng, 36)}.jsonl.gz"
+    return key, lines(rows)
+
+
+def gen_securityhub(rng, count):
+    rows = []
+    for i in range(count):
+        finding = {
+            "SchemaVersion": "2018-10-08",
+            "Id": f"arn:aws:securityhub:{REGION}:{ACCOUNT}:finding/{hexstr(rng, 32)}",
+            "ProductArn": f"arn:aws:securityhub:{REGION}::product/aws/securityhub",
+            "GeneratorId": "aws-foundational-security-best-practices/v/1.0.0/S3.1",
+            "AwsAccountId": ACCOUNT,
+            "Types": [
+                "Software and Configuration Checks/Industry and Regulatory "
+                "Standards/AWS-Foundational-Security-Best-Practices"
+            ],
+            "CreatedAt": iso8601(i) + "Z",
+            "UpdatedAt": iso8601(i) + "Z",
+            "Severity": {"Product": 40, "Label": "MEDIUM", "Normalized": 40},
+            "Title": "S3.1 S3 Block Public Access setting should be enabled",
+            "Description": "This AWS control checks the S3 Block Public Access.",
+            "ProductFields": {
+                "aws/securityhub/ProductName": "Security Hub",
+                "aws/securityhub/CompanyName": "AWS",
+            },
+            "Resources": [
+                {
+                    "Type": "AwsAccount",
+                    "Id": f"AWS::::Account:{ACCOUNT}",
+                    "Partition": "aws",
+                    "Region": REGION,
+                }
+            ],
+            "Compliance": {"Status": rng.choice(("PASSED", "FAILED"))},
+            "RecordState": "ACTIVE",
+        }
+        rows.append(
+            json.dumps(
+                {
+                    "version": "0",
+                    "id": hexstr(rng, 32),
+                    "detail-type": "Security Hub Findings - Imported",
+                    "source": "aws.securityhub",
+                    "account": ACCOUNT,
+                    "time": iso8601(i, fraction=False) + "Z",
+                    "region": REGION,
+                    "resources": [finding["Id"]],
+                    "detail": {"findings": [finding]},
+                }
+            )
+        )
+    key = (
+        f"AWSLogs/{ACCOUNT}/SecurityHub/{REGION}/2021/01/01/"
+        f"siem-securityhub-1-2021-01-01-00-00-00-{hexstr(rng, 36)}"
+    )
+    return key, lines(rows)
+
+
+def elb_key(rng, name, suffix):
+    return (
+        f"AWSLogs/{ACCOUNT}/elasticloadbalancing/{REGION}/2021/01/01/{ACCOUNT}_"
+        f"elasticloadbalancing_{REGION}_{name}_20210101T0000Z_{suffix}"
+    )
+
+
+def gen_nlb(rng, count):
+    rows = []
+    for i in range(count):
+        rows.append(
+            f"tls 2.0 {iso8601(i, fraction=False)} net/bench/{hexstr(rng, 16)} "
+            f"{hexstr(rng, 16)} {public_ip(rng)}:{rng.randrange(1024, 65536)} "
+            f"{private_ip(rng)}:443 {rng.randrange(1, 5000)} {rng.randrange(1, 50)} "
+            f"{rng.randrange(100, 5000)} {rng.randrange(100, 50000)} - "
+            f"arn:aws:acm:{REGION}:{ACCOUNT}:certificate/{hexstr(rng, 32)} - "
+            "ECDHE-RSA-AES128-GCM-SHA256 tlsv12 - www.example.com - - -"
+        )
+    return elb_key(rng, "net.bench." + hexstr(rng, 16), hexstr(rng, 8) + ".log.gz"), (
+        lines(rows)
+    )
+
+
+def gen_alb(rng, count):
+    rows = []
+    for i in range(count):
+        method = rng.choice(HTTP_METHODS)
+        status = rng.choice(HTTP_STATUSES)
+        rows.append(
+            f"https {iso8601(i)}Z app/bench/{hexstr(rng, 16)} "
+            f"{public_ip(rng)}:{rng.randrange(1024, 65536)} {private_ip(rng)}:80 "
+            f"0.001 0.{rng.randrange(1000):03d} 0.000 {status} {status} "
+            f"{rng.randrange(100, 2000)} {rng.randrange(100, 50000)} "
+            f'"{method} https://www.example.com:443{rng.choice(PATHS)}?q={i} '
+            f'HTTP/1.1" "{rng.choice(USER_AGENTS)}" ECDHE-RSA-AES128-GCM-SHA256 '
+            f"TLSv1.2 arn:aws:elasticloadbalancing:{REGION}:{ACCOUNT}:targetgroup/"
+            f'bench/{hexstr(rng, 16)} "Root=1-{hexstr(rng, 8)}-{hexstr(rng, 24)}" '
+            f'"www.example.com" "arn:aws:acm:{REGION}:{ACCOUNT}:certificate/'
+            f'{hexstr(rng, 32)}" 0 {iso8601(i)}Z "forward" "-" "-" '
+            f'"{private_ip(rng)}:80" "{status}" "-" "-"'
+        )
+    return elb_key(rng, "app.bench." + hexstr(rng, 16), "192.0.2.1_x.log.gz"), (
+        lines(rows)
+    )
+
+
+def gen_clb(rng, count):
+    rows = []
+    for i in range(count):
+        method = rng.choice(HTTP_METHODS)
+        status = rng.choice(HTTP_STATUSES)
+        rows.append(
+            f"{iso8601(i)}Z bench {public_ip(rng)}:{rng.randrange(1024, 65536)} "
+            f"{private_ip(rng)}:80 0.00005 0.{rng.randrange(1000):03d} 0.00002 "
+            f"{status} {status} 0 {rng.randrange(100, 50000)} "
+            f'"{method} http://www.example.com:80{rng.choice(PATHS)} HTTP/1.1" '
+            f'"{rng.choice(USER_AGENTS)}" - -'
+        )
+    return elb_key(rng, "bench", "192.0.2.1_x.log"), lines(rows)
+
+
+def gen_s3accesslog(rng, count):
+    rows = []
+    for i in range(count):
+        seconds = epoch(i) - BASE_EPOCH
+        rows.append(
+            f"{hexstr(rng, 64)} bench-bucket "
+            f"[01/Jan/2021:{seconds // 3600 % 24:02d}:{seconds // 60 % 60:02d}:"
+            f"{seconds % 60:02d} +0000] {public_ip(rng)} "
+            f"arn:aws:iam::{ACCOUNT}:user/bench {hexstr(rng, 16).upper()} "
+            f"REST.GET.OBJECT logs/{i}.gz "
+            f'"GET /bench-bucket/logs/{i}.gz HTTP/1.1" '
+            f"{rng.choice(HTTP_STATUSES)} - {rng.randrange(100, 50000)} "
+            f"{rng.randrange(100, 50000)} {rng.randrange(1, 100)} "
+            f'{rng.randrange(1, 100)} "-" "{rng.choice(USER_AGENTS)}" - '
+            f"{hexstr(rng, 56)} SigV4 ECDHE-RSA-AES128-GCM-SHA256 AuthHeader "
+            f"bench-bucket.s3.{REGION}.amazonaws.com TLSv1.2"
+        )
+    key = f"s3accesslog/bench-bucket/2021-01-01-00-00-00-{hexstr(rng, 16).upper()}"
+    return key, lines(rows)
+
+
+def gen_cloudfront_realtime(rng, count):
+    rows = []
+    for i in range(count):
+        fields = [
+            f"{epoch(i)}.{i % 1000:03d}",
+            public_ip(rng),
+            "0.001",
+            str(rng.choice(HTTP_STATUSES)),
+            str(rng.randrange(100, 50000)),
+            rng.choice(HTTP_METHODS),
+            "https",
+            "d111111abcdef8.cloudfront.net",
+            rng.choice(PATHS),
+            str(rng.randrange(100, 2000)),
+            "YUL62-C1",
+            hexstr(rng, 56),
+            "www.example.com",
+            "0.002",
+            "HTTP/2.0",
+            "IPv4",
+            rng.choice(USER_AGENTS).replace(" ", "%20"),
+            "-",
+            "-",
+            "-",
+            "Hit",
+            "-",
+            "TLSv1.3",
+            "TLS_AES_128_GCM_SHA256",
+            "Hit",
+            "-",
+            "-",
+            "text/html",
+            str(rng.randrange(100, 50000)),
+            "-",
+            "-",
+            str(rng.randrange(1024, 65536)),
+            "Hit",
+            "CA",
+            "gzip",
+            "*/*",
+            "*",
+            "-",
+            "-",
+            "0",
+        ]
+        rows.append("\t".join(fields))
+    key = f"CloudFront/E1234567890ABC/realtime/2021/01/01/{hexstr(rng, 36)}"
+    return key, lines(rows)
+
+
+def gen_cloudfront_standard(rng, count):
+    rows = [
+        "#Version: 1.0",
+        "#Fields: date time x-edge-location sc-bytes c-ip cs-method cs(Host) "
+        "cs-uri-stem sc-status cs(Referer) cs(User-Agent) cs-uri-query cs(Cookie) "
+        "x-edge-result-type x-edge-request-id x-host-header cs-protocol cs-bytes "
+        "time-taken x-forwarded-for ssl-protocol ssl-cipher "
+        "x-edge-response-result-type cs-protocol-version fle-status "
+        "fle-encrypted-fields c-port time-to-first-byte "
+        "x-edge-detailed-result-type sc-content-type sc-content-len "
+        "sc-range-start sc-range-end",
+    ]
+    for i in range(count):
+        fields = [
+            iso8601(i, sep="\t", fraction=False),
+            "YUL62-C1",
+            str(rng.randrange(100, 50000)),
+            public_ip(rng),
+            rng.choice(HTTP_METHODS),
+            "d111111abcdef8.cloudfront.net",
+            rng.choice(PATHS),
+            str(rng.choice(HTTP_STATUSES)),
+            "-",
+            rng.choice(USER_AGENTS).replace(" ", "%20"),
+            "-",
+            "-",
+            "Hit",
+            hexstr(rng, 56),
+            "www.example.com",
+            "https",
+            str(rng.randrange(100, 2000)),
+            "0.002",
+            "-",
+            "TLSv1.3",
+            "TLS_AES_128_GCM_SHA256",
+            "Hit",
+            "HTTP/2.0",
+            "-",
+            "-",
+            str(rng.randrange(1024, 65536)),
+            "0.001",
+            "Hit",
+            "text/html",
+            str(rng.randrange(100, 50000)),
+            "-",
+            "-",
+        ]
+        rows.append("\t".join(fields))
+    key = f"cloudfront/E1234567890ABC.2021-01-01-00.{hexstr(rng, 8)}.gz"
+    return key, lines(rows)
+
+
+def gen_waf(rng, count):
+    rows = []
+    for i in range(count):
+        rows.append(
+            json.dumps(
+                {
+                    "timestamp": epoch(i) * 1000,
+                    "formatVersion": 1,
+                    "webaclId": f"arn:aws:wafv2:{REGION}:{ACCOUNT}:regional/"
+                    f"webacl/bench/{hexstr(rng, 32)}",
+                    "terminatingRuleId": "Default_Action",
+                    "terminatingRuleType": "REGULAR",
+                    "action": rng.choice(("ALLOW", "BLOCK")),
+                    "httpSourceName": "ALB",
+                    "httpSourceId": f"{ACCOUNT}-app/bench/{hexstr(rng, 16)}",
+                    "ruleGroupList": [],
+                    "rateBasedRuleList": [],
+                    "nonTerminatingMatchingRules": [],
+                    "httpRequest": {
+                        "clientIp": public_ip(rng),
+                        "country": "CA",
+                        "headers": [
+                            {"name": "Host", "value": "www.example.com"},
+                            {"name": "User-Agent", "value": rng.choice(USER_AGENTS)},
+                        ],
+                        "uri": rng.choice(PATHS),
+                        "args": f"q={i}",
+                        "httpVersion": "HTTP/1.1",
+                        "httpMethod": rng.choice(HTTP_METHODS),
+                        "requestId": hexstr(rng, 32),
+                    },
+                }
+            )
+        )
+    key = (
+        f"AWSLogs/{ACCOUNT}/aws-waf-logs-bench/2021/01/01/00/"
+        f"aws-waf-logs-bench-1-2021-01-01-00-00-00-{hexstr(rng, 36)}"
+    )
+    return key, lines(rows)
+
+
+def gen_route53resolver(rng, count):
+    rows = []
+    for i in range(count):
+        rows.append(
+            json.dumps(
+                {
+                    "version": "1.100000",
+                    "account_id": ACCOUNT,
+                    "region": REGION,
+                    "vpc_id": "vpc-0123456789abcdef0",
+                    "query_timestamp": iso8601(i, fraction=False) + "Z",
+                    "query_name": f"host{rng.randrange(100)}.example.com.",
+                    "query_type": "A",
+                    "query_class": "IN",
+                    "rcode": "NOERROR",
+                    "answers": [{"Rdata": public_ip(rng), "Type": "A", "Class": "IN"}],
+                    "srcaddr": private_ip(rng),
+                    "srcport": str(rng.randrange(1024, 65536)),
+                    "transport": "UDP",
+                    "srcids": {"instance": f"i-{hexstr(rng, 17)}"},
+                }
+            )
+        )
+    key = (
+        f"AWSLogs/{ACCOUNT}/vpcdnsquerylogs/vpc-0123456789abcdef0/2021/01/01/"
+        f"vpc-0123456789abcdef0_vpcdnsquerylogs_{ACCOUNT}_20210101T0000Z_"
+        f"{hexstr(rng, 8)}.log.gz"
+    )
+    return key, lines(rows)
+
+
+def rds_key(rng, engine):
+    return (
+        f"AWSLogs/{ACCOUNT}/rds/{engine}/2021/01/01/00/"
+        f"siem-rds-1-2021-01-01-00-00-00-{hexstr(rng, 36)}"
+    )
+
+
+def gen_rds_postgresql(rng, count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            f"{iso8601(i, sep=' ', fraction=False)} UTC:{private_ip(rng)}"
+            f"({rng.randrange(1024, 65536)}):bench@benchdb:[{rng.randrange(1, 30000)}]"
+            f":LOG:  duration: {rng.randrange(1, 5000)}.{rng.randrange(1000):03d} "
+            f"ms  statement: SELECT * FROM items WHERE id = {i};"
+        )
+    body = cwl_wrap(
+        rng, "/aws/rds/cluster/bench/postgresql", "bench-instance-1.0", messages
+    )
+    return rds_key(rng, "postgresql"), body
+
+
+def gen_rds_mysql_audit(rng, count):
+    messages = []
+    for i in range(count):
+        seconds = epoch(i) - BASE_EPOCH
+        messages.append(
+            f"20210101 {seconds // 3600 % 24:02d}:{seconds // 60 % 60:02d}:"
+            f"{seconds % 60:02d},ip-10-0-0-1,bench,{private_ip(rng)},"
+            f"{rng.randrange(1, 3000)},{i},QUERY,benchdb,"
+            f"'SELECT * FROM items WHERE id = {i}',0"
+        )
+    body = cwl_wrap(rng, "/aws/rds/cluster/bench/audit", "bench-instance-1", messages)
+    return rds_key(rng, "mysql-audit"), body
+
+
+def gen_rds_mysql_general(rng, count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            f"{iso8601(i)}Z\t{rng.randrange(1, 3000):>6} Query\t"
+            f"SELECT *\nFROM items\nWHERE id = {i}"
+        )
+    body = cwl_wrap(rng, "/aws/rds/cluster/bench/general", "bench-instance-1", messages)
+    return rds_key(rng, "mysql-general"), body
+
+
+def gen_rds_mysql_error(rng, count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            f"{iso8601(i)}Z {rng.randrange(1, 3000)} [Note] Access denied for user "
+            f"'bench'@'{private_ip(rng)}' (using password: YES)"
+        )
+    body = cwl_wrap(rng, "/aws/rds/cluster/bench/error", "bench-instance-1", messages)
+    return rds_key(rng, "mysql-error"), body
+
+
+def gen_rds_mysql_slowquery(rng, count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            f"# Time: {iso8601(i)}Z\n"
+            f"# User@Host: bench[bench] @  [{private_ip(rng)}]  "
+            f"Id:  {rng.randrange(1, 3000)}\n"
+            f"# Query_time: {rng.random() * 10:.6f}  Lock_time: 0.000100 "
+            f"Rows_sent: 1  Rows_examined: {rng.randrange(1, 100000)}\n"
+            f"use benchdb;\nSET timestamp={epoch(i)};\n"
+            f"SELECT * FROM items WHERE id = {i};"
+        )
+    body = cwl_wrap(
+        rng, "/aws/rds/cluster/bench/slowquery", "bench-instance-1", messages
+    )
+    return rds_key(rng, "mysql-slowquery"), body
+
+
+def gen_msk(rng, count):
+    rows = []
+    for i in range(count):
+        rows.append(
+            f"[{iso8601(i, sep=' ', fraction=False)},{i % 1000:03d}] INFO "
+            f"[GroupCoordinator {rng.randrange(1, 4)}]: Member consumer-{i} in "
+            f"group bench has failed, removing it from the group "
+            "(kafka.coordinator.group.GroupCoordinator)"
+        )
+        if rng.random() < 0.1:
+            rows.append("\tat kafka.server.KafkaApis.handle(KafkaApis.scala:142)")
+    key = (
+        f"AWSLogs/{ACCOUNT}/KafkaBrokerLogs/{REGION}/"
+        f"bench-12345678-1234-1234-1234-123456789012-1/2021-01-01-00/"
+        f"Broker-1_000000-{hexstr(rng, 8)}.log.gz"
+    )
+    return key, lines(rows)
+
+
+def syslog_messages(rng, count, procs):
+    messages = []
+    for i in range(count):
+        seconds = epoch(i) - BASE_EPOCH
+        proc, message = rng.choice(procs)
+        messages.append(
+            f"Jan  1 {seconds // 3600 % 24:02d}:{seconds // 60 % 60:02d}:"
+            f"{seconds % 60:02d} ip-10-0-0-1 {proc}[{rng.randrange(1, 30000)}]: "
+            + message.format(ip=public_ip(rng), port=rng.randrange(1024, 65536))
+        )
+    return messages
+
+
+def gen_linux_secure(rng, count):
+    procs = [
+        ("sshd", "Accepted publickey for ec2-user from {ip} port {port} ssh2"),
+        ("sshd", "Invalid user admin from {ip} port {port}"),
+        ("sudo", "ec2-user : TTY=pts/0 ; PWD=/home/ec2-user ; USER=root ; "),
+    ]
+    messages = syslog_messages(rng, count, procs)
+    body = cwl_wrap(rng, "/ec2/linux/secure", f"i-{hexstr(rng, 17)}", messages)
+    key = f"AWSLogs/{ACCOUNT}/linux/secure/2021/01/01/{hexstr(rng, 36)}"
+    return key, body
+
+
+def gen_linux_os_syslog(rng, count):
+    procs = [
+        ("systemd", "Started Session {port} of user ec2-user."),
+        ("dhclient", "DHCPACK from {ip} (xid=0x{port})"),
+        ("kernel", "Out of memory: Kill process {port} (java)"),
+    ]
+    messages = syslog_messages(rng, count, procs)
+    body = cwl_wrap(rng, "/ec2/linux/messages", f"i-{hexstr(rng, 17)}", messages)
+    key = f"AWSLogs/{ACCOUNT}/linux/messages/2021/01/01/{hexstr(rng, 36)}"
+    return key, body
+
+
+GENERATORS = {
+    "vpcflowlogs": gen_vpcflowlogs,
+    "cloudtrail": gen_cloudtrail,
+    "networkfirewall": gen_networkfirewall,
+    "guardduty": gen_guardduty,
+    "securityhub": gen_securityhub,
+    "nlb": gen_nlb,
+    "alb": gen_alb,
+    "clb": gen_clb,
+    "s3accesslog": gen_s3accesslog,
+    "cloudfront-realtime": gen_cloudfront_realtime,
+    "cloudfront-standard": gen_cloudfront_standard,
+    "waf": gen_waf,
+    "route53resolver": gen_route53resolver,
+    "rds-postgresql": gen_rds_postgresql,
+    "rds-mysql-audit": gen_rds_mysql_audit,
+    "rds-mysql-general": gen_rds_mysql_general,
+    "rds-mysql-error": gen_rds_mysql_error,
+    "rds-mysql-slowquery": gen_rds_mysql_slowquery,
+    "msk": gen_msk,
+    "linux-secure": gen_linux_secure,
+    "linux-os-syslog": gen_linux_os_syslog,
+}
+
+
+def generate(logtype, count, seed=0):
+    """return (s3 key, uncompressed body) of count logs of logtype."""
+    rng = random.Random(f"{logtype}:{count}:{seed}")
+    return GENERATORS[logtype](rng, count)
+
+
+def compress(body, compression):
+    if compression == "gzip":
+        return gzip.compress(body, mtime=0)
+    elif compression == "bzip2":
+        return bz2.compress(body)
+    elif compression == "zip":
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(zipfile.ZipInfo("log", (2021, 1, 1, 0, 0, 0)), body)
+        return output.getvalue()
+    elif compression == "text":
+        return body
+    raise ValueError(f"unsupported compression {compression}")
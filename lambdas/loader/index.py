@@ -3,37 +3,96 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
+import logging
 import os
 import re
 import sys
+import threading
 import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache, wraps
+from multiprocessing import connection, get_context
 
 import boto3
 from aws_lambda_powertools import Logger, Metrics
-from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.metrics import MetricUnit, single_metric
+from aws_lambda_powertools.metrics.base import MetricManager
 
 import siem
-from siem import geodb, utils
+from siem import geodb, profiler, utils
 
 __version__ = "2.3.2"
 
 
+class S3KeyFilter(logging.Filter):
+    """add s3_key of the record processed in the current thread to logs.
+
+    Records are processed concurrently, so s3_key is kept per thread instead
+    of in the formatter shared by the threads. The filter is added to the
+    handler so that logs of the child loggers of siem have s3_key too.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.context = threading.local()
+
+    def set_s3_key(self, s3_key):
+        self.context.s3_key = s3_key
+
+    def filter(self, record):
+        s3_key = getattr(self.context, "s3_key", None)
+        if s3_key is not None:
+            record.s3_key = s3_key
+        return True
+
+
 logger = Logger(stream=sys.stdout, log_record_order=["level", "message"])
+s3_key_filter = S3KeyFilter()
+for handler in logger.handlers:
+    handler.addFilter(s3_key_filter)
 logger.info("version: " + __version__)
 metrics = Metrics()
 
 SQS_SPLITTED_LOGS_URL = None
 if "SQS_SPLITTED_LOGS_URL" in os.environ:
     SQS_SPLITTED_LOGS_URL = os.environ["SQS_SPLITTED_LOGS_URL"]
+DEAD_LETTER_BUCKET = None
+if "DEAD_LETTER_BUCKET" in os.environ:
+    DEAD_LETTER_BUCKET = os.environ["DEAD_LETTER_BUCKET"]
+# 全てのレコードをプロファイルする。SQS のメッセージの "profile": true でも有効
+# profile all records. also enabled by "profile": true in a SQS message
+PROFILE_RECORDS = os.environ.get("PROFILE_RECORDS", "").lower() == "true"
+PROFILE_BUCKET = None
+if "PROFILE_BUCKET" in os.environ:
+    PROFILE_BUCKET = os.environ["PROFILE_BUCKET"]
 ES_HOSTNAME = utils.get_es_hostname()
+# bytes of entries sent from a parse worker to the parent at once
+PARSE_WORKER_CHUNK_SIZE = 1048576
+# ログ単位でステージ毎の処理時間を出力する割合。0 は出力しない
+# ratio of logs whose durations of stages are logged one by one. 0 is off
+RECORD_TIMING_SAMPLE_RATE = float(os.environ.get("RECORD_TIMING_SAMPLE_RATE", 0))
+# metric names of the stages timed by StageTimer of LogS3 and LogParser
+STAGE_METRIC_NAMES = {
+    "download": "S3DownloadTime",
+    "decompress": "DecompressTime",
+    "count": "LogCountTime",
+    "parse": "ParseTime",
+    "ecs": "EcsMappingTime",
+    "script": "ScriptTime",
+    "geoip": "GeoIpTime",
+    "serialize": "SerializeTime",
+    "worker_wait": "ParseWorkerWaitTime",
+    "bulk": "BulkTime",
+}
 
 
 def extract_logfile_from_s3(record):
     if "s3" in record:
         s3key = record["s3"]["object"]["key"]
-        logger.structure_logs(append=True, s3_key=s3key)
-        logtype = utils.get_logtype_from_s3key(s3key, logtype_s3key_dict)
+        s3_key_filter.set_s3_key(s3key)
+        logtype = utils.get_logtype_from_s3key(s3key, logtype_router)
         logconfig = create_logconfig(logtype)
         logfile = siem.LogS3(record, logtype, logconfig, s3_client, sqs_queue)
     else:
@@ -74,7 +133,17 @@ def get_value_from_etl_config(logtype, key, keytype=None):
 @lru_cache(maxsize=128)
 def create_logconfig(logtype):
     type_re = ["s3_key_ignored", "log_pattern", "multiline_firstline"]
-    type_int = ["max_log_count", "text_header_line_number", "ignore_header_line_number"]
+    type_int = [
+        "max_log_count",
+        "text_header_line_number",
+        "ignore_header_line_number",
+        "es_bulk_concurrency",
+        "es_bulk_size",
+        "es_bulk_min_size",
+        "es_bulk_took_target",
+        "es_bulk_max_retries",
+        "parse_process_min_size",
+    ]
     type_bool = ["via_cwl", "via_firelens", "ignore_container_stderr", "timestamp_nano"]
     logconfig = {}
     if logtype in ("unknown", "nodata"):
@@ -88,9 +157,20 @@ def create_logconfig(logtype):
             logconfig[key] = get_value_from_etl_config(logtype, key, "bool")
         else:
             logconfig[key] = get_value_from_etl_config(logtype, key)
+    # ECS へのマッピングはログタイプ毎に1回だけ解析する
+    logconfig["ecs_plan"] = utils.compile_ecs_plan(logconfig)
     return logconfig
 
 
+@lru_cache(maxsize=1024)
+def get_bulk_action_prefix(indexname):
+    """return the action line of bulk API up to _id.
+
+    The action line is the same except for _id in an index.
+    """
+    return b'{"index":{"_index":' + utils.json_dumps(indexname) + b',"_id":'
+
+
 def get_es_entries(logfile, exclude_log_patterns):
     """get elasticsearch entries.
 
@@ -103,43 +183,228 @@ def get_es_entries(logfile, exclude_log_patterns):
     sf_module = utils.load_sf_module(logfile, logconfig, user_libs_list)
 
     logparser = siem.LogParser(
-        logfile, logconfig, sf_module, geodb_instance, exclude_log_patterns
+        logfile,
+        logconfig,
+        sf_module,
+        geodb_instance,
+        exclude_log_patterns,
+        RECORD_TIMING_SAMPLE_RATE,
     )
-    for logdata in logfile:
+    processes = count_parse_processes(logfile)
+    if processes > 1:
+        yield from get_es_entries_in_processes(logfile, logparser, processes)
+    else:
+        yield from make_es_entries(logparser, logfile)
+
+
+def make_es_entries(logparser, logdatas):
+    """parse logdatas and yield the NDJSON bytes of bulk API.
+
+    Reading a log from logdatas is timed as parse and building the entry
+    as serialize. Time while the caller holds an entry is not counted.
+    """
+    stage_timer = logparser.stage_timer
+    start = time.perf_counter()
+    for logdata in logdatas:
+        stage_timer.add("parse", time.perf_counter() - start)
         logparser(logdata)
         if logparser.is_ignored:
             logger.debug(f"Skipped log because {logparser.ignored_reason}")
+            start = time.perf_counter()
             continue
-        yield {"index": {"_index": logparser.indexname, "_id": logparser.doc_id}}
+        start = time.perf_counter()
+        action = get_bulk_action_prefix(logparser.indexname) + utils.json_dumps(
+            logparser.doc_id
+        )
         # logger.debug(logparser.json)
-        yield logparser.json
+        # bulk API の action 行と document 行を NDJSON の bytes にして返す
+        entry = b"".join((action, b"}}\n", logparser.json, b"\n"))
+        stage_timer.add("serialize", time.perf_counter() - start)
+        yield entry
+        start = time.perf_counter()
+
+
+def count_parse_processes(logfile):
+    """return the number of processes to parse logfile.
+
+    Logs are parsed in worker processes only when the decompressed data is
+    larger than parse_process_min_size and it is not split into SQS.
+    Workers are forked only when this is the only thread. Locks held by other
+    threads, such as the records processed concurrently, their bulk requests
+    and the profiler, would never be released in the workers.
+    """
+    if parse_processes <= 1 or logfile.is_ignored:
+        return 1
+    if logfile.rawdata_size < logfile.logconfig["parse_process_min_size"]:
+        return 1
+    if logfile.is_split_into_sqs:
+        return 1
+    if threading.active_count() > 1:
+        logger.debug("logs are parsed in this process because of other threads")
+        return 1
+    return parse_processes
+
+
+def parse_worker(conn, logfile, logparser, start, end):
+    """parse logs of start < log number <= end in a forked process.
+
+    Lists of entries are sent to the parent through conn. The durations of
+    stages in this process are sent when all logs were parsed and an error
+    message is sent when parsing failed.
+    """
+    try:
+        logfile.reopen_rawdata()
+        logparser.geodb_instance.reopen_after_fork()
+        # the stages of the parent before fork are not counted again
+        logfile.stage_timer.reset()
+        entries, size = [], 0
+        for entry in make_es_entries(logparser, logfile.extract_logdata(start, end)):
+            entries.append(entry)
+            size += len(entry)
+            if size >= PARSE_WORKER_CHUNK_SIZE:
+                conn.send(entries)
+                entries, size = [], 0
+        if entries:
+            conn.send(entries)
+        conn.send(logfile.stage_timer.durations)
+    except Exception as e:
+        logger.exception("failed to parse logs in worker process")
+        conn.send(f"failed to parse logs {start + 1}-{end} in worker process: {e}")
+    finally:
+        conn.close()
+
+
+def get_es_entries_in_processes(logfile, logparser, processes):
+    """parse logs in forked worker processes and yield their entries.
+
+    Each worker parses a contiguous range of logs. It shares the spooled
+    rawdata, logconfig, sf module and GeoDB with this process by fork, so
+    nothing is pickled except the entries. multiprocessing.Queue and Pool
+    don't work in Lambda, which has no /dev/shm, so each worker has its own
+    Pipe. Entries are yielded in the order they arrive and this process
+    keeps the connection to Amazon ES. The durations of stages in workers
+    are merged into the stage_timer of logfile, and the time this process
+    waits for workers is counted as worker_wait.
+    """
+    if logparser.ecs_plan["geoip"]:
+        # workers open the databases downloaded here
+        logparser.geodb_instance.open_databases()
+    context = get_context("fork")
+    workers = {}
+    try:
+        for start, end in logfile.split_log_range(processes):
+            recv_conn, send_conn = context.Pipe(duplex=False)
+            process = context.Process(
+                target=parse_worker,
+                args=(send_conn, logfile, logparser, start, end),
+                daemon=True,
+            )
+            process.start()
+            send_conn.close()
+            workers[recv_conn] = process
+        while workers:
+            with logfile.stage_timer.measure("worker_wait"):
+                ready = connection.wait(list(workers))
+            for conn in ready:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = "worker process exited without result"
+                if isinstance(message, list):
+                    yield from message
+                    continue
+                process = workers.pop(conn)
+                conn.close()
+                process.join()
+                if not isinstance(message, dict):
+                    raise Exception(message)
+                logfile.stage_timer.merge(message)
+    finally:
+        for conn, process in workers.items():
+            process.terminate()
+            process.join()
+            conn.close()
 
 
 def check_es_results(results):
+    """count the results of bulk API.
+
+    Failed items are returned as lists of (position, error reason). Items
+    rejected with 429 or 503 are retryable. The others such as 400 mapping
+    errors are permanent.
+    """
     duration = results["took"]
-    success, error = 0, 0
-    error_reasons = []
+    success = 0
+    retryable, permanent = [], []
     if not results["errors"]:
         success = len(results["items"])
     else:
-        for result in results["items"]:
-            if result["index"]["status"] >= 300:
+        for i, result in enumerate(results["items"]):
+            status = result["index"]["status"]
+            if status >= 300:
                 # status code
-                # 200:OK, 201:Created, 400:NG
-                error += 1
+                # 200:OK, 201:Created, 400:NG, 429:Too Many Requests
                 error_reason = result["index"].get("error")
-                if error_reason:
-                    error_reasons.append(error_reason)
+                if status in (429, 503) or (
+                    isinstance(error_reason, dict)
+                    and error_reason.get("type") == "es_rejected_execution_exception"
+                ):
+                    retryable.append((i, error_reason))
+                else:
+                    permanent.append((i, error_reason))
             else:
                 success += 1
 
-    return duration, success, error, error_reasons
+    return duration, success, retryable, permanent
 
 
-def bulkloads_into_elasticsearch(es_entries, collected_metrics):
+class BulkSizeController:
+    """adjust the size of bulk requests with the response of Amazon ES.
+
+    The size starts at max_size. It is halved and the next request is
+    delayed with exponential backoff when Amazon ES rejects documents
+    (429) or when took is over took_target. It grows by a quarter while
+    took is under half of took_target.
+    """
+
+    def __init__(self, min_size, max_size, took_target):
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.took_target = took_target
+        self.size = max_size
+        self.backoff = 0
+
+    def update(self, took, rejected):
+        if rejected:
+            self.size = max(self.size // 2, self.min_size)
+            self.backoff = min(max(self.backoff * 2, 0.1), 5)
+        elif took > self.took_target:
+            self.size = max(self.size // 2, self.min_size)
+            self.backoff = 0
+        else:
+            if took < self.took_target / 2:
+                self.size = min(self.size + self.size // 4, self.max_size)
+            self.backoff = 0
+
+
+def bulkloads_into_elasticsearch(es_entries, collected_metrics, logconfig):
+    """load es_entries into Amazon ES with bulk API.
+
+    Each entry is the NDJSON bytes of one document. Entries are joined into
+    a bulk body and the body is sent to the transport as is. The size of
+    the body is adjusted between es_bulk_min_size and es_bulk_size by
+    BulkSizeController. Bulk requests are sent on a thread pool and es_entries
+    keeps being parsed while up to es_bulk_concurrency requests are in
+    flight. The results are merged in order of the requests.
+
+    Only the retryable failed documents are sent again, up to
+    es_bulk_max_retries times with backoff. Documents which failed
+    permanently are written to DEAD_LETTER_BUCKET and counted as
+    dead_letter_count. Without the bucket they are only counted as errors,
+    so the record fails and is retried.
+    """
     output_size, total_output_size = 0, 0
     total_count, success_count, error_count, es_response_time = 0, 0, 0, 0
-    results = False
     putdata_list = []
     error_reason_list = []
     filter_path = [
@@ -149,42 +414,108 @@ def bulkloads_into_elasticsearch(es_entries, collected_metrics):
         "items.index.error.reason",
         "items.index.error.type",
     ]
-    for data in es_entries:
-        putdata_list.append(data)
-        output_size += len(str(data))
-        # es の http.max_content_length は t2 で10MB なのでデータがたまったらESにロード
-        if isinstance(data, str) and output_size > 6000000:
-            total_output_size += output_size
-            results = es_conn.bulk(putdata_list, filter_path=filter_path)
-            es_took, success, error, error_reasons = check_es_results(results)
+    concurrency = max(logconfig.get("es_bulk_concurrency", 1), 1)
+    max_retries = logconfig.get("es_bulk_max_retries", 3)
+    in_flight = deque()
+    dead_letters = []
+    retry_count = 0
+
+    def collect_oldest_result():
+        nonlocal success_count, error_count, es_response_time, retry_count
+        future, entries = in_flight.popleft()
+        results = future.result()
+        attempt = 0
+        while True:
+            es_took, success, retryable, permanent = check_es_results(results)
+            controller.update(es_took, len(retryable))
+            bulk_latencies.append(es_took)
             success_count += success
-            error_count += error
             es_response_time += es_took
-            output_size = 0
-            total_count += len(putdata_list)
-            putdata_list = []
+            if DEAD_LETTER_BUCKET:
+                dead_letters.extend((entries[i], reason) for i, reason in permanent)
+            retry = retryable and attempt < max_retries
+            failed = permanent if retry else permanent + retryable
+            error_count += len(failed)
+            error_reasons = [reason for _, reason in failed if reason]
             if len(error_reasons):
                 error_reason_list.extend([error_reasons])
-    if output_size > 0:
-        total_output_size += output_size
-        results = es_conn.bulk(putdata_list, filter_path=filter_path)
-        # logger.debug(results)
-        es_took, success, error, error_reasons = check_es_results(results)
-        success_count += success
-        error_count += error
-        es_response_time += es_took
-        total_count += len(putdata_list)
-        if len(error_reasons):
-            error_reason_list.extend([error_reasons])
+            if not retry:
+                break
+            # 失敗したドキュメントのうち再送可能なものだけを再送する
+            entries = [entries[i] for i, _ in retryable]
+            retry_count += len(entries)
+            attempt += 1
+            time.sleep(controller.backoff)
+            results = es_conn.bulk(b"".join(entries), filter_path=filter_path)
+
+    controller = BulkSizeController(
+        logconfig.get("es_bulk_min_size", 1000000),
+        logconfig.get("es_bulk_size", 6000000),
+        logconfig.get("es_bulk_took_target", 3000),
+    )
+    bulk_sizes, bulk_latencies = [], []
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def submit_bulk():
+            nonlocal output_size, total_output_size, total_count, putdata_list
+            if len(in_flight) >= concurrency:
+                collect_oldest_result()
+            if controller.backoff:
+                time.sleep(controller.backoff)
+            bulk_sizes.append(output_size)
+            total_output_size += output_size
+            total_count += len(putdata_list)
+            in_flight.append(
+                (
+                    executor.submit(
+                        es_conn.bulk, b"".join(putdata_list), filter_path=filter_path
+                    ),
+                    putdata_list,
+                )
+            )
+            output_size = 0
+            putdata_list = []
+
+        for data in es_entries:
+            # es の http.max_content_length は t2 で10MB なので
+            # es_bulk_size を超える前にESにロード
+            if putdata_list and output_size + len(data) > controller.size:
+                submit_bulk()
+            putdata_list.append(data)
+            output_size += len(data)
+        if putdata_list:
+            submit_bulk()
+        while in_flight:
+            collect_oldest_result()
+    if dead_letters:
+        dead_letter_path = utils.write_dead_letters(
+            dead_letters, s3_client, DEAD_LETTER_BUCKET
+        )
+        logger.error(
+            f"{len(dead_letters)} of logs were rejected by Amazon ES and "
+            f"written to {dead_letter_path}"
+        )
     collected_metrics["total_output_size"] = total_output_size
     collected_metrics["total_log_load_count"] = total_count
     collected_metrics["success_count"] = success_count
     collected_metrics["error_count"] = error_count
+    collected_metrics["retry_count"] = retry_count
+    collected_metrics["dead_letter_count"] = len(dead_letters)
     collected_metrics["es_response_time"] = es_response_time
+    collected_metrics["bulk_sizes"] = bulk_sizes
+    collected_metrics["bulk_latencies"] = bulk_latencies
 
     return collected_metrics, error_reason_list
 
 
+def count_geoip_cache():
+    cache_info = geodb_instance.cache_info()
+    hits = sum(info["hits"] for info in cache_info.values())
+    misses = sum(info["misses"] for info in cache_info.values())
+    return hits, misses
+
+
 def output_metrics(metrics, record=None, logfile=None, collected_metrics={}):
     if not os.environ.get("AWS_EXECUTION_ENV"):
         return
@@ -216,6 +547,33 @@ def output_metrics(metrics, record=None, logfile=None, collected_metrics={}):
     metrics.add_metric(
         name="EsResponseTime", unit=MetricUnit.Milliseconds, value=es_response_time
     )
+    # EMF は1つのメトリクスに100個まで値を持てる
+    for bulk_size in collected_metrics.get("bulk_sizes", [])[:100]:
+        metrics.add_metric(name="BulkSize", unit=MetricUnit.Bytes, value=bulk_size)
+    for bulk_latency in collected_metrics.get("bulk_latencies", [])[:100]:
+        metrics.add_metric(
+            name="BulkLatency", unit=MetricUnit.Milliseconds, value=bulk_latency
+        )
+    if "geoip_cache_hit_count" in collected_metrics:
+        metrics.add_metric(
+            name="GeoIpCacheHitCount",
+            unit=MetricUnit.Count,
+            value=collected_metrics["geoip_cache_hit_count"],
+        )
+        metrics.add_metric(
+            name="GeoIpCacheMissCount",
+            unit=MetricUnit.Count,
+            value=collected_metrics["geoip_cache_miss_count"],
+        )
+    # S3 オブジェクト単位で集計したステージ毎の処理時間
+    stage_durations = logfile.stage_timer.durations
+    for stage, name in STAGE_METRIC_NAMES.items():
+        if stage in stage_durations:
+            metrics.add_metric(
+                name=name,
+                unit=MetricUnit.Milliseconds,
+                value=round(stage_durations[stage] * 1000, 3),
+            )
     metrics.add_metric(name="TotalLogFileCount", unit=MetricUnit.Count, value=1)
     metrics.add_metric(
         name="TotalLogCount", unit=MetricUnit.Count, value=total_log_count
@@ -223,6 +581,26 @@ def output_metrics(metrics, record=None, logfile=None, collected_metrics={}):
     metrics.add_metadata(key="s3_key", value=s3_key)
 
 
+def init_phase(name, func, *args, **kwargs):
+    """run a step of initialization and record the duration in init_timings."""
+    start_time = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        init_timings[name] = int((time.perf_counter() - start_time) * 1000)
+
+
+def output_init_metrics(init_timings):
+    if not os.environ.get("AWS_EXECUTION_ENV"):
+        return
+    for phase, duration in init_timings.items():
+        with single_metric(
+            name="InitDuration", unit=MetricUnit.Milliseconds, value=duration
+        ) as metric:
+            metric.add_dimension(name="phase", value=phase)
+            metric.add_dimension(name="version", value=__version__)
+
+
 def observability_decorator_switcher(func):
     if os.environ.get("AWS_EXECUTION_ENV"):
 
@@ -242,59 +620,197 @@ def observability_decorator_switcher(func):
         return decorator
 
 
-es_conn = utils.initialize_es_connection(ES_HOSTNAME)
-user_libs_list = utils.find_user_custom_libs()
-etl_config = utils.get_etl_config()
-utils.load_modules_on_memory(etl_config, user_libs_list)
-logtype_s3key_dict = utils.create_logtype_s3key_dict(etl_config)
-
-exclude_own_log_patterns = utils.make_exclude_own_log_patterns(etl_config)
-csv_filename = utils.get_exclude_log_patterns_csv_filename(etl_config)
-exclude_log_patterns = utils.merge_csv_into_log_patterns(
-    exclude_own_log_patterns, csv_filename
-)
+init_timings = {}
+init_start_time = time.perf_counter()
+etl_config = init_phase("config", utils.get_etl_config)
 s3_session_config = utils.make_s3_session_config(etl_config)
-s3_client = boto3.client("s3", config=s3_session_config)
-sqs_queue = utils.sqs_queue(SQS_SPLITTED_LOGS_URL)
+s3_client = init_phase("s3_client", boto3.client, "s3", config=s3_session_config)
+# ネットワークを使う初期化は並列に実行し、その間に sf モジュールを読み込む
+# Steps using network run concurrently while sf modules are imported
+with ThreadPoolExecutor(max_workers=3) as init_executor:
+    es_conn_future = init_executor.submit(
+        init_phase, "es_connection", utils.initialize_es_connection, ES_HOSTNAME
+    )
+    csv_filename_future = init_executor.submit(
+        init_phase,
+        "exclude_log_patterns_csv",
+        utils.get_exclude_log_patterns_csv_filename,
+        etl_config,
+        s3_client,
+    )
+    sqs_queue_future = init_executor.submit(
+        init_phase, "sqs_queue", utils.sqs_queue, SQS_SPLITTED_LOGS_URL
+    )
+    user_libs_list = utils.find_user_custom_libs()
+    init_phase("sf_modules", utils.load_modules_on_memory, etl_config, user_libs_list)
+    logtype_s3key_dict = utils.create_logtype_s3key_dict(etl_config)
+    logtype_router = utils.create_logtype_router(logtype_s3key_dict)
+    exclude_own_log_patterns = utils.make_exclude_own_log_patterns(etl_config)
+    es_conn = es_conn_future.result()
+    csv_filename = csv_filename_future.result()
+    sqs_queue = sqs_queue_future.result()
+record_concurrency = max(etl_config["DEFAULT"].getint("record_concurrency", 1), 1)
+# 0 はコンテナの CPU 数に合わせる
+# 0 follows the CPU limit of the container
+parse_processes = etl_config["DEFAULT"].getint("parse_processes", 1)
+if parse_processes <= 0:
+    parse_processes = utils.get_cpu_limit()
+exclude_log_patterns = utils.compile_exclude_log_patterns(
+    utils.merge_csv_into_log_patterns(exclude_own_log_patterns, csv_filename)
+)
 
-geodb_instance = geodb.GeoDB()
+# GeoIP のデータベースは geoip を使うログを処理する時にダウンロードする
+# GeoIP databases are downloaded when a log with geoip is processed
+geodb_instance = geodb.GeoDB(s3_client)
 utils.show_local_dir()
+init_timings["total"] = int((time.perf_counter() - init_start_time) * 1000)
+output_init_metrics(init_timings)
 
 
-@observability_decorator_switcher
-def lambda_handler(event, context):
-    for record in event["Records"]:
-        collected_metrics = {"start_time": time.perf_counter()}
-        if "body" in record:
-            # from sqs-splitted-logs
-            record = json.loads(record["body"])
-        # S3からファイルを取得してログを抽出する
-        logfile = extract_logfile_from_s3(record)
-        if logfile.is_ignored:
-            logger.warning(f"Skipped S3 object because {logfile.ignored_reason}")
-            continue
+def publish_metrics(record_metrics):
+    """print the metrics of a record in embedded metric format.
+
+    Each record has its own metrics so that the logtype dimension and values
+    of records processed concurrently are not mixed.
+    """
+    if record_metrics.metric_set:
+        print(json.dumps(record_metrics.serialize_metric_set()))
+
+
+def is_profiled_record(record):
+    if PROFILE_RECORDS:
+        return True
+    if "body" not in record:
+        return False
+    try:
+        return json.loads(record["body"]).get("profile") is True
+    except Exception:
+        return False
+
+
+def profiler_switcher(func):
+    """run func with RecordProfiler if the record is profiled.
+
+    The profile is keyed by the logtype and the s3 key of the record.
+    """
+
+    @wraps(func)
+    def decorator(record):
+        if not is_profiled_record(record):
+            return func(record)
+        s3_record = json.loads(record["body"]) if "body" in record else record
+        if "s3" not in s3_record:
+            return func(record)
+        s3key = s3_record["s3"]["object"]["key"]
+        logtype = utils.get_logtype_from_s3key(s3key, logtype_router)
+        with profiler.RecordProfiler(
+            logtype, urllib.parse.unquote_plus(s3key), s3_client, PROFILE_BUCKET
+        ):
+            return func(record)
+
+    return decorator
+
+
+@profiler_switcher
+def process_record(record):
+    """load the S3 object of a record into Amazon ES.
+
+    Exception is raised when logs were NOT loaded, so the record is retried.
+    """
+    collected_metrics = {"start_time": time.perf_counter()}
+    if "body" in record:
+        # from sqs-splitted-logs
+        record = json.loads(record["body"])
+    # S3からファイルを取得してログを抽出する
+    logfile = extract_logfile_from_s3(record)
+    if logfile.is_ignored:
+        logger.warning(f"Skipped S3 object because {logfile.ignored_reason}")
+        return
 
-        # 抽出したログからESにPUTするデータを作成する
-        es_entries = get_es_entries(logfile, exclude_log_patterns)
-        # 作成したデータをESにPUTしてメトリクスを収集する
+    # 抽出したログからESにPUTするデータを作成する
+    geoip_hits, geoip_misses = count_geoip_cache()
+    es_entries = get_es_entries(logfile, exclude_log_patterns)
+    # 作成したデータをESにPUTしてメトリクスを収集する
+    # es_entries is parsed lazily in bulkloads. its stages are not in bulk
+    with logfile.stage_timer.measure("bulk"):
         collected_metrics, error_reason_list = bulkloads_into_elasticsearch(
-            es_entries, collected_metrics
+            es_entries, collected_metrics, logfile.logconfig
         )
-        output_metrics(
-            metrics, record=record, logfile=logfile, collected_metrics=collected_metrics
+    hits, misses = count_geoip_cache()
+    collected_metrics["geoip_cache_hit_count"] = hits - geoip_hits
+    collected_metrics["geoip_cache_miss_count"] = misses - geoip_misses
+    record_metrics = MetricManager()
+    output_metrics(
+        record_metrics,
+        record=record,
+        logfile=logfile,
+        collected_metrics=collected_metrics,
+    )
+    publish_metrics(record_metrics)
+    # raise error to retry if error has occuered
+    # dead letter に書き出したドキュメントは再送しても失敗するのでリトライしない
+    if logfile.is_ignored:
+        logger.warning(f"Skipped S3 object because {logfile.ignored_reason}")
+    elif collected_metrics["error_count"] > collected_metrics.get(
+        "dead_letter_count", 0
+    ):
+        error_message = (
+            f"{collected_metrics['error_count']}"
+            " of logs were NOT loaded into Amazon ES"
         )
-        # raise error to retry if error has occuered
-        if logfile.is_ignored:
-            logger.warning(f"Skipped S3 object because {logfile.ignored_reason}")
-        elif collected_metrics["error_count"]:
-            error_message = (
-                f"{collected_metrics['error_count']}"
-                " of logs were NOT loaded into Amazon ES"
-            )
-            logger.error(error_message)
-            logger.error(error_reason_list[:5])
-            raise Exception(error_message)
-        elif collected_metrics["total_log_load_count"] > 0:
-            logger.info("All logs were loaded into Amazon ES")
-        else:
-            logger.warning("No entries were successed to load")
+        logger.error(error_message)
+        logger.error(error_reason_list[:5])
+        raise Exception(error_message)
+    elif collected_metrics.get("dead_letter_count"):
+        logger.error(error_reason_list[:5])
+    elif collected_metrics["total_log_load_count"] > 0:
+        logger.info("All logs were loaded into Amazon ES")
+    else:
+        logger.warning("No entries were successed to load")
+
+
+def process_records(records):
+    """process records concurrently up to record_concurrency.
+
+    A failure of a record doesn't stop the others. Failed records are
+    returned. Records are processed one by one if any of them is profiled,
+    so that the profile has only its own allocations.
+    """
+    failed_records = []
+    concurrency = min(record_concurrency, len(records))
+    if any(is_profiled_record(record) for record in records):
+        concurrency = 1
+    if concurrency <= 1:
+        for record in records:
+            try:
+                process_record(record)
+            except Exception:
+                logger.exception("failed to process a record")
+                failed_records.append(record)
+        return failed_records
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(process_record, record) for record in records]
+    for record, future in zip(records, futures):
+        try:
+            future.result()
+        except Exception:
+            logger.exception("failed to process a record")
+            failed_records.append(record)
+    return failed_records
+
+
+@observability_decorator_switcher
+def lambda_handler(event, context):
+    records = event["Records"]
+    failed_records = process_records(records)
+    if not failed_records:
+        return None
+    if all(isinstance(record, dict) and "messageId" in record for record in records):
+        # SQS からの場合は失敗したメッセージだけを再送させる
+        # only failed messages of SQS are retried (ReportBatchItemFailures)
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": record["messageId"]} for record in failed_records
+            ]
+        }
+    raise Exception(f"{len(failed_records)} of {len(records)} records were failed")
@@ -1,16 +1,15 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import bz2
-import gzip
+import bisect
 import hashlib
 import io
-import ipaddress
 import json
+import random
 import re
-from unittest.mock import patch
+import time
 import urllib.parse
-import zipfile
+from array import array
 from datetime import datetime, timedelta, timezone
 from functools import cached_property
 
@@ -39,8 +38,17 @@ class LogS3:
 
         self.loggroup = None
         self.logstream = None
+        # start offset of each line in decompressed data. see spool_rawdata
+        self.line_offsets = array("Q", [0])
+        # number of json records before each line. built when counting
+        self.json_counts_before_line = None
+        # (compressed offset, decompressed offset) of gzip members
+        self.compressed_members = None
+        self.mime_type = None
         self.s3bucket = self.record["s3"]["bucket"]["name"]
         self.s3key = self.record["s3"]["object"]["key"]
+        # seconds of each stage to process this object. see output_metrics
+        self.stage_timer = utils.StageTimer()
 
         logger.info(self.startmsg())
         if self.is_ignored:
@@ -50,16 +58,18 @@ class LogS3:
         self.file_format = self.logconfig["file_format"]
         self.max_log_count = self.logconfig["max_log_count"]
 
-        self.__rawdata = self.extract_rawdata_from_s3obj()
+        # time to read S3 object is counted as download, not decompress
+        with self.stage_timer.measure("decompress"):
+            self.__rawdata = self.extract_rawdata_from_s3obj()
 
-        if self.__rawdata and self.via_cwl:
-            (
-                self.loggroup,
-                self.logstream,
-                self.cwl_accountid,
-            ) = self.extract_header_from_cwl(self.__rawdata)
-            self.__rawdata.seek(0)
-            self.__rawdata = self.extract_messages_from_cwl(self.__rawdata)
+            if self.__rawdata and self.via_cwl:
+                (
+                    self.loggroup,
+                    self.logstream,
+                    self.cwl_accountid,
+                ) = self.extract_header_from_cwl(self.__rawdata)
+                self.__rawdata.seek(0)
+                self.__rawdata = self.extract_messages_from_cwl(self.__rawdata)
 
         if self.file_format in ("multiline",):
             self.re_multiline_firstline = self.logconfig["multiline_firstline"]
@@ -67,16 +77,15 @@ class LogS3:
     def __iter__(self):
         if self.is_ignored:
             return
-        if self.log_count >= self.max_log_count:
-            if self.sqs_queue:
-                metadata = self.split_logs(self.log_count, self.max_log_count)
-                sent_count = self.send_meta_to_sqs(metadata)
-                self.is_ignored = True
-                self.total_log_count = 0
-                self.ignored_reason = (
-                    f"Log file was split into {sent_count}" f" pieces and sent to SQS."
-                )
-                return
+        if self.is_split_into_sqs:
+            metadata = self.split_logs(self.log_count, self.max_log_count)
+            sent_count = self.send_meta_to_sqs(metadata)
+            self.is_ignored = True
+            self.total_log_count = 0
+            self.ignored_reason = (
+                f"Log file was split into {sent_count}" f" pieces and sent to SQS."
+            )
+            return
         yield from self.logdata_generator()
 
     ###########################################################################
@@ -105,17 +114,17 @@ class LogS3:
     @cached_property
     def log_count(self):
         if self.end_number == 0:
-            if self.file_format in ("text", "csv") or self.via_firelens:
-                log_count = len(self.rawdata.readlines())
-                # log_count = sum(1 for line in self.rawdata)
-            elif "json" in self.file_format:
-                log_count = 0
-                for x in self.extract_logobj_from_json(mode="count"):
-                    log_count = x
-            elif self.file_format in ("multiline",):
-                log_count = self.count_multiline_log()
-            else:
-                log_count = 0
+            with self.stage_timer.measure("count"):
+                if self.file_format in ("text", "csv") or self.via_firelens:
+                    log_count = len(self.line_offsets) - 1
+                elif "json" in self.file_format:
+                    log_count = 0
+                    for x in self.extract_logobj_from_json(mode="count"):
+                        log_count = x
+                elif self.file_format in ("multiline",):
+                    log_count = self.count_multiline_log()
+                else:
+                    log_count = 0
             if log_count == 0:
                 self.is_ignored = True
                 self.ignored_reason = "there are not any valid logs in S3 object"
@@ -123,6 +132,11 @@ class LogS3:
         else:
             return self.end_number - self.start_number
 
+    @property
+    def is_split_into_sqs(self):
+        """the logs are split and sent to SQS instead of being loaded"""
+        return bool(self.sqs_queue) and self.log_count >= self.max_log_count
+
     @property
     def rawdata(self):
         self.__rawdata.seek(0)
@@ -131,7 +145,10 @@ class LogS3:
     @cached_property
     def csv_header(self):
         if "csv" in self.file_format:
-            return self.rawdata.readlines()[0].strip()
+            if self.checkpoint and "csv_header" in self.checkpoint:
+                # rawdata of split log doesn't start with header
+                return self.checkpoint["csv_header"]
+            return self.rawdata.readline().strip()
         else:
             return None
 
@@ -171,6 +188,14 @@ class LogS3:
         except KeyError:
             return 0
 
+    @cached_property
+    def checkpoint(self):
+        """where the split log starts in S3 object. see make_checkpoint"""
+        try:
+            return self.record["siem"]["checkpoint"]
+        except KeyError:
+            return None
+
     ###########################################################################
     # Method/Function
     ###########################################################################
@@ -186,6 +211,15 @@ class LogS3:
         return startmsg
 
     def logdata_generator(self):
+        start, end = self.log_range()
+        yield from self.extract_logdata(start, end)
+
+    def log_range(self):
+        """return (start, end) of the logs to be extracted from rawdata.
+
+        Logs of start < log number <= end are extracted. Header lines and
+        the logs before the checkpoint of split logs are excluded.
+        """
         if "text" in self.file_format:
             ignore_header_line_number = self.logconfig["text_header_line_number"]
         elif "csv" in self.file_format:
@@ -194,7 +228,10 @@ class LogS3:
             ignore_header_line_number = 0
         if self.start_number <= ignore_header_line_number:
             start = ignore_header_line_number
-            if self.max_log_count >= self.log_count:
+            if self.end_number:
+                # first piece of split logs
+                end = self.end_number
+            elif self.max_log_count >= self.log_count:
                 end = self.log_count
             else:
                 end = self.max_log_count
@@ -202,9 +239,22 @@ class LogS3:
             start = self.start_number - 1
             end = self.end_number
         self.total_log_count = end - start
-
+        if self.checkpoint:
+            # rawdata starts at the line of checkpoint
+            start = max(start - self.checkpoint["count"], 0)
+            end = end - self.checkpoint["count"]
+        return start, end
+
+    def split_log_range(self, number):
+        """split the range of log_range into number of contiguous ranges."""
+        start, end = self.log_range()
+        size = -(-(end - start) // number)
+        return [(x, min(x + size, end)) for x in range(start, end, max(size, 1))]
+
+    def extract_logdata(self, start, end):
+        """yield logs of start < log number <= end."""
         if self.file_format in ("text", "csv") or self.via_firelens:
-            for logdata in self.rawdata.readlines()[start:end]:
+            for logdata in self.iter_lines(start, end):
                 yield logdata.strip()
         elif "json" in self.file_format:
             logobjs = self.extract_logobj_from_json("extract", start, end)
@@ -215,44 +265,114 @@ class LogS3:
         else:
             raise Exception
 
-    def extract_header_from_cwl(self, rawdata):
+    def iter_json_objects(self, rawdata):
+        """yield concatenated json objects without reading whole stream."""
+        decoder = utils.JSON_DECODER
+        buffer = ""
         index = 0
-        body = rawdata
-        decoder = json.JSONDecoder()
+        is_eof = False
         while True:
+            index = json.decoder.WHITESPACE.match(buffer, index).end()
+            if index >= len(buffer):
+                if is_eof:
+                    return
+                buffer = rawdata.read(utils.DECOMPRESS_CHUNK_SIZE)
+                index = 0
+                is_eof = not buffer
+                continue
             try:
-                obj, offset = decoder.raw_decode(body.read())
+                obj, index = decoder.raw_decode(buffer, index)
             except json.decoder.JSONDecodeError:
-                break
-            index = offset + index
-            body.seek(index)
-            if "CONTROL_MESSAGE" in obj["messageType"]:
+                if is_eof:
+                    raise
+                # json object continues in next chunk
+                chunk = rawdata.read(max(utils.DECOMPRESS_CHUNK_SIZE, len(buffer)))
+                is_eof = not chunk
+                buffer = buffer[index:] + chunk
+                index = 0
                 continue
-            loggroup = obj["logGroup"]
-            logstream = obj["logStream"]
-            owner = obj["owner"]
-            return loggroup, logstream, owner
+            yield obj
+
+    def extract_header_from_cwl(self, rawdata):
+        try:
+            for obj in self.iter_json_objects(rawdata):
+                if "CONTROL_MESSAGE" in obj["messageType"]:
+                    continue
+                loggroup = obj["logGroup"]
+                logstream = obj["logStream"]
+                owner = obj["owner"]
+                return loggroup, logstream, owner
+        except json.decoder.JSONDecodeError:
+            pass
         return None, None, None
 
     def extract_messages_from_cwl(self, rawlog_io_obj):
-        decoder = json.JSONDecoder()
-        rawlog = rawlog_io_obj.read()
-        size = len(rawlog)
-        index = 0
-        newlog_io_obj = io.StringIO()
-        while size > index:
-            obj, index = decoder.raw_decode(rawlog, index)
-            if "CONTROL_MESSAGE" in obj["messageType"]:
-                continue
-            for log in obj["logEvents"]:
-                newlog_io_obj.write(log["message"] + "\n")
-        newlog_io_obj.seek(0)
+        def messages():
+            for obj in self.iter_json_objects(rawlog_io_obj):
+                if "CONTROL_MESSAGE" in obj["messageType"]:
+                    continue
+                for log in obj["logEvents"]:
+                    yield (log["message"] + "\n").encode("utf8", errors="ignore")
+
+        newlog_io_obj = self.spool_rawdata(messages())
         return newlog_io_obj
 
+    def spool_rawdata(self, chunks):
+        """spool decompressed chunks and index the start offset of lines."""
+        self.line_offsets = array("Q", [0])
+        self.json_counts_before_line = None
+        spool = utils.spool_chunks(chunks, line_offsets=self.line_offsets)
+        return io.TextIOWrapper(spool, encoding="utf8", errors="ignore")
+
+    @property
+    def rawdata_size(self):
+        """size of decompressed data"""
+        return self.line_offsets[-1]
+
+    def reopen_rawdata(self):
+        """open rawdata again with its own file offset.
+
+        A process forked after rawdata was spilled to a temporary file
+        shares the file offset with the parent and the other workers.
+        """
+        spool = self.__rawdata.buffer
+        try:
+            fd = spool.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # in memory. the forked process has its own copy
+            return
+        self.__rawdata = io.TextIOWrapper(
+            open(f"/proc/self/fd/{fd}", "rb"), encoding="utf8", errors="ignore"
+        )
+
+    def iter_lines(self, start=0, end=None):
+        """yield lines[start:end] by seeking with the line index."""
+        line_count = len(self.line_offsets) - 1
+        if end is None or end > line_count:
+            end = line_count
+        if start >= end:
+            return
+        rawbuffer = self.rawdata.buffer
+        rawbuffer.seek(self.line_offsets[start])
+        for _ in range(start, end):
+            yield rawbuffer.readline().decode("utf8", errors="ignore")
+
     def extract_rawdata_from_s3obj(self):
+        checkpoint = self.checkpoint
         try:
             safe_s3_key = urllib.parse.unquote_plus(self.s3key)
-            obj = self.s3_client.get_object(Bucket=self.s3bucket, Key=safe_s3_key)
+            with self.stage_timer.measure("download"):
+                if checkpoint:
+                    # split log. download from the gzip member including the log
+                    obj = self.s3_client.get_object(
+                        Bucket=self.s3bucket,
+                        Key=safe_s3_key,
+                        Range=f"bytes={checkpoint['member_offset']}-",
+                    )
+                else:
+                    obj = self.s3_client.get_object(
+                        Bucket=self.s3bucket, Key=safe_s3_key
+                    )
         except Exception:
             msg = f"Failed to download S3 object from {self.s3key}"
             logger.exception(msg)
@@ -261,93 +381,140 @@ class LogS3:
             s3size = int(obj["ResponseMetadata"]["HTTPHeaders"]["content-length"])
         except Exception:
             s3size = 20
-        if s3size < 20:
+        if s3size < 20 and not checkpoint:
             self.is_ignored = True
             self.ignored_reason = (
                 f"no valid contents in s3 object, size of "
                 f"{self.s3key} is only {s3size} byte"
             )
             return None
-        rawbody = io.BytesIO(obj["Body"].read())
-        mime_type = utils.get_mime_type(rawbody.read(16))
-        rawbody.seek(0)
-        if mime_type == "gzip":
-            body = gzip.open(rawbody, mode="rt", encoding="utf8", errors="ignore")
-        elif mime_type == "text":
-            body = io.TextIOWrapper(rawbody, encoding="utf8", errors="ignore")
-        elif mime_type == "zip":
-            z = zipfile.ZipFile(rawbody)
-            body = open(z.namelist()[0], encoding="utf8", errors="ignore")
-        elif mime_type == "bzip2":
-            body = bz2.open(rawbody, mode="rt", encoding="utf8", errors="ignore")
+        # S3 の StreamingBody を一度だけ読んで伸長し、伸長後のデータを spool する
+        rawbody = utils.TimedReader(obj["Body"], self.stage_timer, "download")
+        head = rawbody.read(16)
+        if checkpoint:
+            mime_type = checkpoint["mime_type"]
         else:
+            mime_type = utils.get_mime_type(head)
+        if mime_type not in ("gzip", "text", "zip", "bzip2"):
             logger.error("unknown file format")
             raise Exception("unknown file format")
+        self.mime_type = mime_type
+        if mime_type in ("gzip", "bzip2") and not checkpoint:
+            self.compressed_members = []
+        chunks = utils.iter_decompressed_chunks(
+            rawbody, mime_type, head, self.compressed_members
+        )
+        if checkpoint:
+            # skip to the first line and stop decompressing after the last line
+            chunks = utils.slice_chunks(
+                chunks,
+                checkpoint["offset"] - checkpoint["member_base"],
+                checkpoint["end_offset"] - checkpoint["member_base"],
+            )
+        body = self.spool_rawdata(chunks)
+        if checkpoint:
+            rawbody.close()
         return body
 
     def extract_logobj_from_json(self, mode="count", start=0, end=0):
-        decoder = json.JSONDecoder()
+        """yield json records. start < record number <= end.
+
+        When mode is count, yield the number of records of each line and
+        index the number of records before each line, so that extraction of
+        a later slice can skip lines which are out of scope.
+        """
         delimiter = self.logconfig["json_delimiter"]
+        is_count_mode = "count" in mode
+        first_line = 0
         count = 0
+        if is_count_mode:
+            self.json_counts_before_line = array("Q")
+        elif self.json_counts_before_line:
+            first_line = bisect.bisect_right(self.json_counts_before_line, start) - 1
+            count = self.json_counts_before_line[first_line]
         # For ndjson
-        for line in self.rawdata.readlines():
+        for line in self.iter_lines(first_line):
+            if is_count_mode:
+                self.json_counts_before_line.append(count)
+            elif count >= end:
+                break
             # for Firehose's json (multiple jsons in 1 line)
-            size = len(line)
-            index = 0
-            while index < size:
-                raw_event, offset = decoder.raw_decode(line, index)
-                raw_event = self.check_cwe_and_strip_header(raw_event)
-                if delimiter and (delimiter in raw_event):
+            for raw_event, source in utils.json_loads_values(line, with_source=True):
+                event = self.check_cwe_and_strip_header(raw_event)
+                if is_count_mode:
+                    if delimiter and (delimiter in event):
+                        count += len(event[delimiter])
+                    elif not delimiter:
+                        count += 1
+                    continue
+                if delimiter and (delimiter in event):
                     # multiple evets in 1 json
-                    for record in raw_event[delimiter]:
+                    records = event[delimiter]
+                    sources = None
+                    if start < count + len(records) and count < end:
+                        sources = self.get_record_sources(source, delimiter, records)
+                    for i, record in enumerate(records):
                         count += 1
-                        if "count" not in mode:
-                            if start <= count <= end:
-                                yield record
+                        if start < count <= end:
+                            if sources:
+                                record = utils.JsonRecord(record, sources[i])
+                            yield record
                 elif not delimiter:
                     count += 1
-                    if "count" not in mode:
-                        if start <= count <= end:
-                            yield raw_event
-                search = json.decoder.WHITESPACE.search(line, offset)
-                if search is None:
-                    break
-                index = search.end()
-            if "count" in mode:
+                    if not start < count <= end:
+                        continue
+                    if isinstance(event, dict):
+                        if event is not raw_event:
+                            # CloudWatch Events の detail
+                            source = utils.json_member_source(source, "detail", event)
+                        if source:
+                            event = utils.JsonRecord(event, source)
+                    yield event
+            if is_count_mode:
                 yield count
 
+    def get_record_sources(self, source, delimiter, records):
+        """return the source texts of records in the delimiter array."""
+        if not all(isinstance(record, dict) for record in records):
+            return None
+        return utils.json_array_element_sources(source, delimiter, records)
+
     def match_multiline_firstline(self, line):
         if self.re_multiline_firstline.match(line):
             return True
         else:
             return False
 
-    def count_multiline_log(self):
-        count = 0
-        for line in self.rawdata:
+    @cached_property
+    def multiline_firstlines(self):
+        """line number of the first line of each multiline log"""
+        multiline_firstlines = array("Q")
+        for line_number, line in enumerate(self.iter_lines()):
             if self.match_multiline_firstline(line):
-                count += 1
-        return count
+                multiline_firstlines.append(line_number)
+        return multiline_firstlines
+
+    def count_multiline_log(self):
+        return len(self.multiline_firstlines)
 
     def extract_multiline_log(self, start=0, end=0):
-        count = 0
+        """yield multiline logs. start < log number <= end."""
+        if start >= len(self.multiline_firstlines):
+            return
+        first_line = self.multiline_firstlines[start]
+        count = start
         multilog = []
-        is_in_scope = False
-        for line in self.rawdata:
+        for line in self.iter_lines(first_line):
             if self.match_multiline_firstline(line):
                 count += 1
-                if start < count <= end:
-                    if len(multilog) > 0:
-                        # yield previous log
-                        yield "".join(multilog).rstrip()
-                    multilog = []
-                    is_in_scope = True
-                    multilog.append(line)
-                else:
-                    continue
-            elif is_in_scope:
-                multilog.append(line)
-        if is_in_scope:
+                if count > end:
+                    break
+                if len(multilog) > 0:
+                    # yield previous log
+                    yield "".join(multilog).rstrip()
+                multilog = []
+            multilog.append(line)
+        if len(multilog) > 0:
             # yield last log
             yield "".join(multilog).rstrip()
 
@@ -377,6 +544,64 @@ class LogS3:
             splite_logs_list.append((start, end))
         return splite_logs_list
 
+    def make_checkpoint(self, start, end):
+        """make checkpoint for the split log of start <= log number <= end.
+
+        Checkpoint has the decompressed offsets of the first line including
+        the split log and the line after the last log, the number of logs
+        before the first line, and the compressed/decompressed offsets of the
+        gzip member including the first line. The worker downloads the object
+        from the member with a ranged GetObject, decompresses only up to
+        end_offset and doesn't count the logs from the beginning.
+        Returns None if the log can't be resumed in the middle, such as zip or
+        logs via CloudWatch Logs.
+        """
+        if self.via_cwl or self.mime_type not in ("gzip", "bzip2", "text"):
+            return None
+        line_count = len(self.line_offsets) - 1
+        if self.file_format in ("text", "csv") or self.via_firelens:
+            first_line = start - 1
+            count = start - 1
+            end_line = min(end, line_count)
+        elif "json" in self.file_format and self.json_counts_before_line:
+            counts = self.json_counts_before_line
+            first_line = bisect.bisect_right(counts, start - 1) - 1
+            count = counts[first_line]
+            end_line = bisect.bisect_left(counts, end)
+        elif self.file_format in ("multiline",):
+            firstlines = self.multiline_firstlines
+            first_line = firstlines[start - 1]
+            count = start - 1
+            if end < len(firstlines):
+                end_line = firstlines[end]
+            else:
+                end_line = line_count
+        else:
+            return None
+        offset = self.line_offsets[first_line]
+        if self.compressed_members:
+            member_index = (
+                bisect.bisect_right(
+                    [member[1] for member in self.compressed_members], offset
+                )
+                - 1
+            )
+            member_offset, member_base = self.compressed_members[member_index]
+        else:
+            # not compressed
+            member_offset, member_base = offset, offset
+        checkpoint = {
+            "offset": offset,
+            "end_offset": self.line_offsets[end_line],
+            "count": count,
+            "member_offset": member_offset,
+            "member_base": member_base,
+            "mime_type": self.mime_type,
+        }
+        if "csv" in self.file_format:
+            checkpoint["csv_header"] = self.csv_header
+        return checkpoint
+
     def send_meta_to_sqs(self, metadata):
         logger.debug(
             {
@@ -395,6 +620,9 @@ class LogS3:
                     "object": {"key": self.s3key},
                 },
             }
+            checkpoint = self.make_checkpoint(start, end)
+            if checkpoint:
+                queue_body["siem"]["checkpoint"] = checkpoint
             message_body = json.dumps(queue_body)
             entries.append({"Id": f"num_{start}", "MessageBody": message_body})
             if (len(entries) == 10) or (i == last_num - 1):
@@ -415,13 +643,22 @@ class LogParser:
     """
 
     def __init__(
-        self, logfile, logconfig, sf_module, geodb_instance, exclude_log_patterns
+        self,
+        logfile,
+        logconfig,
+        sf_module,
+        geodb_instance,
+        exclude_log_patterns,
+        record_sample_rate=0.0,
     ):
         self.logfile = logfile
         self.logconfig = logconfig
         self.sf_module = sf_module
         self.geodb_instance = geodb_instance
         self.exclude_log_patterns = exclude_log_patterns
+        # ratio of logs whose stage durations are logged one by one
+        self.record_sample_rate = record_sample_rate
+        self.stage_timer = logfile.stage_timer
 
         self.logtype = logfile.logtype
         self.s3key = logfile.s3key
@@ -440,15 +677,25 @@ class LogParser:
         if self.logconfig["index_tz"]:
             self.index_tz = timezone(timedelta(hours=float(self.logconfig["index_tz"])))
         self.has_nanotime = self.logconfig["timestamp_nano"]
+        # ip addresses parsed in transform_to_ecs are reused by enrich
+        self.__parsed_ips = {}
+        self.__is_ignored = None
 
     def __call__(self, logdata):
+        start = time.perf_counter()
         self.logdata = logdata
+        self.__is_ignored = None
+        if self.is_excluded_by_raw_patterns(logdata):
+            self.stage_timer.add("parse", time.perf_counter() - start)
+            return
         self.__logdata_dict = self.logdata_to_dict(logdata)
         if self.is_ignored:
+            self.stage_timer.add("parse", time.perf_counter() - start)
             return
         self.__event_ingested = datetime.now(timezone.utc)
         self.__skip_normalization = self.set_skip_normalization()
         self.__timestamp = self.get_timestamp()
+        parsed = time.perf_counter()
 
         # idなどの共通的なフィールドを追加する
         self.add_basic_field()
@@ -458,32 +705,106 @@ class LogParser:
         self.clean_multi_type_field()
         # フィールドをECSにマッピングして正規化する
         self.transform_to_ecs()
+        mapped = time.perf_counter()
         # 一部のフィールドを修正する
         self.transform_by_script()
+        scripted = time.perf_counter()
         # ログにgeoipなどの情報をエンリッチ
         self.enrich()
+        enriched = time.perf_counter()
+        # ECS のフィールドや sf_ スクリプトが追加したフィールドも除外の対象
+        # exclude_log_patterns can match fields of ECS and sf_ scripts too
+        self.__is_ignored = self.is_excluded()
+
+        durations = (
+            ("parse", parsed - start + time.perf_counter() - enriched),
+            ("ecs", mapped - parsed),
+            ("script", scripted - mapped),
+            ("geoip", enriched - scripted),
+        )
+        for stage, seconds in durations:
+            self.stage_timer.add(stage, seconds)
+        if self.record_sample_rate and random.random() < self.record_sample_rate:
+            logger.info(
+                {
+                    "record_stage_durations_ms": {
+                        stage: round(seconds * 1000, 3) for stage, seconds in durations
+                    },
+                    # doc_id would pop __doc_id_suffix set by sf_ script
+                    "doc_id": self.__logdata_dict.get("@id"),
+                }
+            )
 
     ###########################################################################
     # Property
     ###########################################################################
     @property
     def is_ignored(self):
+        # 1つのログにつき1回だけ判定する
+        if self.__is_ignored is None:
+            self.__is_ignored = self.check_ignored()
+        return self.__is_ignored
+
+    def check_ignored(self):
         if self.__logdata_dict.get("is_ignored"):
             self.ignored_reason = self.__logdata_dict.get("ignored_reason")
             return True
-        if self.logtype in self.exclude_log_patterns:
+        raw = None
+        if self.logformat in ("text", "csv", "multiline") and not self.via_firelens:
+            # text のログの値は全て元のログの一部
+            raw = self.logdata
+        return self.is_excluded(raw)
+
+    def is_excluded(self, raw=None):
+        """match the log with exclude_log_patterns.
+
+        raw is the text log which every value of the log is a part of. It is
+        given only before the log is transformed.
+        """
+        if self.logtype not in self.exclude_log_patterns:
+            return False
+        log_patterns = self.exclude_log_patterns[self.logtype]
+        if isinstance(log_patterns, utils.LogExcluder):
+            is_excluded, ex_pattern = log_patterns.match(self.__logdata_dict, raw)
+        else:
             is_excluded, ex_pattern = utils.match_log_with_exclude_patterns(
-                self.__logdata_dict, self.exclude_log_patterns[self.logtype]
+                self.__logdata_dict, log_patterns
             )
-            if is_excluded:
-                self.ignored_reason = f"matched {ex_pattern} with exclude_log_patterns"
-                return True
-        return False
+        if is_excluded:
+            self.ignored_reason = f"matched {ex_pattern} with exclude_log_patterns"
+        return is_excluded
+
+    def is_excluded_by_raw_patterns(self, logdata):
+        """match raw log with raw patterns before it is parsed."""
+        if self.via_firelens or self.logtype not in self.exclude_log_patterns:
+            return False
+        log_patterns = self.exclude_log_patterns[self.logtype]
+        if not isinstance(log_patterns, utils.LogExcluder):
+            return False
+        if not log_patterns.raw_patterns:
+            return False
+        raw = getattr(logdata, "source", None) or logdata
+        if not isinstance(raw, str):
+            return False
+        is_excluded, ex_pattern = log_patterns.match_raw(raw)
+        if is_excluded:
+            self.__logdata_dict = {}
+            self.__is_ignored = True
+            self.ignored_reason = f"matched {ex_pattern} with exclude_log_patterns"
+        return is_excluded
 
     @property
     def timestamp(self):
         return self.__timestamp
 
+    @property
+    def ecs_plan(self):
+        # create_logconfig で作成済み。なければ作成する
+        ecs_plan = self.logconfig.get("ecs_plan")
+        if ecs_plan is None:
+            ecs_plan = utils.compile_ecs_plan(self.logconfig)
+        return ecs_plan
+
     @property
     def event_ingested(self):
         return self.__event_ingested
@@ -517,27 +838,17 @@ class LogParser:
             index_dt = self.event_ingested
         else:
             index_dt = self.timestamp
-        if self.logconfig["index_tz"]:
-            index_dt = index_dt.astimezone(self.index_tz)
-        if "daily" in self.logconfig["index_rotation"]:
-            return indexname + index_dt.strftime("-%Y-%m-%d")
-        elif "weekly" in self.logconfig["index_rotation"]:
-            return indexname + index_dt.strftime("-%Y-w%W")
-        elif "monthly" in self.logconfig["index_rotation"]:
-            return indexname + index_dt.strftime("-%Y-%m")
-        else:
-            return indexname + index_dt.strftime("-%Y")
+        resolver = utils.get_index_name_resolver(
+            self.logconfig["index_rotation"],
+            self.index_tz if self.logconfig["index_tz"] else None,
+        )
+        return resolver.resolve(indexname, index_dt)
 
     @property
     def json(self):
-        # 内部で管理用のフィールドを削除
-        self.__logdata_dict = self.del_none(self.__logdata_dict)
-        loaded_data = json.dumps(self.__logdata_dict)
-        # サイズが Lucene の最大値である 32766 Byte を超えてるかチェック
-        if len(loaded_data) >= 65536:
-            self.__logdata_dict = self.truncate_big_field(self.__logdata_dict)
-            loaded_data = json.dumps(self.__logdata_dict)
-        return loaded_data
+        # 値のないキーの削除と大きいフィールドの切り詰めをしてから変換
+        self.__logdata_dict = self.finalize_dict(self.__logdata_dict)
+        return utils.json_dumps(self.__logdata_dict)
 
     ###########################################################################
     # Method/Function - Main
@@ -565,72 +876,79 @@ class LogParser:
         return logdata_dict
 
     def add_basic_field(self):
-        basic_dict = {}
         if self.logformat in "json":
-            basic_dict["@message"] = str(json.dumps(self.logdata))
+            # json のログは元のテキストをそのまま使い、なければ文字列化する
+            source = getattr(self.logdata, "source", None)
+            if source:
+                message = source
+            else:
+                message = str(json.dumps(self.logdata))
         else:
-            basic_dict["@message"] = str(self.logdata)
-        basic_dict["event"] = {"module": self.logtype}
-        basic_dict["@timestamp"] = self.timestamp.isoformat()
-        basic_dict["event"]["ingested"] = self.event_ingested.isoformat()
-        basic_dict["@log_type"] = self.logtype
+            message = str(self.logdata)
         if self.__skip_normalization:
-            unique_text = "{0}{1}".format(basic_dict["@message"], self.s3key)
-            basic_dict["@id"] = hashlib.md5(unique_text.encode("utf-8")).hexdigest()
+            unique_text = "{0}{1}".format(message, self.s3key)
+            doc_id = hashlib.md5(unique_text.encode("utf-8")).hexdigest()
         elif self.logconfig["doc_id"]:
-            basic_dict["@id"] = self.__logdata_dict[self.logconfig["doc_id"]]
+            doc_id = self.__logdata_dict[self.logconfig["doc_id"]]
         else:
-            basic_dict["@id"] = hashlib.md5(
-                str(basic_dict["@message"]).encode("utf-8")
-            ).hexdigest()
+            doc_id = hashlib.md5(str(message).encode("utf-8")).hexdigest()
+        # 元のログに直接書き込む
+        logdata_dict = self.__logdata_dict
+        logdata_dict["@message"] = message
+        utils.merge_value_into_nesteddict(
+            logdata_dict, ("event", "module"), self.logtype
+        )
+        logdata_dict["@timestamp"] = self.timestamp.isoformat()
+        logdata_dict["event"]["ingested"] = self.event_ingested.isoformat()
+        logdata_dict["@log_type"] = self.logtype
+        logdata_dict["@id"] = doc_id
         if self.loggroup:
-            basic_dict["@log_group"] = self.loggroup
-            basic_dict["@log_stream"] = self.logstream
-        basic_dict["@log_s3bucket"] = self.s3bucket
-        basic_dict["@log_s3key"] = self.s3key
-        self.__logdata_dict = utils.merge_dicts(self.__logdata_dict, basic_dict)
+            logdata_dict["@log_group"] = self.loggroup
+            logdata_dict["@log_stream"] = self.logstream
+        logdata_dict["@log_s3bucket"] = self.s3bucket
+        logdata_dict["@log_s3key"] = self.s3key
 
     def clean_multi_type_field(self):
-        clean_multi_type_dict = {}
-        multifield_keys = self.logconfig["json_to_text"].split()
-        for multifield_key in multifield_keys:
-            v = utils.value_from_nesteddict_by_dottedkey(
-                self.__logdata_dict, multifield_key
-            )
+        # 全ての値を取得してから書き込む
+        texts = []
+        for original_keys, multifield_keys in self.ecs_plan["json_to_text"]:
+            v = utils.value_from_nesteddict_by_keys(self.__logdata_dict, original_keys)
             if v:
                 # json obj in json obj
                 if isinstance(v, int):
-                    new_dict = utils.put_value_into_nesteddict(multifield_key, v)
+                    pass
                 elif "{" in v:
-                    new_dict = utils.put_value_into_nesteddict(multifield_key, repr(v))
+                    v = repr(v)
                 else:
-                    new_dict = utils.put_value_into_nesteddict(multifield_key, str(v))
-                clean_multi_type_dict = utils.merge_dicts(
-                    clean_multi_type_dict, new_dict
-                )
-        self.__logdata_dict = utils.merge_dicts(
-            self.__logdata_dict, clean_multi_type_dict
-        )
+                    v = str(v)
+                texts.append((multifield_keys, utils.convert_value_for_nesteddict(v)))
+        for multifield_keys, v in texts:
+            utils.merge_value_into_nesteddict(self.__logdata_dict, multifield_keys, v)
 
     def transform_to_ecs(self):
         ecs_dict = {"ecs": {"version": self.logconfig["ecs_version"]}}
+        self.__parsed_ips = parsed_ips = {}
         if self.logconfig["cloud_provider"]:
             ecs_dict["cloud"] = {"provider": self.logconfig["cloud_provider"]}
-        ecs_keys = self.logconfig["ecs"].split()
-        for ecs_key in ecs_keys:
-            original_keys = self.logconfig[ecs_key]
-            v = utils.value_from_nesteddict_by_dottedkeylist(
-                self.__logdata_dict, original_keys
+        for ecs_keys, original_keys_list, is_ip in self.ecs_plan["ecs"]:
+            for original_keys in original_keys_list:
+                v = utils.value_from_nesteddict_by_keys(
+                    self.__logdata_dict, original_keys
+                )
+                if v:
+                    break
+            else:
+                continue
+            if is_ip:
+                # IPアドレスの場合は、validation
+                parsed_ip = utils.parse_ip(v)
+                if parsed_ip is None:
+                    continue
+                parsed_ips[v] = parsed_ip
+            utils.merge_value_into_nesteddict(
+                ecs_dict, ecs_keys, utils.convert_value_for_nesteddict(v)
             )
-            if v:
-                new_ecs_dict = utils.put_value_into_nesteddict(ecs_key, v)
-                if ".ip" in ecs_key:
-                    # IPアドレスの場合は、validation
-                    try:
-                        ipaddress.ip_address(v)
-                    except ValueError:
-                        continue
-                ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
+
         if "cloud" in ecs_dict:
             # Set AWS Account ID
             if "account" in ecs_dict["cloud"] and "id" in ecs_dict["cloud"]["account"]:
@@ -664,13 +982,8 @@ class LogParser:
                 "name": self.__logdata_dict["container_name"],
             }
 
-        static_ecs_keys = self.logconfig["static_ecs"]
-        if static_ecs_keys:
-            for static_ecs_key in static_ecs_keys.split():
-                new_ecs_dict = utils.put_value_into_nesteddict(
-                    static_ecs_key, self.logconfig[static_ecs_key]
-                )
-                ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
+        for static_ecs_keys, value in self.ecs_plan["static_ecs"]:
+            utils.merge_value_into_nesteddict(ecs_dict, static_ecs_keys, value)
         self.__logdata_dict = utils.merge_dicts(self.__logdata_dict, ecs_dict)
 
     def transform_by_script(self):
@@ -678,28 +991,30 @@ class LogParser:
             self.__logdata_dict = self.sf_module.transform(self.__logdata_dict)
 
     def enrich(self):
-        enrich_dict = {}
         # geoip
-        geoip_list = self.logconfig["geoip"].split()
-        for geoip_ecs in geoip_list:
+        for geoip_ecs in self.ecs_plan["geoip"]:
             try:
                 ipaddr = self.__logdata_dict[geoip_ecs]["ip"]
             except KeyError:
                 continue
-            geoip, asn = self.geodb_instance.check_ipaddress(ipaddr)
+            parsed_ip = None
+            if isinstance(ipaddr, str):
+                parsed_ip = self.__parsed_ips.get(ipaddr)
+            geoip, asn = self.geodb_instance.check_ipaddress(ipaddr, parsed_ip)
             if geoip:
-                enrich_dict[geoip_ecs] = {"geo": geoip}
-            if geoip and asn:
-                enrich_dict[geoip_ecs].update({"as": asn})
-            elif asn:
-                enrich_dict[geoip_ecs] = {"as": asn}
-        self.__logdata_dict = utils.merge_dicts(self.__logdata_dict, enrich_dict)
+                utils.merge_value_into_nesteddict(
+                    self.__logdata_dict, (geoip_ecs, "geo"), geoip
+                )
+            if asn:
+                utils.merge_value_into_nesteddict(
+                    self.__logdata_dict, (geoip_ecs, "as"), asn
+                )
 
     ###########################################################################
     # Method/Function - Support
     ###########################################################################
     def get_log_and_meta_from_firelens(self):
-        obj = json.loads(self.logdata)
+        obj = utils.json_loads(self.logdata)
         firelens_meta_dict = {}
         # basic firelens field
         firelens_meta_dict["container_id"] = obj.get("container_id")
@@ -728,7 +1043,7 @@ class LogParser:
                 return (firelens_meta_dict, False)
         if self.logformat in "json":
             try:
-                logdata = json.loads(logdata)
+                logdata = utils.json_loads(logdata)
             except json.JSONDecodeError:
                 error_message = "Invalid file format found during parsing"
                 d = {"__skip_normalization": True, "error": {"message": error_message}}
@@ -783,35 +1098,35 @@ class LogParser:
             dt = datetime.now(timezone.utc)
         return dt
 
-    def del_none(self, d):
-        """値のないキーを削除する。削除しないとESへのLoad時にエラーとなる"""
+    def finalize_dict(self, d):
+        """値のないキーを削除し、大きすぎるフィールドを切り詰める
+
+        値のないキーは削除しないとESへのLoad時にエラーとなる。
+        field size が Lucene の最大値である 32766 Byte を UTF-8 で超えてれば
+        切り捨て。1回の走査で両方を処理する
+        """
         for key, value in list(d.items()):
-            if isinstance(value, dict):
-                self.del_none(value)
-            if isinstance(value, dict) and len(value) == 0:
+            if isinstance(value, str):
+                if value in ("", "-", "null", "[]"):
+                    del d[key]
+                elif len(value) > 8191 and key != "@message":
+                    # 8191 文字以下なら UTF-8 でも 32766 Byte 未満
+                    encoded = value.encode("utf-8", "surrogatepass")
+                    if len(encoded) >= 32766:
+                        d[key] = (
+                            encoded[:32753].decode("utf-8", "ignore") + "<<TRUNCATED>>"
+                        )
+                        logger.warning(
+                            f"Data was trauncated because the size of {key} field "
+                            f"is bigger than 32,766 bytes. @id is "
+                            f"{self.__logdata_dict.get('@id')}"
+                        )
+            elif value is None:
                 del d[key]
+            elif isinstance(value, dict):
+                self.finalize_dict(value)
+                if len(value) == 0:
+                    del d[key]
             elif isinstance(value, list) and len(value) == 0:
                 del d[key]
-            elif isinstance(value, str) and (value in ("", "-", "null", "[]")):
-                del d[key]
-            elif isinstance(value, type(None)):
-                del d[key]
-        return d
-
-    def truncate_big_field(self, d):
-        """truncate big field if size is bigger than 32,766 byte
-
-        field size が Lucene の最大値である 32766 Byte を超えてるかチェック
-        超えてれば切り捨て。このサイズは lucene の制限値
-        """
-        for key, value in list(d.items()):
-            if isinstance(value, dict):
-                self.truncate_big_field(value)
-            elif isinstance(value, str) and (len(value) >= 32766):
-                if key not in ("@message",):
-                    d[key] = d[key][:32753] + "<<TRUNCATED>>"
-                    logger.warning(
-                        f"Data was trauncated because the size of {key} field "
-                        f"is bigger than 32,766. _id is {self.doc_id}"
-                    )
         return d
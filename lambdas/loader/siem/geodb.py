@@ -4,45 +4,207 @@
 import configparser
 import datetime
 import os
-import re
-from functools import lru_cache
+import threading
+import time
 
 import boto3
 import geoip2.database
+from botocore.exceptions import ClientError
+from geoip2.errors import AddressNotFoundError
 from aws_lambda_powertools import Logger
 
+from siem import utils
+
 __version__ = "2.3.2"
 
 logger = Logger(child=True)
 
+MAX_PREFIXLEN = {4: 32, 6: 128}
+
+
+def copy_nesteddict(value):
+    """return a copy of nested dicts. values other than dict are shared."""
+    if not isinstance(value, dict):
+        return value
+    return {key: copy_nesteddict(child) for key, child in value.items()}
+
+
+class NetworkCache:
+    """Cache of geoip results keyed by network.
+
+    MaxMind returns the network which an ip address belongs to. Any ip
+    address in the networks which were already resolved is answered without
+    traversing mmdb. Networks in mmdb do not overlap, so the first matched
+    network is the answer. The oldest network is evicted when the number of
+    networks reaches maxsize. It is shared by records processed concurrently,
+    so the cache is guarded by a lock and cached values must not be modified.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        # number of cached networks per prefix length
+        self._prefixlens = {4: {}, 6: {}}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, parsed_ip):
+        """return (True, value) if ip is in cached networks.
+
+        parsed_ip is (version, int) which utils.parse_ip returns.
+        """
+        version, ip_int = parsed_ip
+        max_prefixlen = MAX_PREFIXLEN[version]
+        with self._lock:
+            for prefixlen in self._prefixlens[version]:
+                key = (version, prefixlen, ip_int >> (max_prefixlen - prefixlen))
+                if key in self._cache:
+                    self.hits += 1
+                    return True, self._cache[key]
+            self.misses += 1
+        return False, None
+
+    def put(self, parsed_ip, prefixlen, value):
+        version, ip_int = parsed_ip
+        key = (version, prefixlen, ip_int >> (MAX_PREFIXLEN[version] - prefixlen))
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = value
+                return
+            if len(self._cache) >= self.maxsize:
+                self._evict()
+            self._cache[key] = value
+            prefixlens = self._prefixlens[version]
+            prefixlens[prefixlen] = prefixlens.get(prefixlen, 0) + 1
+
+    def _evict(self):
+        version, prefixlen, _ = key = next(iter(self._cache))
+        del self._cache[key]
+        prefixlens = self._prefixlens[version]
+        prefixlens[prefixlen] -= 1
+        if prefixlens[prefixlen] == 0:
+            del prefixlens[prefixlen]
+
+    def reset_lock(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._prefixlens = {4: {}, 6: {}}
+
 
 class GeoDB:
+    """GeoIP database.
+
+    GeoLite2 databases are downloaded from S3 and opened when they are used
+    for the first time, so that log types without geoip do not wait for
+    them. A database is downloaded again only when its ETag in S3 differs
+    from the one of the local file.
+    """
+
     S3KEY_PREFIX = "GeoLite2/"
     GEOIP_DBS = {"city": "GeoLite2-City.mmdb", "asn": "GeoLite2-ASN.mmdb"}
-    DB_FILE_FRESH_DURATION = 864000  # 10 days
+    LOCAL_DIR = "/tmp/"
     NOT_FILE_FRESH_DURATION = 86400  # 24 hours
-    RE_DIGIT = re.compile(r"\d")
-
-    def __init__(self):
-        GEOIP_BUCKET = self._get_geoip_buckent_name()
-        has_city_db, has_asn_db = False, False
-        if GEOIP_BUCKET:
-            has_city_db = self._download_geoip_database(
-                GEOIP_BUCKET, self.GEOIP_DBS["city"]
-            )
-            has_asn_db = self._download_geoip_database(
-                GEOIP_BUCKET, self.GEOIP_DBS["asn"]
-            )
-        self._reader_city, self._reader_asn = None, None
-        if has_city_db:
-            self._reader_city = geoip2.database.Reader("/tmp/" + self.GEOIP_DBS["city"])
-        if has_asn_db:
-            self._reader_asn = geoip2.database.Reader("/tmp/" + self.GEOIP_DBS["asn"])
-
-    def check_ipaddress(self, ip: str):
-        if (ip is None) or (not self.RE_DIGIT.search(ip)):
+    S3_NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+    CACHE_MAXSIZE = 200000  # networks per mmdb
+
+    def __init__(self, s3_client=None):
+        self._cache_city = NetworkCache(self.CACHE_MAXSIZE)
+        self._cache_asn = NetworkCache(self.CACHE_MAXSIZE)
+        self._s3_client = s3_client
+        self._geoip_bucket = self._get_geoip_buckent_name()
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _reader_city(self):
+        return self._get_reader("city")
+
+    @_reader_city.setter
+    def _reader_city(self, reader):
+        self._readers["city"] = reader
+
+    @property
+    def _reader_asn(self):
+        return self._get_reader("asn")
+
+    @_reader_asn.setter
+    def _reader_asn(self, reader):
+        self._readers["asn"] = reader
+
+    def _get_reader(self, name):
+        try:
+            return self._readers[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._readers:
+                self._readers[name] = self._open_reader(self.GEOIP_DBS[name])
+        return self._readers[name]
+
+    def open_databases(self):
+        """open all databases now instead of when they are used."""
+        for name in self.GEOIP_DBS:
+            self._get_reader(name)
+
+    def reopen_after_fork(self):
+        """reset locks and reopen databases in a forked worker process.
+
+        Locks may have been held by threads of the parent, which do not
+        exist in the worker. Databases which the parent has already opened
+        are opened again from the local files without downloading them.
+        """
+        self._lock = threading.Lock()
+        self._cache_city.reset_lock()
+        self._cache_asn.reset_lock()
+        for name, reader in self._readers.items():
+            if reader:
+                self._readers[name] = geoip2.database.Reader(
+                    self.LOCAL_DIR + self.GEOIP_DBS[name]
+                )
+
+    def _open_reader(self, geodb_name):
+        if not self._geoip_bucket:
+            return None
+        start_time = time.perf_counter()
+        if not self._download_geoip_database(self._geoip_bucket, geodb_name):
+            return None
+        reader = geoip2.database.Reader(self.LOCAL_DIR + geodb_name)
+        duration = int((time.perf_counter() - start_time) * 1000)
+        logger.info(f"{geodb_name} was loaded in {duration} ms")
+        return reader
+
+    def check_ipaddress(self, ip: str, parsed_ip=None):
+        """return geo and asn of ip.
+
+        parsed_ip is the result of utils.parse_ip(ip) when the caller has
+        already parsed ip. private and reserved addresses are not looked up.
+        geo and asn are copies of the cached dicts, so the caller can modify
+        them, e.g. LogParser.finalize_dict deletes keys without value.
+        """
+        if parsed_ip is None:
+            parsed_ip = utils.parse_ip(ip)
+            if parsed_ip is None:
+                return None, None
+        if utils.is_reserved_ip(parsed_ip):
             return None, None
-        return self._get_geo_city(ip), self._get_geo_asn(ip)
+        return (
+            copy_nesteddict(self._get_geo_city(ip, parsed_ip)),
+            copy_nesteddict(self._get_geo_asn(ip, parsed_ip)),
+        )
+
+    def cache_info(self):
+        """return hits, misses and number of networks of geoip caches."""
+        return {
+            name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache)}
+            for name, cache in (("city", self._cache_city), ("asn", self._cache_asn))
+        }
 
     def _get_geoip_buckent_name(self):
         if "GEOIP_BUCKET" in os.environ:
@@ -73,41 +235,62 @@ class GeoDB:
             return False
 
     def _download_geoip_database(self, geoipbucket: str, geodb_name: str) -> bool:
-        localfile = "/tmp/" + geodb_name
-        localfile_not_found = "/tmp/not_found_" + geodb_name
+        localfile = self.LOCAL_DIR + geodb_name
+        localfile_etag = self.LOCAL_DIR + geodb_name + ".etag"
+        localfile_not_found = self.LOCAL_DIR + "not_found_" + geodb_name
         if os.path.isfile(localfile_not_found):
             del_success = self._delete_file_older_than_seconds(
                 localfile_not_found, self.NOT_FILE_FRESH_DURATION
             )
             if not del_success:
                 return False
-        elif os.path.isfile(localfile):
-            del_success = self._delete_file_older_than_seconds(
-                localfile, self.DB_FILE_FRESH_DURATION
-            )
-            if not del_success:
-                return True
 
-        if not os.path.isfile(localfile):
-            s3geo = boto3.resource("s3")
-            bucket = s3geo.Bucket(geoipbucket)
-            s3obj = self.S3KEY_PREFIX + geodb_name
-            try:
-                bucket.download_file(s3obj, localfile)
-                logger.info(f"downloading {geodb_name} was success")
-                return True
-            except Exception:
+        if self._s3_client is None:
+            self._s3_client = boto3.client("s3")
+        s3obj = self.S3KEY_PREFIX + geodb_name
+        try:
+            etag = self._s3_client.head_object(Bucket=geoipbucket, Key=s3obj)["ETag"]
+            if os.path.isfile(localfile) and os.path.isfile(localfile_etag):
+                with open(localfile_etag) as f:
+                    if f.read() == etag:
+                        logger.info(f"{geodb_name} is not changed in s3")
+                        return True
+            self._s3_client.download_file(geoipbucket, s3obj, localfile)
+        except Exception as e:
+            if (
+                isinstance(e, ClientError)
+                and e.response.get("Error", {}).get("Code") in self.S3_NOT_FOUND_CODES
+            ):
                 logger.warning(geodb_name + " is not found in s3")
                 with open(localfile_not_found, "w") as f:
                     f.write("")
                 return False
+            # throttling, network errors and so on are transient, so they
+            # don't mark the database as not found
+            if os.path.isfile(localfile) and os.path.isfile(localfile_etag):
+                logger.warning(
+                    f"failed to check {geodb_name} in s3, local one is used: {e}"
+                )
+                return True
+            logger.warning(f"failed to download {geodb_name} from s3: {e}")
+            return False
+        with open(localfile_etag, "w") as f:
+            f.write(etag)
+        logger.info(f"downloading {geodb_name} was success")
+        return True
 
-    @lru_cache(maxsize=1000000)
-    def _get_geo_city(self, ip):
+    def _get_geo_city(self, ip, parsed_ip):
         if not self._reader_city:
             return None
+        found, geo = self._cache_city.get(parsed_ip)
+        if found:
+            return geo
         try:
             response = self._reader_city.city(ip)
+        except AddressNotFoundError:
+            # 見つからなかった IP アドレスはホスト単位でキャッシュする
+            self._cache_city.put(parsed_ip, MAX_PREFIXLEN[parsed_ip[0]], None)
+            return None
         except Exception:
             return None
         country_iso_code = response.country.iso_code
@@ -116,22 +299,31 @@ class GeoDB:
         __lon = response.location.longitude
         __lat = response.location.latitude
         location = {"lon": __lon, "lat": __lat}
-        return {
+        geo = {
             "city_name": city_name,
             "country_iso_code": country_iso_code,
             "country_name": country_name,
             "location": location,
         }
+        self._cache_city.put(parsed_ip, response.traits.network.prefixlen, geo)
+        return geo
 
-    @lru_cache(maxsize=1000000)
-    def _get_geo_asn(self, ip):
+    def _get_geo_asn(self, ip, parsed_ip):
         if not self._reader_asn:
             return None
+        found, asn = self._cache_asn.get(parsed_ip)
+        if found:
+            return asn
         try:
             response = self._reader_asn.asn(ip)
+        except AddressNotFoundError:
+            self._cache_asn.put(parsed_ip, MAX_PREFIXLEN[parsed_ip[0]], None)
+            return None
         except Exception:
             return None
-        return {
+        asn = {
             "number": response.autonomous_system_number,
             "organization": {"name": response.autonomous_system_organization},
         }
+        self._cache_asn.put(parsed_ip, response.network.prefixlen, asn)
+        return asn
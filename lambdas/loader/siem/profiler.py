@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import collections
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from aws_lambda_powertools import Logger
+
+__version__ = "2.3.2"
+
+logger = Logger(child=True)
+
+PROFILE_DIR = "/tmp"
+# number of profiles kept in PROFILE_DIR when they are not written to S3
+MAX_LOCAL_PROFILES = 10
+# seconds between samples of the stack
+SAMPLE_INTERVAL = 0.005
+# number of source lines which allocated the most memory
+TOP_ALLOCATIONS = 50
+# seconds between checks of traced memory
+MEMORY_CHECK_INTERVAL = 0.1
+# a snapshot is taken when traced memory grew by this ratio since the last one
+PEAK_SNAPSHOT_GROWTH = 1.25
+
+
+def collapse_stack(frame, labels):
+    """return the stack of frame as "outermost;...;innermost".
+
+    Each frame is labeled as module:function, qualified with the class on
+    Python 3.11 or later. labels caches the label of code objects.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            module = frame.f_globals.get("__name__", "?")
+            name = getattr(code, "co_qualname", code.co_name)
+            label = labels[code] = f"{module}:{name}"
+        names.append(label)
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """count the collapsed stacks of a thread sampled at interval.
+
+    The stacks are read from another thread with sys._current_frames, so
+    the sampled thread runs without instrumentation. callback is called
+    after each sample in the sampling thread.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, callback=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.callback = callback
+        self.stacks = collections.Counter()
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.stacks[collapse_stack(frame, self._labels)] += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if self.callback:
+                self.callback()
+
+
+class RecordProfiler:
+    """profile the processing of an S3 object in the thread which enters.
+
+    Stacks are sampled by StackSampler and memory allocations are traced by
+    tracemalloc. A snapshot is taken when traced memory grew, so the
+    allocations are reported as of the peak, not after they were freed.
+    On exit, the collapsed stacks, the source lines which held the most
+    memory and a summary are written under
+    profile/<logtype>/<s3 key>/<time>/ in PROFILE_DIR. If the S3 bucket is
+    given, they are uploaded to it and removed from PROFILE_DIR, otherwise
+    only the last MAX_LOCAL_PROFILES profiles are kept so that /tmp of a warm
+    container doesn't fill up. Failure to write doesn't fail the record.
+
+    Parse workers and bulk threads are not sampled. Allocations of other
+    threads are traced too, so records should not run concurrently.
+    """
+
+    def __init__(self, logtype, s3key, s3_client=None, bucket=None):
+        self.logtype = logtype
+        self.s3key = s3key
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.location = None
+
+    def __enter__(self):
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        # reset_peak is new in Python 3.9. Without it, the peak of
+        # get_traced_memory is the record's own only if it was started here,
+        # otherwise the peak of the checked memory is reported.
+        self.exact_peak = self.started_tracemalloc
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+            self.exact_peak = True
+        self.snapshot = tracemalloc.take_snapshot()
+        self.peak_snapshot = None
+        self.peak_snapshot_size = tracemalloc.get_traced_memory()[0]
+        self.checked_peak = self.peak_snapshot_size
+        self.next_memory_check = 0
+        self.sampler = StackSampler(
+            threading.get_ident(), callback=self.watch_memory
+        ).start()
+        self.start_time = time.perf_counter()
+        return self
+
+    def watch_memory(self):
+        now = time.perf_counter()
+        if now < self.next_memory_check:
+            return
+        self.next_memory_check = now + MEMORY_CHECK_INTERVAL
+        current = tracemalloc.get_traced_memory()[0]
+        self.checked_peak = max(self.checked_peak, current)
+        if current > self.peak_snapshot_size * PEAK_SNAPSHOT_GROWTH:
+            self.peak_snapshot = tracemalloc.take_snapshot()
+            self.peak_snapshot_size = current
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start_time
+        self.sampler.stop()
+        current, peak = tracemalloc.get_traced_memory()
+        if not self.exact_peak:
+            peak = max(self.checked_peak, current)
+        if not self.peak_snapshot or current > self.peak_snapshot_size:
+            self.peak_snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        try:
+            self.location = self.write(
+                {
+                    "stacks.txt": self.format_stacks(),
+                    "allocations.txt": self.format_allocations(),
+                    "summary.json": self.format_summary(duration, peak, exc_value),
+                }
+            )
+            logger.info(f"profile of {self.s3key} was written to {self.location}")
+        except Exception:
+            logger.exception(f"failed to write profile of {self.s3key}")
+        return False
+
+    def format_stacks(self):
+        """collapsed stacks, the input format of flamegraph.pl"""
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.sampler.stacks.most_common()
+        )
+
+    def format_allocations(self):
+        """memory held at the peak snapshot compared to the start"""
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        stats = self.peak_snapshot.filter_traces(ignored).compare_to(
+            self.snapshot.filter_traces(ignored), "lineno"
+        )
+        return "".join(f"{stat}\n" for stat in stats[:TOP_ALLOCATIONS])
+
+    def format_summary(self, duration, peak, exc_value):
+        return json.dumps(
+            {
+                "logtype": self.logtype,
+                "s3_key": self.s3key,
+                "duration_ms": int(duration * 1000),
+                "samples": sum(self.sampler.stacks.values()),
+                "sample_interval_ms": self.sampler.interval * 1000,
+                "traced_memory_peak": peak,
+                "error": repr(exc_value) if exc_value else None,
+            },
+            indent=2,
+        )
+
+    def write(self, files):
+        now = datetime.now(timezone.utc)
+        # "." and ".." of s3 key must not leave PROFILE_DIR
+        s3key = "/".join(x for x in self.s3key.split("/") if x not in ("", ".", ".."))
+        prefix = f"profile/{self.logtype}/{s3key}/{now:%Y%m%dT%H%M%S%fZ}"
+        path = os.path.join(PROFILE_DIR, prefix)
+        os.makedirs(path, exist_ok=True)
+        for name, text in files.items():
+            with open(os.path.join(path, name), "w") as f:
+                f.write(text)
+        if not self.bucket:
+            prune_profiles(MAX_LOCAL_PROFILES)
+            return path
+        for name, text in files.items():
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=f"{prefix}/{name}", Body=text.encode("utf-8")
+            )
+        remove_profile(path)
+        return f"s3://{self.bucket}/{prefix}"
+
+
+def remove_profile(path):
+    """remove the profile directory and its parents which became empty"""
+    shutil.rmtree(path, ignore_errors=True)
+    root = os.path.join(PROFILE_DIR, "profile")
+    path = os.path.dirname(path)
+    while os.path.commonpath([path, root]) == root:
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def prune_profiles(keep):
+    """remove all but the newest keep profiles in PROFILE_DIR"""
+    root = os.path.join(PROFILE_DIR, "profile")
+    profiles = [path for path, _, names in os.walk(root) if "summary.json" in names]
+    # the name of the directory is the time when the profile was written
+    profiles.sort(key=os.path.basename)
+    for path in profiles[: max(len(profiles) - keep, 0)]:
+        remove_profile(path)
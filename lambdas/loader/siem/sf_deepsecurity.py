@@ -3,8 +3,7 @@ import base64
 import json
 import ipaddress
 from siem.utils import (
-    merge_dicts,
-    put_value_into_nesteddict,
+    merge_value_into_nesteddict_by_dottedkey,
     value_from_nesteddict_by_dottedkeylist,
 )
 
@@ -68,13 +67,12 @@ def transform(logdata):
         original_keys = deepsecurity_ecs_keys[ecs_key]
         v = value_from_nesteddict_by_dottedkeylist(logdata, original_keys)
         if v:
-            new_ecs_dict = put_value_into_nesteddict(ecs_key, v)
             if ".ip" in ecs_key:
                 try:
                     ipaddress.ip_address(v)
                 except ValueError:
                     continue
-            merge_dicts(logdata, new_ecs_dict)
+            merge_value_into_nesteddict_by_dottedkey(logdata, ecs_key, v)
             del logdata[original_keys]
 
     # source.ipが設定されていなければ、dvcで代用する
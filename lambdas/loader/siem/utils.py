@@ -1,12 +1,26 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import bz2
 import configparser
 import csv
+import gzip
+import hashlib
 import importlib
+import io
+import json
 import os
 import re
+import shutil
+import socket
 import sys
+import tempfile
+import time
+import uuid
+import zipfile
+import zlib
+from bisect import bisect_right
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from functools import lru_cache
 
@@ -16,6 +30,11 @@ from aws_lambda_powertools import Logger
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __version__ = "2.3.2"
 
 logger = Logger(child=True)
@@ -47,7 +66,6 @@ MONTH_TO_INT = {
     "Nov": 11,
     "Dec": 12,
 }
-NOW = datetime.now(timezone.utc)
 TD_OFFSET12 = timedelta(hours=12)
 
 
@@ -128,6 +146,233 @@ def convert_underscore_field_into_dot_notation(prefix, logdata):
     return logdata
 
 
+#############################################################################
+# json
+#############################################################################
+JSON_DECODER = json.JSONDecoder()
+# orjson loads int over 64 bit as float. Text which may have such int is
+# loaded with json module
+RE_LONG_DIGITS = re.compile(r"\d{19}")
+
+
+def json_dumps(obj):
+    """serialize obj to json bytes.
+
+    orjson is used if it is installed. The output is the same json value as
+    the one of json.dumps but it is not byte-identical, so json.dumps should
+    be used when the text itself is stored or hashed.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # int over 64 bit, surrogate and so on
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+def json_loads(text):
+    if orjson and not RE_LONG_DIGITS.search(text):
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            # NaN and so on. json.loads raises if text is invalid
+            pass
+    return json.loads(text)
+
+
+def json_loads_values(text, with_source=False):
+    """return the list of json values concatenated in text.
+
+    Firehose concatenates json objects without delimiter, e.g. {...}{...}.
+    Outside of strings, "}{" appears only between concatenated objects, so
+    text is split there and each piece is loaded with orjson. raw_decode is
+    used when the fast path cannot load text.
+    When with_source is True, return the list of (value, source text).
+    """
+    if orjson and not RE_LONG_DIGITS.search(text):
+        try:
+            value = orjson.loads(text)
+            return [(value, text.strip())] if with_source else [value]
+        except ValueError:
+            pass
+        pieces = text.strip().split("}{")
+        if len(pieces) > 1:
+            last = len(pieces) - 1
+            sources = [
+                ("{" if i else "") + piece + ("}" if i < last else "")
+                for i, piece in enumerate(pieces)
+            ]
+            try:
+                values = [orjson.loads(source) for source in sources]
+            except ValueError:
+                pass
+            else:
+                return list(zip(values, sources)) if with_source else values
+    values = []
+    size = len(text)
+    index = json.decoder.WHITESPACE.match(text, 0).end()
+    while index < size:
+        value, end = JSON_DECODER.raw_decode(text, index)
+        values.append((value, text[index:end]) if with_source else value)
+        index = json.decoder.WHITESPACE.match(text, end).end()
+    return values
+
+
+class JsonRecord(dict):
+    """dict of json record which keeps its source text."""
+
+    __slots__ = ("source",)
+
+    def __init__(self, record, source):
+        super().__init__(record)
+        self.source = source
+
+
+@lru_cache(maxsize=128)
+def _re_json_member(key):
+    return re.compile(r'[{,]\s*"' + re.escape(key) + r'"\s*:\s*(?=[\[{])')
+
+
+def json_member_source(text, key, value):
+    """return the source text of the member key of which value is value.
+
+    text is the source text of json. Members named key are searched from
+    the head of text and the first one which is loaded as value is used.
+    None is returned if it is not found.
+    """
+    for m in _re_json_member(key).finditer(text):
+        start = m.end()
+        try:
+            loaded, end = JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            continue
+        if loaded == value:
+            return text[start:end]
+    return None
+
+
+def json_array_element_sources(text, key, values):
+    """return the source texts of elements of the array member key.
+
+    The elements of the array must be loaded as values. Each element is
+    decoded with raw_decode, which is cheaper than json.dumps of it.
+    None is returned if the array is not found.
+    """
+    skip_whitespace = json.decoder.WHITESPACE.match
+    for m in _re_json_member(key).finditer(text):
+        index = m.end()
+        if text[index] != "[":
+            continue
+        index = skip_whitespace(text, index + 1).end()
+        sources = []
+        for value in values:
+            try:
+                loaded, end = JSON_DECODER.raw_decode(text, index)
+            except ValueError:
+                break
+            if loaded != value:
+                break
+            sources.append(text[index:end])
+            index = skip_whitespace(text, end).end()
+            if text[index : index + 1] == ",":
+                index = skip_whitespace(text, index + 1).end()
+        else:
+            if text[index : index + 1] == "]":
+                return sources
+    return None
+
+
+#############################################################################
+# ip address
+#############################################################################
+# special purpose addresses which are not in GeoIP database.
+# (first address, last address) sorted by first address
+def _create_reserved_ip_ranges(networks, family):
+    ranges = []
+    for network in networks:
+        addr, prefixlen = network.split("/")
+        packed = socket.inet_pton(family, addr)
+        max_prefixlen = len(packed) * 8
+        first = int.from_bytes(packed, "big")
+        last = first | ((1 << (max_prefixlen - int(prefixlen))) - 1)
+        ranges.append((first, last))
+    ranges.sort()
+    return [first for first, _ in ranges], [last for _, last in ranges]
+
+
+RESERVED_IP_RANGES = {
+    4: _create_reserved_ip_ranges(
+        (
+            "0.0.0.0/8",  # this network
+            "10.0.0.0/8",  # private
+            "100.64.0.0/10",  # shared address space (CGNAT)
+            "127.0.0.0/8",  # loopback
+            "169.254.0.0/16",  # link local
+            "172.16.0.0/12",  # private
+            "192.0.0.0/24",  # IETF protocol assignments
+            "192.0.2.0/24",  # documentation
+            "192.168.0.0/16",  # private
+            "198.18.0.0/15",  # benchmarking
+            "198.51.100.0/24",  # documentation
+            "203.0.113.0/24",  # documentation
+            "224.0.0.0/4",  # multicast
+            "240.0.0.0/4",  # reserved and broadcast
+        ),
+        socket.AF_INET,
+    ),
+    6: _create_reserved_ip_ranges(
+        (
+            "::/127",  # unspecified and loopback
+            "100::/64",  # discard only
+            "2001:db8::/32",  # documentation
+            "fc00::/7",  # unique local
+            "fe80::/10",  # link local
+            "ff00::/8",  # multicast
+        ),
+        socket.AF_INET6,
+    ),
+}
+
+
+def parse_ip(ip):
+    """parse ip address string into (version, int).
+
+    return None if ip is not a valid IPv4 or IPv6 address. It is faster than
+    ipaddress.ip_address.
+    >>> parse_ip('192.0.2.1')
+    (4, 3221225985)
+    >>> parse_ip('::1')
+    (6, 1)
+    >>> parse_ip('foo') is None
+    True
+    """
+    if not isinstance(ip, str):
+        return None
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except (OSError, ValueError):
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    except (OSError, ValueError):
+        return None
+
+
+def is_reserved_ip(parsed_ip):
+    """return True if parsed ip is private, loopback, link local and so on.
+
+    >>> is_reserved_ip(parse_ip('10.1.2.3'))
+    True
+    >>> is_reserved_ip(parse_ip('192.0.1.1'))
+    False
+    """
+    version, ip_int = parsed_ip
+    firsts, lasts = RESERVED_IP_RANGES[version]
+    i = bisect_right(firsts, ip_int) - 1
+    return i >= 0 and ip_int <= lasts[i]
+
+
 #############################################################################
 # date time
 #############################################################################
@@ -147,7 +392,6 @@ def get_timestr_from_logdata_dict(logdata_dict, timestamp_key, has_nanotime):
     return timestr
 
 
-@lru_cache(maxsize=100000)
 def convert_timestr_to_datetime(timestr, timestamp_key, timestamp_format, TZ):
     dt = None
     if "epoch" in timestamp_format:
@@ -163,7 +407,6 @@ def convert_timestr_to_datetime(timestr, timestamp_key, timestamp_format, TZ):
     return dt
 
 
-@lru_cache(maxsize=1024)
 def convert_epoch_to_datetime(timestr, TZ):
     epoch = float(timestr)
     if epoch > 1000000000000:
@@ -176,52 +419,39 @@ def convert_epoch_to_datetime(timestr, TZ):
     return dt
 
 
-@lru_cache(maxsize=10000)
-def convert_syslog_to_datetime(timestr, TZ):
-    now = NOW + TD_OFFSET12
+@lru_cache(maxsize=4096)
+def resolve_syslog_year(month, day, hour, minute, TZ, reference_hour):
+    """return the year of syslog timestamp which has no year.
+
+    reference_hour is hours since epoch and the year is resolved against
+    the start of the next hour, so the result can be cached per minute.
+    """
     # timezoneを考慮して、12時間を早めた現在時刻を基準とする
-    m = RE_SYSLOG_FORMAT.match(timestr)
+    now = datetime.fromtimestamp((reference_hour + 1) * 3600, tz=TZ) + TD_OFFSET12
+    year = now.year
     try:
-        # コンマ以下の秒があったら
-        microsec = int(m.group(7).ljust(6, "0"))
-    except AttributeError:
-        microsec = 0
-    try:
-        dt = datetime(
-            year=now.year,
-            month=MONTH_TO_INT[m.group(1)],
-            day=int(m.group(2)),
-            hour=int(m.group(3)),
-            minute=int(m.group(4)),
-            second=int(m.group(5)),
-            microsecond=microsec,
-            tzinfo=TZ,
-        )
+        dt = datetime(year, month, day, hour, minute, tzinfo=TZ)
     except ValueError:
         # うるう年対策
-        last_year = now.year - 1
-        dt = datetime(
-            year=last_year,
-            month=MONTH_TO_INT[m.group(1)],
-            day=int(m.group(2)),
-            hour=int(m.group(3)),
-            minute=int(m.group(4)),
-            second=int(m.group(5)),
-            microsecond=microsec,
-            tzinfo=TZ,
-        )
+        return year - 1
     if dt > now:
         # syslog timestamp が未来。マイナス1年の補正が必要
         # know_issue: 1年以上古いログの補正はできない
-        last_year = now.year - 1
-        dt = dt.replace(year=last_year)
-    else:
-        # syslog timestamp が過去であり適切。処理なし
-        pass
-    return dt
+        return year - 1
+    return year
+
+
+def convert_syslog_to_datetime(timestr, TZ):
+    m = RE_SYSLOG_FORMAT.match(timestr)
+    month = MONTH_TO_INT[m.group(1)]
+    day, hour, minute = int(m.group(2)), int(m.group(3)), int(m.group(4))
+    year = resolve_syslog_year(month, day, hour, minute, TZ, int(time.time() // 3600))
+    # コンマ以下の秒があったら
+    microsec = m.group(7)
+    microsec = int(microsec.ljust(6, "0")) if microsec else 0
+    return datetime(year, month, day, hour, minute, int(m.group(5)), microsec, TZ)
 
 
-@lru_cache(maxsize=1024)
 def convert_iso8601_to_datetime(timestr, TZ, timestamp_key):
     timestr = timestr.replace("+0000", "")
     # Python datetime.fromisoformat can't parser +0000 format.
@@ -239,8 +469,131 @@ def convert_iso8601_to_datetime(timestr, TZ, timestamp_key):
     return dt
 
 
-@lru_cache(maxsize=10000)
+class TimestampLayout:
+    """Fixed layout parser of strptime format.
+
+    Formats whose directives are %Y, %m, %b, %d, %H, %M and %S with
+    optional %f and %z after them, such as %d/%b/%Y:%H:%M:%S %z, are
+    supported. The part before %S is parsed once per minute and cached.
+    parse returns None when timestr doesn't fit the layout, and then
+    strptime should be used.
+    """
+
+    DIRECTIVES = {
+        "Y": r"(\d{4})",
+        "m": r"(\d{2})",
+        "b": r"([A-Z][a-z]{2})",
+        "d": r"(\d{2})",
+        "H": r"(\d{2})",
+        "M": r"(\d{2})",
+        "S": r"(\d{2})",
+        "f": r"(\d{1,6})",
+        "z": r"(Z|[+-]\d{2}:?\d{2})",
+    }
+    WIDTHS = {"Y": 4, "m": 2, "b": 3, "d": 2, "H": 2, "M": 2}
+    RE_DIRECTIVE = re.compile(r"%(.)")
+
+    def __init__(self, timestamp_format, maxsize=4096):
+        self.timestamp_format = timestamp_format
+        self.maxsize = maxsize
+        before_second, sep, after_second = timestamp_format.partition("%S")
+        prefix_fields = self.RE_DIRECTIVE.findall(before_second)
+        suffix_fields = self.RE_DIRECTIVE.findall(after_second)
+        month_field = "b" if "b" in prefix_fields else "m"
+        if (
+            not sep
+            or sorted(prefix_fields) != sorted(["Y", month_field, "d", "H", "M"])
+            or not set(suffix_fields) <= {"f", "z"}
+            or len(suffix_fields) != len(set(suffix_fields))
+        ):
+            raise ValueError(f"{timestamp_format} is not fixed layout")
+        self.prefix_fields = prefix_fields
+        self.re_prefix = re.compile(self._to_regex(before_second), re.ASCII)
+        self.re_suffix = re.compile(self._to_regex("%S" + after_second), re.ASCII)
+        self.prefix_len = len(self.RE_DIRECTIVE.sub("", before_second)) + sum(
+            self.WIDTHS[field] for field in prefix_fields
+        )
+        self.fraction_group = (
+            suffix_fields.index("f") + 2 if "f" in suffix_fields else 0
+        )
+        self.tz_group = suffix_fields.index("z") + 2 if "z" in suffix_fields else 0
+        self.minutes = {}
+
+    def _to_regex(self, timestamp_format):
+        regex = []
+        for i, text in enumerate(self.RE_DIRECTIVE.split(timestamp_format)):
+            regex.append(self.DIRECTIVES[text] if i % 2 else re.escape(text))
+        return "".join(regex)
+
+    def _parse_minute(self, prefix):
+        m = self.re_prefix.fullmatch(prefix)
+        if not m:
+            return None
+        fields = dict(zip(self.prefix_fields, m.groups()))
+        if "b" in fields:
+            month = MONTH_TO_INT.get(fields["b"])
+        else:
+            month = int(fields["m"])
+        minute = (
+            int(fields["Y"]),
+            month,
+            int(fields["d"]),
+            int(fields["H"]),
+            int(fields["M"]),
+        )
+        try:
+            datetime(*minute)
+        except (TypeError, ValueError):
+            return None
+        if len(self.minutes) >= self.maxsize:
+            self.minutes.clear()
+        self.minutes[prefix] = minute
+        return minute
+
+    def parse(self, timestr, TZ):
+        prefix = timestr[: self.prefix_len]
+        minute = self.minutes.get(prefix) or self._parse_minute(prefix)
+        if not minute:
+            return None
+        m = self.re_suffix.fullmatch(timestr, self.prefix_len)
+        if not m:
+            return None
+        microsec = 0
+        if self.fraction_group:
+            microsec = int(m.group(self.fraction_group).ljust(6, "0"))
+        if self.tz_group:
+            TZ = convert_utcoffset_to_timezone(m.group(self.tz_group))
+        try:
+            return datetime(*minute, int(m.group(1)), microsec, TZ)
+        except ValueError:
+            return None
+
+
+@lru_cache(maxsize=1024)
+def convert_utcoffset_to_timezone(utcoffset):
+    if utcoffset == "Z":
+        return timezone.utc
+    sign = -1 if utcoffset[0] == "-" else 1
+    utcoffset = utcoffset[1:].replace(":", "")
+    return timezone(
+        sign * timedelta(hours=int(utcoffset[:2]), minutes=int(utcoffset[2:]))
+    )
+
+
+@lru_cache(maxsize=128)
+def get_timestamp_layout(timestamp_format):
+    try:
+        return TimestampLayout(timestamp_format)
+    except ValueError:
+        # parsed with strptime
+        return None
+
+
 def convert_custom_timeformat_to_datetime(timestr, TZ, timestamp_format, timestamp_key):
+    layout = get_timestamp_layout(timestamp_format)
+    dt = layout.parse(timestr, TZ) if layout else None
+    if dt:
+        return dt
     try:
         dt = datetime.strptime(timestr, timestamp_format)
     except ValueError:
@@ -252,6 +605,61 @@ def convert_custom_timeformat_to_datetime(timestr, TZ, timestamp_format, timesta
     return dt
 
 
+class IndexNameResolver:
+    """Append date suffix of index_rotation to index name.
+
+    The boundaries of the date bucket in index_tz which the last datetime
+    belongs to are kept, and datetime in the same bucket gets the suffix
+    without astimezone and strftime.
+    """
+
+    def __init__(self, index_rotation, index_tz=None):
+        if "daily" in index_rotation:
+            self.rotation, self.suffix_format = "daily", "-%Y-%m-%d"
+        elif "weekly" in index_rotation:
+            self.rotation, self.suffix_format = "weekly", "-%Y-w%W"
+        elif "monthly" in index_rotation:
+            self.rotation, self.suffix_format = "monthly", "-%Y-%m"
+        else:
+            self.rotation, self.suffix_format = "annually", "-%Y"
+        self.index_tz = index_tz
+        # (tzinfo, start epoch, end epoch, suffix)
+        self.bucket = (None, 0, 0, "")
+
+    def get_bucket_boundaries(self, local_dt):
+        day = local_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        year = day.replace(month=1, day=1)
+        next_year = year.replace(year=year.year + 1)
+        if self.rotation == "daily":
+            return day, day + timedelta(days=1)
+        elif self.rotation == "weekly":
+            # %W は年が変わるとリセットされる
+            monday = day - timedelta(days=day.weekday())
+            return max(monday, year), min(monday + timedelta(days=7), next_year)
+        elif self.rotation == "monthly":
+            month = day.replace(day=1)
+            if month.month == 12:
+                return month, next_year
+            return month, month.replace(month=month.month + 1)
+        return year, next_year
+
+    def resolve(self, indexname, dt):
+        timestamp = dt.timestamp()
+        tzinfo, start, end, suffix = self.bucket
+        if start <= timestamp < end and (self.index_tz or dt.tzinfo is tzinfo):
+            return indexname + suffix
+        local_dt = dt.astimezone(self.index_tz) if self.index_tz else dt
+        start, end = self.get_bucket_boundaries(local_dt)
+        suffix = local_dt.strftime(self.suffix_format)
+        self.bucket = (dt.tzinfo, start.timestamp(), end.timestamp(), suffix)
+        return indexname + suffix
+
+
+@lru_cache(maxsize=128)
+def get_index_name_resolver(index_rotation, index_tz):
+    return IndexNameResolver(index_rotation, index_tz)
+
+
 #############################################################################
 # Amazon ES / AWS Resouce
 #############################################################################
@@ -283,9 +691,178 @@ def create_logtype_s3key_dict(etl_config):
     return logtype_s3key_dict
 
 
+# number of characters after \x, \u and \U in regex
+ESCAPE_ARGUMENT_LENGTHS = {"x": 2, "u": 4, "U": 8}
+
+
+def _end_of_character_class(pattern, i):
+    """return the index after the character class starting at pattern[i].
+
+    "]" right after "[" or "[^" is a member of the class. None is returned
+    when the class is not closed.
+    """
+    i += 1
+    if pattern.startswith("^", i):
+        i += 1
+    if pattern.startswith("]", i):
+        i += 1
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+        elif pattern[i] == "]":
+            return i + 1
+        else:
+            i += 1
+    return None
+
+
+def extract_required_literal(pattern):
+    """return the longest string which every match of pattern contains.
+
+    Only the top level of pattern is checked. Groups, character classes,
+    escapes other than escaped symbols and characters with optional
+    quantifiers are skipped. "" is returned for constructs which are not
+    handled, such as comments and unclosed groups.
+    >>> extract_required_literal(r"elasticloadbalancing_.*T\\d{4}Z_\\w*\\.log$")
+    'elasticloadbalancing_'
+    >>> extract_required_literal(r"(MySQL|mysql).*(audit)")
+    ''
+    >>> extract_required_literal(r"ab\\x41cd")
+    'ab'
+    """
+    runs, run = [], []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            escaped = pattern[i + 1 : i + 2]
+            i += 2
+            if escaped and not escaped.isalnum():
+                run.append(escaped)
+                continue
+            # the arguments of \xhh, \uxxxx, \Uxxxxxxxx, \N{name}, octal
+            # escapes and backreferences are not literal
+            if escaped in ESCAPE_ARGUMENT_LENGTHS:
+                i += ESCAPE_ARGUMENT_LENGTHS[escaped]
+            elif escaped == "N" and pattern[i : i + 1] == "{":
+                i = pattern.find("}", i) + 1 or n
+            elif escaped.isdigit():
+                end = i + 2
+                while i < min(end, n) and pattern[i].isdigit():
+                    i += 1
+        elif c == "|":
+            # top level alternation
+            return ""
+        elif c == "[":
+            i = _end_of_character_class(pattern, i)
+            if i is None:
+                return ""
+        elif c == "(":
+            if pattern.startswith("(?#", i):
+                # comment can have any character but ")"
+                return ""
+            depth = 0
+            while i < n:
+                if pattern[i] == "\\":
+                    i += 2
+                    continue
+                if pattern[i] == "[":
+                    i = _end_of_character_class(pattern, i)
+                    if i is None:
+                        return ""
+                    continue
+                if pattern[i] == "(":
+                    depth += 1
+                elif pattern[i] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        i += 1
+                        break
+                i += 1
+            else:
+                return ""
+        elif c in "*?{":
+            # the previous character is optional
+            if run:
+                run.pop()
+            if c == "{":
+                i = pattern.find("}", i) + 1 or n
+            else:
+                i += 1
+        elif c not in ".^$+":
+            run.append(c)
+            i += 1
+            continue
+        else:
+            i += 1
+        runs.append("".join(run))
+        run = []
+    runs.append("".join(run))
+    return max(runs, key=len)
+
+
+class LogtypeRouter:
+    """Resolve logtype from s3 key.
+
+    s3_key of logtypes are tried in the order of logtypes and the first
+    matched logtype wins. The literal which every match of s3_key contains is
+    extracted in advance, and s3_key regex is evaluated only when s3 key
+    contains the literal. Results are cached by s3 key.
+    """
+
+    RE_METACHARACTER = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+    def __init__(self, logtype_s3key_dict, maxsize=4096):
+        self.logtype_s3key_dict = logtype_s3key_dict
+        self.routes = []
+        for logtype, re_s3key in logtype_s3key_dict.items():
+            literal = ""
+            if not re_s3key.flags & (re.IGNORECASE | re.VERBOSE):
+                literal = extract_required_literal(re_s3key.pattern)
+            self.routes.append((logtype, literal, re_s3key))
+        self.get_logtype = lru_cache(maxsize=maxsize)(self._get_logtype)
+
+    def _get_logtype(self, s3key):
+        for logtype, literal, re_s3key in self.routes:
+            if literal in s3key and re_s3key.search(s3key):
+                return logtype
+        return "unknown"
+
+    def find_ambiguous_logtypes(self):
+        """return (logtype, preceding logtype) whose s3_key is shadowed.
+
+        s3_key which is a plain string is checked whether s3_key of a
+        preceding logtype matches it, and the same s3_key is reported too.
+        Such a logtype is never or rarely selected.
+        """
+        ambiguous = []
+        items = list(self.logtype_s3key_dict.items())
+        for i, (logtype, re_s3key) in enumerate(items):
+            is_literal = not self.RE_METACHARACTER.search(re_s3key.pattern)
+            for preceding_logtype, preceding_re_s3key in items[:i]:
+                if preceding_re_s3key.pattern == re_s3key.pattern or (
+                    is_literal and preceding_re_s3key.search(re_s3key.pattern)
+                ):
+                    ambiguous.append((logtype, preceding_logtype))
+                    break
+        return ambiguous
+
+
+def create_logtype_router(logtype_s3key_dict):
+    router = LogtypeRouter(logtype_s3key_dict)
+    for logtype, preceding_logtype in router.find_ambiguous_logtypes():
+        logger.warning(
+            f"s3_key of {logtype} is also matched by s3_key of {preceding_logtype}, "
+            f"which precedes {logtype}. Review s3_key in user.ini"
+        )
+    return router
+
+
 def get_logtype_from_s3key(s3key, logtype_s3key_dict):
     if s3key[-1] == "/":
         return "nodata"
+    if isinstance(logtype_s3key_dict, LogtypeRouter):
+        return logtype_s3key_dict.get_logtype(s3key)
     for logtype, re_s3key in logtype_s3key_dict.items():
         m = re_s3key.search(s3key)
         if m:
@@ -305,6 +882,25 @@ def sqs_queue(queue_url):
     return sqs_queue
 
 
+def write_dead_letters(dead_letters, s3_client, bucket):
+    """write documents which Amazon ES rejected permanently.
+
+    dead_letters is a list of (bulk entry, error reason). They are written
+    as gzipped NDJSON to the S3 bucket. Return the location of the file.
+    """
+    lines = []
+    for entry, error_reason in dead_letters:
+        entry = entry.decode("utf-8", errors="ignore")
+        lines.append(json.dumps({"error": error_reason, "entry": entry}) + "\n")
+    body = gzip.compress("".join(lines).encode("utf-8"))
+    now = datetime.now(timezone.utc)
+    key = (
+        f"dead_letter/{now:%Y/%m/%d/%H}/{now:%Y%m%dT%H%M%SZ}_{uuid.uuid4().hex}.json.gz"
+    )
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    return f"s3://{bucket}/{key}"
+
+
 #############################################################################
 # Lambda initialization
 #############################################################################
@@ -343,6 +939,51 @@ def find_user_custom_libs():
     return user_libs
 
 
+# cgroup v2 and v1 files of CPU quota
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_CPU_CFS_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_CPU_CFS_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def read_cgroup_cpu_quota():
+    """return the CPU quota of cgroup as a number of CPUs, or None."""
+    try:
+        with open(CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open(CGROUP_CPU_CFS_QUOTA) as f:
+                quota = f.read().strip()
+            with open(CGROUP_CPU_CFS_PERIOD) as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        # "max" means no limit
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def get_cpu_limit():
+    """return the number of CPUs which this container can use.
+
+    The CPUs available to the process are limited by the CPU quota of
+    cgroup if it is set. Partial CPUs are rounded down, at least 1.
+    """
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    quota = read_cgroup_cpu_quota()
+    if quota:
+        cpu_count = min(cpu_count, int(quota))
+    return max(cpu_count, 1)
+
+
 @lru_cache(maxsize=128)
 def timestr_to_hours(timestr):
     try:
@@ -356,7 +997,82 @@ def timestr_to_hours(timestr):
     return str(hours)
 
 
+ETL_CONFIG_FILES = ("aws.ini", "/opt/user.ini", "user.ini")
+# aws.ini と user.ini を解析済みの設定。ビルド時に作成する
+# etl_config which was parsed at build time. make etl_config
+ETL_CONFIG_ARTIFACT = "etl_config.json"
+ETL_CONFIG_RE_KEYS = ("s3_key", "s3_key_ignored", "log_pattern", "multiline_firstline")
+
+
+def hash_etl_config_files(filenames=ETL_CONFIG_FILES):
+    """return sha256 of the config files. missing files are hashed too."""
+    sha256 = hashlib.sha256()
+    for filename in filenames:
+        sha256.update(filename.encode() + b"\0")
+        try:
+            with open(filename, "rb") as f:
+                sha256.update(f.read())
+        except FileNotFoundError:
+            sha256.update(b"\0not found")
+        sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def create_etl_config_artifact(etl_config, config_hash):
+    """validate etl_config and convert it into a dict to dump as json.
+
+    All values are interpolated and regex is compiled once to validate.
+    """
+    sections = {}
+    for section in etl_config:
+        sections[section] = dict(etl_config[section])
+        for key in ETL_CONFIG_RE_KEYS:
+            if sections[section].get(key):
+                try:
+                    re.compile(sections[section][key])
+                except re.error:
+                    raise Exception(f"invalid regex pattern for {key} in {section}")
+    return {"hash": config_hash, "sections": sections}
+
+
+def write_etl_config_artifact(filename=ETL_CONFIG_ARTIFACT):
+    etl_config = parse_etl_config()
+    artifact = create_etl_config_artifact(etl_config, hash_etl_config_files())
+    with open(filename, "wb") as f:
+        f.write(json_dumps(artifact))
+    return filename
+
+
+def load_etl_config_artifact(filename, config_hash):
+    """load etl_config from artifact.
+
+    return None if there is no artifact or config files were changed after
+    the artifact was created.
+    """
+    try:
+        with open(filename, "rt") as f:
+            artifact = json_loads(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning(f"{filename} is broken. parse config files")
+        return None
+    if artifact.get("hash") != config_hash:
+        logger.info(f"config files were changed after {filename} was created")
+        return None
+    etl_config = configparser.ConfigParser(interpolation=None)
+    etl_config.read_dict(artifact["sections"])
+    return etl_config
+
+
 def get_etl_config():
+    etl_config = load_etl_config_artifact(ETL_CONFIG_ARTIFACT, hash_etl_config_files())
+    if etl_config is not None:
+        return etl_config
+    return parse_etl_config()
+
+
+def parse_etl_config():
     etl_config = configparser.ConfigParser(
         interpolation=configparser.ExtendedInterpolation()
     )
@@ -393,7 +1109,7 @@ def load_modules_on_memory(etl_config, user_libs):
 
 
 def load_sf_module(logfile, logconfig, user_libs_list):
-    if "script_ecs" in logconfig:
+    if logconfig.get("script_ecs"):
         mod_name = "sf_" + logfile.logtype.replace("-", "_")
         # old_mod_name is for compatibility
         old_mod_name = "sf_" + logfile.logtype
@@ -419,7 +1135,7 @@ def make_exclude_own_log_patterns(etl_config):
     return log_patterns
 
 
-def get_exclude_log_patterns_csv_filename(etl_config):
+def get_exclude_log_patterns_csv_filename(etl_config, s3_client=None):
     csv_filename = etl_config["DEFAULT"].get("exclude_log_patterns_filename")
     if not csv_filename:
         return None
@@ -435,12 +1151,12 @@ def get_exclude_log_patterns_csv_filename(etl_config):
             geoipbucket = config["aes"]["GEOIP_BUCKET"]
         else:
             return None
-    s3geo = boto3.resource("s3")
-    bucket = s3geo.Bucket(geoipbucket)
+    if s3_client is None:
+        s3_client = boto3.client("s3")
     s3obj = csv_filename
     local_file = f"/tmp/{csv_filename}"
     try:
-        bucket.download_file(s3obj, local_file)
+        s3_client.download_file(geoipbucket, s3obj, local_file)
     except Exception:
         return None
     return local_file
@@ -457,6 +1173,10 @@ def merge_dotted_key_value_into_dict(patterns_dict, dotted_key, value):
     return patterns_dict
 
 
+# key of exclude_log_patterns for patterns which search raw log
+RAW_PATTERNS_KEY = "@raw"
+
+
 def merge_csv_into_log_patterns(log_patterns, csv_filename):
     if not csv_filename:
         logger.info(f"{log_patterns}")
@@ -464,7 +1184,15 @@ def merge_csv_into_log_patterns(log_patterns, csv_filename):
     logger.info(f"{csv_filename} is imported to exclude_log_patterns")
     with open(csv_filename, "rt") as f:
         for line in csv.DictReader(f):
-            if line["pattern_type"].lower() == "text":
+            if line["pattern_type"].lower() == "raw":
+                # 解析前のログそのものを検索する
+                # search raw log before it is parsed
+                log_patterns.setdefault(line["log_type"], {})
+                log_patterns[line["log_type"]].setdefault(RAW_PATTERNS_KEY, []).append(
+                    re.compile(str(line["pattern"]))
+                )
+                continue
+            elif line["pattern_type"].lower() == "text":
                 pattern = re.compile(str(re.escape(line["pattern"])) + "$")
             else:
                 pattern = re.compile(str(line["pattern"]) + "$")
@@ -512,6 +1240,216 @@ def get_mime_type(data):
         return "text"
 
 
+class StageTimer:
+    """accumulate the seconds spent in each processing stage of an S3 object.
+
+    The time of a stage is exclusive. Time added to other stages while a
+    stage is measured is not counted in it. add() is cheap enough to be
+    called for every log.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        # seconds added in this process. subtracted from enclosing stages
+        self.total = 0.0
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+        self.total += seconds
+
+    @contextmanager
+    def measure(self, stage):
+        start, total = time.perf_counter(), self.total
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start - (self.total - total))
+
+    def merge(self, durations):
+        """add durations of other processes.
+
+        They ran in parallel with this process, so they are not subtracted
+        from stages measured here.
+        """
+        for stage, seconds in durations.items():
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def reset(self):
+        self.durations = {}
+        self.total = 0.0
+
+
+class TimedReader:
+    """file-like object which adds the time of read() to a stage of timer."""
+
+    def __init__(self, raw, timer, stage):
+        self.raw = raw
+        self.timer = timer
+        self.stage = stage
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        try:
+            return self.raw.read(size)
+        finally:
+            self.timer.add(self.stage, time.perf_counter() - start)
+
+    def close(self):
+        self.raw.close()
+
+
+# 1 MB per read from S3 StreamingBody
+DECOMPRESS_CHUNK_SIZE = 1048576
+# decompressed data is kept in memory up to this size and then spilled to /tmp
+SPOOL_MAX_MEMORY_SIZE = 67108864
+# free space of /tmp which spilled data leaves to GeoIP databases, zip files
+# and the other records processed concurrently. /tmp is the ephemeral storage
+# of Lambda, 512 MB by default
+SPOOL_MIN_FREE_SPACE = 134217728
+
+
+def _new_decompressor(mime_type):
+    if mime_type == "gzip":
+        # 16 + MAX_WBITS: gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        return bz2.BZ2Decompressor()
+
+
+def iter_decompressed_chunks(body, mime_type, head=b"", members=None):
+    """decompress file-like object in one forward pass.
+
+    S3 の StreamingBody を先頭から一度だけ読み、伸長したデータを順に返す。
+    gzip と bzip2 は連結された複数の member/stream にも対応する
+    head is the bytes which were already read from body to detect mime type.
+    If members (list) is given, (compressed offset, decompressed offset) of
+    the start of each gzip member or bzip2 stream is appended. Decompression
+    can be restarted from these points without the preceding data.
+    """
+    if mime_type == "text":
+        chunk = head or body.read(DECOMPRESS_CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = body.read(DECOMPRESS_CHUNK_SIZE)
+    elif mime_type in ("gzip", "bzip2"):
+        decompressor = _new_decompressor(mime_type)
+        data = head or body.read(DECOMPRESS_CHUNK_SIZE)
+        # offset of data[0] in compressed and decompressed data
+        compressed_offset, decompressed_offset = 0, 0
+        if members is not None:
+            members.append((0, 0))
+        while data:
+            if decompressor.eof:
+                # next member of concatenated gzip/bzip2
+                if mime_type == "gzip":
+                    # gzip files can be padded with zeroes
+                    stripped_data = data.lstrip(b"\x00")
+                    compressed_offset += len(data) - len(stripped_data)
+                    data = stripped_data
+                    if not data:
+                        data = body.read(DECOMPRESS_CHUNK_SIZE)
+                        continue
+                decompressor = _new_decompressor(mime_type)
+                if members is not None:
+                    members.append((compressed_offset, decompressed_offset))
+            output = decompressor.decompress(data)
+            if output:
+                decompressed_offset += len(output)
+                yield output
+            if decompressor.eof and decompressor.unused_data:
+                compressed_offset += len(data) - len(decompressor.unused_data)
+                data = decompressor.unused_data
+            else:
+                compressed_offset += len(data)
+                data = body.read(DECOMPRESS_CHUNK_SIZE)
+        if not decompressor.eof:
+            raise EOFError(
+                "Compressed file ended before the end-of-stream marker was reached"
+            )
+    elif mime_type == "zip":
+        # zip needs random access to the central directory at the end of file
+        with tempfile.TemporaryFile() as rawfile:
+            rawfile.write(head)
+            shutil.copyfileobj(body, rawfile, DECOMPRESS_CHUNK_SIZE)
+            with zipfile.ZipFile(rawfile) as z:
+                with z.open(z.namelist()[0]) as member:
+                    chunk = member.read(DECOMPRESS_CHUNK_SIZE)
+                    while chunk:
+                        yield chunk
+                        chunk = member.read(DECOMPRESS_CHUNK_SIZE)
+    else:
+        raise ValueError(f"unsupported mime type {mime_type}")
+
+
+def slice_chunks(chunks, start, end):
+    """yield bytes of chunks between offset start and end.
+
+    Iteration of chunks is stopped at end, so the rest is not decompressed.
+    """
+    offset = 0
+    for chunk in chunks:
+        chunk_end = offset + len(chunk)
+        if chunk_end > start:
+            sliced_chunk = chunk[max(start - offset, 0) : end - offset]
+            if sliced_chunk:
+                yield sliced_chunk
+        if chunk_end >= end:
+            break
+        offset = chunk_end
+
+
+def has_spool_space(size):
+    """whether size bytes can be written to /tmp leaving SPOOL_MIN_FREE_SPACE"""
+    free = shutil.disk_usage(tempfile.gettempdir()).free
+    return free - size >= SPOOL_MIN_FREE_SPACE
+
+
+def spool_chunks(chunks, max_memory_size=SPOOL_MAX_MEMORY_SIZE, line_offsets=None):
+    """write chunks into a rewindable binary file.
+
+    Data is kept in memory while it is small and is moved to a temporary
+    file when the size exceeds max_memory_size. The data stays in memory, or
+    is moved back to memory, when /tmp would have less free space than
+    SPOOL_MIN_FREE_SPACE.
+    If line_offsets (array('Q', [0])) is given, the start offset of each line
+    is appended in the same pass. The last item is the end of data, so
+    line i is line_offsets[i]:line_offsets[i + 1] and the number of lines is
+    len(line_offsets) - 1.
+    """
+    spool = io.BytesIO()
+    size = 0
+    spillable = True
+    for chunk in chunks:
+        if not isinstance(spool, io.BytesIO) and not has_spool_space(len(chunk)):
+            logger.warning("/tmp is running out of space. data is moved to memory")
+            tmpfile = spool
+            tmpfile.seek(0)
+            spool = io.BytesIO()
+            shutil.copyfileobj(tmpfile, spool, DECOMPRESS_CHUNK_SIZE)
+            tmpfile.close()
+            spillable = False
+        spool.write(chunk)
+        if line_offsets is not None:
+            pos = chunk.find(b"\n")
+            while pos != -1:
+                line_offsets.append(size + pos + 1)
+                pos = chunk.find(b"\n", pos + 1)
+        size += len(chunk)
+        if spillable and isinstance(spool, io.BytesIO) and size > max_memory_size:
+            if has_spool_space(size):
+                tmpfile = tempfile.TemporaryFile()
+                tmpfile.write(spool.getbuffer())
+                spool = tmpfile
+            else:
+                logger.warning("/tmp is running out of space. data is kept in memory")
+                spillable = False
+    if line_offsets is not None and size > line_offsets[-1]:
+        # last line without line feed
+        line_offsets.append(size)
+    spool.seek(0)
+    return spool
+
+
 def value_from_nesteddict_by_dottedkey(nested_dict, dotted_key):
     """get value form nested dict by dotted key.
 
@@ -570,6 +1508,132 @@ def value_from_nesteddict_by_dottedkeylist(nested_dict, dotted_key_list):
             return value
 
 
+def value_from_nesteddict_by_keys(nested_dict, keys):
+    """get value from nested dict by the keys which dotted key was split into.
+
+    digit keys must be int. It is the same as
+    value_from_nesteddict_by_dottedkey without splitting dotted key.
+    >>> value_from_nesteddict_by_keys({'a': {'b': [{'c': 123}]}}, ('a', 'b', 0, 'c'))
+    123
+    """
+    value = nested_dict
+    for key in keys:
+        try:
+            value = value[key]
+        except (TypeError, KeyError, IndexError):
+            return None
+    if value:
+        return value
+
+
+def split_dotted_key(dotted_key):
+    """split dotted key into keys. digit keys are converted into int.
+
+    >>> split_dotted_key('a.b.0.c')
+    ('a', 'b', 0, 'c')
+    """
+    return tuple(int(key) if key.isdigit() else key for key in dotted_key.split("."))
+
+
+def convert_value_for_nesteddict(value):
+    """convert value as put_value_into_nesteddict does.
+
+    dict and str are not converted. list is converted into comma separated
+    string, and others are converted into str.
+    """
+    if isinstance(value, dict) or isinstance(value, str):
+        return value
+    elif isinstance(value, list):
+        return ", ".join(map(str, value))
+    else:
+        return str(value)
+
+
+def merge_value_into_nesteddict(nested_dict, keys, value):
+    """put value into nested dict in place by keys.
+
+    It is the same as merge_dicts(nested_dict, put_value_into_nesteddict())
+    without creating a new nested dict. value is not converted.
+    When conflicts, the value is written as merge_dicts does. A value which
+    is not dict on the way of keys is overridden by dict, dict value is
+    merged into the existing dict and others override the existing value.
+    >>> d = {'a': {'x': 1}}
+    >>> merge_value_into_nesteddict(d, ('a', 'b'), '123')
+    >>> d
+    {'a': {'x': 1, 'b': '123'}}
+    """
+    current = nested_dict
+    for key in keys[:-1]:
+        child = current.get(key)
+        if not isinstance(child, dict):
+            child = current[key] = {}
+        current = child
+    key = keys[-1]
+    if isinstance(value, dict) and isinstance(current.get(key), dict):
+        merge_dicts(current[key], value)
+    else:
+        current[key] = value
+
+
+def merge_value_into_nesteddict_by_dottedkey(nested_dict, dotted_key, value):
+    """put value into nested dict in place by dotted key and return it.
+
+    value is converted as put_value_into_nesteddict does. Use this instead
+    of merge_dicts(nested_dict, put_value_into_nesteddict(dotted_key, value))
+    >>> d = {'a': {'x': 1}}
+    >>> merge_value_into_nesteddict_by_dottedkey(d, 'a.b.c', [123, 456])
+    {'a': {'x': 1, 'b': {'c': '123, 456'}}}
+    """
+    merge_value_into_nesteddict(
+        nested_dict, dotted_key.split("."), convert_value_for_nesteddict(value)
+    )
+    return nested_dict
+
+
+def compile_ecs_plan(logconfig):
+    """compile ecs, static_ecs, json_to_text and geoip of logconfig.
+
+    The dotted keys are split in advance so that LogParser does not parse
+    logconfig for each log.
+    ecs: list of (ecs keys, list of original keys, whether ecs key is ip)
+    static_ecs: list of (ecs keys, converted value)
+    json_to_text: list of (keys to get value, keys to put value)
+    geoip: list of ecs fields which have ip
+    """
+    ecs = []
+    for ecs_key in (logconfig.get("ecs") or "").split():
+        original_keys = logconfig[ecs_key]
+        if isinstance(original_keys, str):
+            original_keys = original_keys.split()
+        ecs.append(
+            (
+                tuple(ecs_key.split(".")),
+                tuple(split_dotted_key(key) for key in original_keys),
+                ".ip" in ecs_key,
+            )
+        )
+    static_ecs = []
+    for static_ecs_key in (logconfig.get("static_ecs") or "").split():
+        static_ecs.append(
+            (
+                tuple(static_ecs_key.split(".")),
+                convert_value_for_nesteddict(logconfig[static_ecs_key]),
+            )
+        )
+    json_to_text = []
+    for multifield_key in (logconfig.get("json_to_text") or "").split():
+        json_to_text.append(
+            (split_dotted_key(multifield_key), tuple(multifield_key.split(".")))
+        )
+    geoip = (logconfig.get("geoip") or "").split()
+    return {
+        "ecs": ecs,
+        "static_ecs": static_ecs,
+        "json_to_text": json_to_text,
+        "geoip": geoip,
+    }
+
+
 def put_value_into_nesteddict(dotted_key, value):
     """put value into nested dict by dotted key.
 
@@ -589,12 +1653,7 @@ def put_value_into_nesteddict(dotted_key, value):
     >>> put_value_into_nesteddict('a.b.c', '"')
     {'a': {'b': {'c': '"'}}}
     """
-    if isinstance(value, dict) or isinstance(value, str):
-        value = value
-    elif isinstance(value, list):
-        value = ", ".join(map(str, value))
-    else:
-        value = str(value)
+    value = convert_value_for_nesteddict(value)
     nested_dict = {}
     keys, current = dotted_key.split("."), nested_dict
     for p in keys[:-1]:
@@ -669,16 +1728,84 @@ def match_log_with_exclude_patterns(log_dict, log_patterns, ex_pattern=None):
                 res, ex_pattern = match_log_with_exclude_patterns(
                     log_dict[key], pattern
                 )
-                return (res, ex_pattern)
+                if res:
+                    return (res, ex_pattern)
             elif isinstance(pattern, re.Pattern):
                 if isinstance(log_dict[key], list):
-                    return (False, None)
+                    continue
                 elif pattern.match(str(log_dict[key])):
                     ex_pattern = "{{{0}: {1}}}".format(key, log_dict[key])
                     return (True, ex_pattern)
     return (False, None)
 
 
+class LogExcluder:
+    """Compiled exclude_log_patterns of a logtype.
+
+    Nested patterns are flattened into rules of (keys, pattern, literal).
+    literal is the string which every match of the pattern contains, and
+    the pattern is evaluated only when the value contains it. Raw patterns
+    from the CSV with pattern_type raw search the log before it is parsed.
+    """
+
+    def __init__(self, log_patterns):
+        self.rules = []
+        self.raw_patterns = list(log_patterns.get(RAW_PATTERNS_KEY, []))
+        self._add_rules(log_patterns, ())
+        literals = [literal for _, _, literal in self.rules]
+        # all literals are needed to skip rules by raw log
+        self.literals = tuple(literals) if all(literals) else None
+
+    def _add_rules(self, log_patterns, parent_keys):
+        for key, pattern in log_patterns.items():
+            if isinstance(pattern, dict):
+                self._add_rules(pattern, parent_keys + (key,))
+            elif isinstance(pattern, re.Pattern):
+                literal = ""
+                if not pattern.flags & (re.IGNORECASE | re.VERBOSE):
+                    literal = extract_required_literal(pattern.pattern)
+                self.rules.append((parent_keys + (key,), pattern, literal))
+
+    def match(self, log_dict, raw=None):
+        """match log with the rules.
+
+        raw is the text which every value of log_dict is a part of, e.g. a
+        line of text log. If raw contains no literal, no rule can match.
+        """
+        if raw is not None and self.literals is not None:
+            for literal in self.literals:
+                if literal in raw:
+                    break
+            else:
+                return (False, None)
+        for keys, pattern, literal in self.rules:
+            value = log_dict
+            for key in keys:
+                if not isinstance(value, dict) or key not in value:
+                    break
+                value = value[key]
+            else:
+                if isinstance(value, list):
+                    continue
+                text = str(value)
+                if literal in text and pattern.match(text):
+                    return (True, "{{{0}: {1}}}".format(keys[-1], value))
+        return (False, None)
+
+    def match_raw(self, raw):
+        for pattern in self.raw_patterns:
+            if pattern.search(raw):
+                return (True, f"{{{RAW_PATTERNS_KEY}: {pattern.pattern}}}")
+        return (False, None)
+
+
+def compile_exclude_log_patterns(exclude_log_patterns):
+    return {
+        logtype: LogExcluder(log_patterns)
+        for logtype, log_patterns in exclude_log_patterns.items()
+    }
+
+
 def merge_dicts(dicta, dictb, path=None):
     """merge two dicts.
 
@@ -713,19 +1840,3 @@ def merge_dicts(dicta, dictb, path=None):
         else:
             dicta[key] = dictb[key]
     return dicta
-
-
-def dev_merge_dicts(dicta: dict, dictb: dict):
-    """merge two dicts.
-
-    under development.
-    """
-    if not isinstance(dicta, dict) or not isinstance(dictb, dict):
-        return dicta
-    new_dicta = {**dicta, **dictb}
-    for k, v in new_dicta.items():
-        if isinstance(v, dict):
-            if (k in dicta) and isinstance(dicta[k], dict):
-                if dicta[k] != v:
-                    new_dicta[k] = dev_merge_dicts(dicta[k], v)
-    return new_dicta
@@ -1,13 +1,24 @@
+import bz2
 import datetime
+import gzip
+import hashlib
 import io
+import json
 import re
+import tempfile
+import zipfile
 import pytest
+from array import array
 
-from siem import LogS3, LogParser
+from siem import LogS3, LogParser, utils
 
 from unittest.mock import ANY, call, MagicMock, patch, PropertyMock
 
 
+def set_rawdata(log, data):
+    log._LogS3__rawdata = log.spool_rawdata([data])
+
+
 @pytest.fixture
 @patch("siem.LogS3.extract_rawdata_from_s3obj")
 @patch("siem.LogS3.extract_header_from_cwl")
@@ -158,27 +169,24 @@ def test_logS3_log_count_no_logs(MockLog):
     MockLog.ignored_reason = "there are not any valid logs in S3 object"
 
 
-@patch("siem.LogS3.rawdata")
-def test_logS3_log_count_csv(MockRawData, MockLog):
-    MockRawData.readlines.return_value = [1, 2]
+def test_logS3_log_count_csv(MockLog):
+    set_rawdata(MockLog, b"1\n2")
     MockLog.end_number = 0
     MockLog.file_format = "csv"
     MockLog.via_firelens = None
     assert LogS3.log_count.func(MockLog) == 2
 
 
-@patch("siem.LogS3.rawdata")
-def test_logS3_log_count_text(MockRawData, MockLog):
-    MockRawData.readlines.return_value = [1, 2]
+def test_logS3_log_count_text(MockLog):
+    set_rawdata(MockLog, b"1\n2")
     MockLog.end_number = 0
     MockLog.file_format = "text"
     MockLog.via_firelens = None
     assert LogS3.log_count.func(MockLog) == 2
 
 
-@patch("siem.LogS3.rawdata")
-def test_logS3_log_count_firelens(MockRawData, MockLog):
-    MockRawData.readlines.return_value = [1, 2]
+def test_logS3_log_count_firelens(MockLog):
+    set_rawdata(MockLog, b"1\n2")
     MockLog.end_number = 0
     MockLog.file_format = ""
     MockLog.via_firelens = "via_firelens"
@@ -211,7 +219,7 @@ def test_logS3_rawdata(MockLog):
 
 @patch("siem.LogS3.rawdata")
 def test_logS3_csv_header_with_csv(MockRawData, MockLog):
-    MockRawData.readlines.return_value = ["foo", "bar"]
+    MockRawData.readline.return_value = "foo\n"
     MockLog.file_format = "csv"
     assert LogS3.csv_header.func(MockLog) == "foo"
 
@@ -299,9 +307,8 @@ def test_logS3_startmsg(MockLog):
     }
 
 
-@patch("siem.LogS3.rawdata")
-def test_logS3_logdata_generator_text(MockRawData, MockLog):
-    MockRawData.readlines.return_value = ["foo", "bar"]
+def test_logS3_logdata_generator_text(MockLog):
+    set_rawdata(MockLog, b"foo\nbar\n")
 
     MockLog.file_format = "text"
     MockLog.logconfig = {"text_header_line_number": 0}
@@ -315,9 +322,8 @@ def test_logS3_logdata_generator_text(MockRawData, MockLog):
     assert MockLog.total_log_count == 1
 
 
-@patch("siem.LogS3.rawdata")
-def test_logS3_logdata_generator_csv(MockRawData, MockLog):
-    MockRawData.readlines.return_value = ["foo", "bar"]
+def test_logS3_logdata_generator_csv(MockLog):
+    set_rawdata(MockLog, b"foo\nbar\n")
 
     MockLog.file_format = "csv"
 
@@ -375,31 +381,39 @@ def test_logS3_logdata_generator_exception(MockLog):
 
 
 def test_logS3_extract_header_from_cwl_empty(MockLog):
-    data = MagicMock()
-    data.read.return_value = ""
+    data = io.StringIO("")
     assert MockLog.extract_header_from_cwl(data) == (None, None, None)
 
 
-@patch("siem.json")
-def test_logS3_extract_header_from_cwl(MockJson, MockLog):
-    data = MagicMock()
-    MockJson.JSONDecoder().raw_decode.side_effect = [
-        ({"messageType": "CONTROL_MESSAGE"}, 1),
-        ({"messageType": "", "logGroup": "foo", "logStream": "bar", "owner": "baz"}, 2),
-    ]
+def test_logS3_extract_header_from_cwl(MockLog):
+    data = io.StringIO(
+        '{"messageType": "CONTROL_MESSAGE"}'
+        '{"messageType": "", "logGroup": "foo", "logStream": "bar", "owner": "baz"}'
+    )
     assert MockLog.extract_header_from_cwl(data) == ("foo", "bar", "baz")
 
 
-@patch("siem.json")
-def test_logS3_extract_messages_from_cwl(MockJson, MockLog):
-    data = MagicMock()
-    data.read.return_value = "11"
-    MockJson.JSONDecoder().raw_decode.side_effect = [
-        ({"messageType": "CONTROL_MESSAGE"}, 1),
-        ({"messageType": "", "logEvents": [{"message": "foo"}]}, 2),
-    ]
+def test_logS3_extract_messages_from_cwl(MockLog):
+    data = io.StringIO(
+        '{"messageType": "CONTROL_MESSAGE"}\n'
+        '{"messageType": "", "logEvents": [{"message": "foo"}]}'
+        '{"messageType": "", "logEvents": [{"message": "bar"}, {"message": "baz"}]}'
+    )
     result = MockLog.extract_messages_from_cwl(data)
-    assert result.read() == "foo\n"
+    assert result.read() == "foo\nbar\nbaz\n"
+
+
+@patch("siem.utils.DECOMPRESS_CHUNK_SIZE", 4)
+def test_logS3_iter_json_objects_across_chunks(MockLog):
+    data = io.StringIO('{"a": 1} {"b": "1234567890"}\n{"c": [1, 2, 3]}\n')
+    a = [x for x in MockLog.iter_json_objects(data)]
+    assert a == [{"a": 1}, {"b": "1234567890"}, {"c": [1, 2, 3]}]
+
+
+def test_logS3_iter_json_objects_broken_json(MockLog):
+    data = io.StringIO('{"a": 1} {"b": ')
+    with pytest.raises(json.decoder.JSONDecodeError):
+        [x for x in MockLog.iter_json_objects(data)]
 
 
 def test_logS3_extract_rawdata_from_s3obj_exception(MockLog):
@@ -431,62 +445,54 @@ def test_logS3_extract_rawdata_from_s3obj_mime_exception(MockGetMimeType, MockLo
         MockLog.extract_rawdata_from_s3obj()
 
 
-@patch("siem.utils.get_mime_type")
-@patch("siem.gzip")
-def test_logS3_extract_rawdata_from_s3obj_gzip(MockGZip, MockGetMimeType, MockLog):
-    MockGetMimeType.return_value = "gzip"
-    MockGZip.open.return_value = "response"
-    MockLog.s3key = "bar"
-    MockLog.s3_client = MagicMock()
-    responseObj = {"Body": io.BytesIO(b"binary data: \x00\x01")}
-    MockLog.s3_client.get_object.return_value = responseObj
-    assert MockLog.extract_rawdata_from_s3obj() == "response"
+RAW_LOG = "line1 \u3042\nline2\nline3\n".encode("utf8")
 
 
-@patch("siem.utils.get_mime_type")
-@patch("siem.io.TextIOWrapper")
-def test_logS3_extract_rawdata_from_s3obj_text(MockText, MockGetMimeType, MockLog):
-    MockGetMimeType.return_value = "text"
-    MockText.return_value = "response"
-    MockLog.s3key = "bar"
-    MockLog.s3_client = MagicMock()
-    responseObj = {"Body": io.BytesIO(b"binary data: \x00\x01")}
-    MockLog.s3_client.get_object.return_value = responseObj
-    assert MockLog.extract_rawdata_from_s3obj() == "response"
+def _zip(data):
+    zipdata = io.BytesIO()
+    with zipfile.ZipFile(zipdata, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("log.txt", data)
+    return zipdata.getvalue()
 
 
-@patch("siem.utils.get_mime_type")
-@patch("siem.zipfile")
-@patch("builtins.open")
-def test_logS3_extract_rawdata_from_s3obj_zip(
-    MockOpen, _MockZip, MockGetMimeType, MockLog
-):
-    MockGetMimeType.return_value = "zip"
-    MockOpen.return_value = "response"
+@pytest.mark.parametrize(
+    "body",
+    [
+        RAW_LOG,
+        gzip.compress(RAW_LOG),
+        gzip.compress(RAW_LOG[:8]) + gzip.compress(RAW_LOG[8:]),
+        gzip.compress(RAW_LOG) + b"\x00" * 8,
+        bz2.compress(RAW_LOG),
+        bz2.compress(RAW_LOG[:8]) + bz2.compress(RAW_LOG[8:]),
+        _zip(RAW_LOG),
+    ],
+)
+@patch("siem.utils.DECOMPRESS_CHUNK_SIZE", 16)
+def test_logS3_extract_rawdata_from_s3obj(body, MockLog):
     MockLog.s3key = "bar"
     MockLog.s3_client = MagicMock()
-    responseObj = {"Body": io.BytesIO(b"binary data: \x00\x01")}
+    responseObj = {"Body": io.BytesIO(body)}
     MockLog.s3_client.get_object.return_value = responseObj
-    assert MockLog.extract_rawdata_from_s3obj() == "response"
+    rawdata = MockLog.extract_rawdata_from_s3obj()
+    assert rawdata.read() == RAW_LOG.decode("utf8")
+    rawdata.seek(0)
+    assert rawdata.readlines() == ["line1 \u3042\n", "line2\n", "line3\n"]
 
 
-@patch("siem.utils.get_mime_type")
-@patch("siem.bz2")
-def test_logS3_extract_rawdata_from_s3obj_bzip2(MockBz2, MockGetMimeType, MockLog):
-    MockGetMimeType.return_value = "bzip2"
-    MockBz2.open.return_value = "response"
+def test_logS3_extract_rawdata_from_s3obj_truncated_gzip(MockLog):
     MockLog.s3key = "bar"
     MockLog.s3_client = MagicMock()
-    responseObj = {"Body": io.BytesIO(b"binary data: \x00\x01")}
+    responseObj = {"Body": io.BytesIO(gzip.compress(RAW_LOG * 10)[:-12])}
     MockLog.s3_client.get_object.return_value = responseObj
-    assert MockLog.extract_rawdata_from_s3obj() == "response"
+    with pytest.raises(EOFError):
+        MockLog.extract_rawdata_from_s3obj()
 
 
 @patch("siem.LogS3.check_cwe_and_strip_header")
 def test_logS3_extract_logobj_from_json_no_delimiter_count(MockStrip, MockLog):
     MockStrip.side_effect = [{"event": 1}, {"event": 2}]
     MockLog.logconfig = {"json_delimiter": False}
-    MockLog.rawdata.readlines.return_value = ["{}", "{}"]
+    set_rawdata(MockLog, b"{}\n{}\n")
     a = [x for x in MockLog.extract_logobj_from_json()]
     assert a == [1, 2]
 
@@ -498,7 +504,7 @@ def test_logS3_extract_logobj_from_json_delimiter_count(MockStrip, MockLog):
         {"|": [{"event": 3}, {"event": 4}]},
     ]
     MockLog.logconfig = {"json_delimiter": "|"}
-    MockLog.rawdata.readlines.return_value = ["{}", "{}"]
+    set_rawdata(MockLog, b"{}\n{}\n")
     a = [x for x in MockLog.extract_logobj_from_json()]
     assert a == [2, 4]
 
@@ -507,7 +513,7 @@ def test_logS3_extract_logobj_from_json_delimiter_count(MockStrip, MockLog):
 def test_logS3_extract_logobj_from_json_no_delimiter_no_count(MockStrip, MockLog):
     MockStrip.side_effect = [{"event": 1}, {"event": 2}]
     MockLog.logconfig = {"json_delimiter": False}
-    MockLog.rawdata.readlines.return_value = ["{}", "{}"]
+    set_rawdata(MockLog, b"{}\n{}\n")
     a = [x for x in MockLog.extract_logobj_from_json(mode="foo", end=2)]
     assert a == [{"event": 1}, {"event": 2}]
 
@@ -519,11 +525,82 @@ def test_logS3_extract_logobj_from_json_delimiter_no_count(MockStrip, MockLog):
         {"|": [{"event": 3}, {"event": 4}]},
     ]
     MockLog.logconfig = {"json_delimiter": "|"}
-    MockLog.rawdata.readlines.return_value = ["{}", "{}"]
+    set_rawdata(MockLog, b"{}\n{}\n")
     a = [x for x in MockLog.extract_logobj_from_json(mode="foo", end=2)]
     assert a == [{"event": 1}, {"event": 2}]
 
 
+@pytest.mark.parametrize(
+    "start,end,expected",
+    [
+        (0, 4, [1, 2, 3, 4]),
+        (1, 3, [2, 3]),
+        (2, 4, [3, 4]),
+        (3, 10, [4]),
+    ],
+)
+def test_logS3_extract_logobj_from_json_slice_with_index(start, end, expected, MockLog):
+    set_rawdata(
+        MockLog,
+        b'{"r": [{"e": 1}, {"e": 2}]}\n\n{"r": [{"e": 3}]} {"r": [{"e": 4}]}\n',
+    )
+    MockLog.logconfig = {"json_delimiter": "r"}
+    assert list(MockLog.extract_logobj_from_json()) == [2, 2, 4]
+    assert list(MockLog.json_counts_before_line) == [0, 2, 2]
+    a = [x["e"] for x in MockLog.extract_logobj_from_json("extract", start, end)]
+    assert a == expected
+
+
+def test_logS3_extract_logobj_from_json_keeps_source(MockLog):
+    set_rawdata(
+        MockLog,
+        b'{"r": [{"e": 1}, {"e":"}{\\"]", "x": [1, {"y": 2}]}], "t": 1}\n'
+        b'{"r":[{"e": 3}]}{"r": [ 5 ]}\n',
+    )
+    MockLog.logconfig = {"json_delimiter": "r"}
+    list(MockLog.extract_logobj_from_json())
+    a = list(MockLog.extract_logobj_from_json("extract", 1, 4))
+    assert a == [{"e": '}{"]', "x": [1, {"y": 2}]}, {"e": 3}, 5]
+    assert [getattr(x, "source", None) for x in a] == [
+        '{"e":"}{\\"]", "x": [1, {"y": 2}]}',
+        '{"e": 3}',
+        None,
+    ]
+
+
+def test_logS3_extract_logobj_from_json_keeps_source_of_cwe(MockLog):
+    set_rawdata(
+        MockLog,
+        b'{"detail-type": "Findings", "resources": [], "account": "123", '
+        b'"region": "r", "detail": {"findings": [{"Id": "a"}, {"Id": "b"}]}}\n'
+        b'{"Id": "c"}\n',
+    )
+    MockLog.logconfig = {"json_delimiter": "findings"}
+    a = list(MockLog.extract_logobj_from_json("extract", 0, 10))
+    assert [x.source for x in a] == ['{"Id": "a"}', '{"Id": "b"}']
+    MockLog.logconfig = {"json_delimiter": ""}
+    a = list(MockLog.extract_logobj_from_json("extract", 0, 10))
+    assert [x.source for x in a] == [
+        '{"findings": [{"Id": "a"}, {"Id": "b"}]}',
+        '{"Id": "c"}',
+    ]
+
+
+@pytest.mark.parametrize(
+    "start,end,expected",
+    [
+        (0, None, ["a\n", "b\u3042\n", "c"]),
+        (1, 2, ["b\u3042\n"]),
+        (2, 10, ["c"]),
+        (3, 10, []),
+    ],
+)
+def test_logS3_iter_lines(start, end, expected, MockLog):
+    set_rawdata(MockLog, "a\nb\u3042\nc".encode("utf8"))
+    assert list(MockLog.line_offsets) == [0, 2, 7, 8]
+    assert list(MockLog.iter_lines(start, end)) == expected
+
+
 def test_logS3_match_multiline_firstline_true(MockLog):
     MockLog.re_multiline_firstline = re.compile("^foo$")
     assert MockLog.match_multiline_firstline("foo") == True
@@ -536,17 +613,35 @@ def test_logS3_match_multiline_firstline_false(MockLog):
 
 @patch("siem.LogS3.match_multiline_firstline")
 def test_logS3_count_multiline_log(MockMatch, MockLog):
-    MockLog.rawdata.__iter__.return_value = ["foo", "bar"]
+    set_rawdata(MockLog, b"foo\nbar\n")
     MockMatch.side_effect = [True, False]
     assert MockLog.count_multiline_log() == 1
 
 
 @patch("siem.LogS3.match_multiline_firstline")
 def test_logS3_extract_multiline_log(MockMatch, MockLog):
-    MockLog.rawdata.__iter__.return_value = ["foo", "bar"]
-    MockMatch.side_effect = [True, False]
+    set_rawdata(MockLog, b"foo\nbar\n")
+    MockMatch.side_effect = [True, False, True, False]
     a = [x for x in MockLog.extract_multiline_log(end=2)]
-    assert a == ["foobar"]
+    assert a == ["foo\nbar"]
+
+
+@pytest.mark.parametrize(
+    "start,end,expected",
+    [
+        (0, 3, ["a1\n a2", "b1", "c1\n c2"]),
+        (1, 2, ["b1"]),
+        (2, 3, ["c1\n c2"]),
+        (0, 1, ["a1\n a2"]),
+        (3, 4, []),
+    ],
+)
+def test_logS3_extract_multiline_log_slice(start, end, expected, MockLog):
+    set_rawdata(MockLog, b"header\na1\n a2\nb1\nc1\n c2\n")
+    MockLog.re_multiline_firstline = re.compile(r"[abc]1")
+    MockLog.multiline_firstlines
+    a = [x for x in MockLog.extract_multiline_log(start, end)]
+    assert a == expected
 
 
 def test_logS3_check_cwe_and_strip_header_no_match(MockLog):
@@ -604,6 +699,177 @@ def test_logS3_send_meta_to_sqs(MockLog):
     )
 
 
+@patch("siem.LogS3.make_checkpoint")
+def test_logS3_send_meta_to_sqs_with_checkpoint(MockCheckpoint, MockLog):
+    MockCheckpoint.return_value = {"offset": 10}
+    MockLog.sqs_queue.send_messages.return_value = {
+        "ResponseMetadata": {"HTTPStatusCode": 200}
+    }
+    MockLog.send_meta_to_sqs([(3, 4)])
+    MockCheckpoint.assert_called_once_with(3, 4)
+    MockLog.sqs_queue.send_messages.assert_called_once_with(
+        Entries=[
+            {
+                "Id": "num_3",
+                "MessageBody": '{"siem": {"start_number": 3, "end_number": 4, "checkpoint": {"offset": 10}}, "s3": {"bucket": {"name": "foo"}, "object": {"key": "bar"}}}',
+            }
+        ]
+    )
+
+
+def test_logS3_make_checkpoint_via_cwl(MockLog):
+    MockLog.mime_type = "gzip"
+    assert MockLog.make_checkpoint(1, 2) is None
+
+
+def test_logS3_make_checkpoint_zip(MockLog):
+    MockLog.via_cwl = False
+    MockLog.mime_type = "zip"
+    assert MockLog.make_checkpoint(1, 2) is None
+
+
+class FakeS3Client:
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.ranges.append(Range)
+        start = 0
+        if Range:
+            start = int(Range[len("bytes=") : -1])
+        return {"Body": io.BytesIO(self.data[start:])}
+
+
+def split_and_load(logconfig, data):
+    record = {"s3": {"bucket": {"name": "foo"}, "object": {"key": "bar"}}}
+    s3_client = FakeS3Client(data)
+    sqs_queue = MagicMock()
+    sqs_queue.send_messages.return_value = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+    logfile = LogS3(record, "logtype", logconfig, s3_client, sqs_queue)
+    assert list(logfile) == []
+    logs = []
+    for send_call in sqs_queue.send_messages.call_args_list:
+        for entry in send_call.kwargs["Entries"]:
+            split_record = json.loads(entry["MessageBody"])
+            split_logfile = LogS3(
+                split_record, "logtype", logconfig, s3_client, sqs_queue
+            )
+            logs.append(list(split_logfile))
+    return logs, s3_client.ranges
+
+
+LOGCONFIG = {
+    "s3_key_ignored": "",
+    "via_cwl": False,
+    "via_firelens": False,
+    "max_log_count": 3,
+    "text_header_line_number": 0,
+    "json_delimiter": "",
+}
+
+
+def test_logS3_split_with_checkpoint_csv():
+    data = "h1 h2\n" + "".join(f"a{i} b{i}\n" for i in range(1, 9))
+    # 2 gzip members
+    member1 = gzip.compress(data[:20].encode())
+    member2 = gzip.compress(data[20:].encode())
+    logconfig = dict(LOGCONFIG, file_format="csv")
+    logs, ranges = split_and_load(logconfig, member1 + member2)
+    assert logs == [
+        ["a1 b1", "a2 b2"],
+        ["a3 b3", "a4 b4", "a5 b5"],
+        ["a6 b6", "a7 b7", "a8 b8"],
+    ]
+    assert ranges == [None, "bytes=0-", "bytes=0-", f"bytes={len(member1)}-"]
+
+
+def test_logS3_split_with_checkpoint_csv_header():
+    data = "h1 h2\n" + "".join(f"a{i} b{i}\n" for i in range(1, 9))
+    logconfig = dict(LOGCONFIG, file_format="csv")
+    record = {"s3": {"bucket": {"name": "foo"}, "object": {"key": "bar"}}}
+    logfile = LogS3(record, "csv", logconfig, FakeS3Client(data.encode()), None)
+    logfile.log_count
+    assert logfile.make_checkpoint(4, 6) == {
+        "offset": 18,
+        "end_offset": 36,
+        "count": 3,
+        "member_offset": 18,
+        "member_base": 18,
+        "mime_type": "text",
+        "csv_header": "h1 h2",
+    }
+
+
+def test_logS3_split_with_checkpoint_json():
+    lines = [
+        json.dumps({"Records": [{"id": i}, {"id": i + 1}]}) for i in range(1, 9, 2)
+    ]
+    data = gzip.compress(("\n".join(lines) + "\n").encode())
+    logconfig = dict(LOGCONFIG, file_format="json", json_delimiter="Records")
+    logs, ranges = split_and_load(logconfig, data)
+    assert [[log["id"] for log in split_log] for split_log in logs] == [
+        [1, 2, 3],
+        [4, 5, 6],
+        [7, 8],
+    ]
+
+
+def test_logS3_split_with_checkpoint_multiline():
+    data = "".join(f"[{i}] first\n next\n" for i in range(1, 6)).encode()
+    logconfig = dict(
+        LOGCONFIG, file_format="multiline", multiline_firstline=re.compile(r"\[")
+    )
+    logs, ranges = split_and_load(logconfig, data)
+    assert logs == [
+        ["[1] first\n next", "[2] first\n next", "[3] first\n next"],
+        ["[4] first\n next", "[5] first\n next"],
+    ]
+    assert ranges == [None, "bytes=0-", f"bytes={len(data) * 3 // 5}-"]
+
+
+@pytest.mark.parametrize("number", [1, 2, 3, 10])
+def test_logS3_split_log_range_json(number):
+    lines = [
+        json.dumps({"Records": [{"id": i}, {"id": i + 1}]}) for i in range(1, 9, 2)
+    ]
+    data = ("\n".join(lines) + "\n").encode()
+    logconfig = dict(
+        LOGCONFIG, file_format="json", json_delimiter="Records", max_log_count=100
+    )
+    record = {"s3": {"bucket": {"name": "foo"}, "object": {"key": "bar"}}}
+    logfile = LogS3(record, "json", logconfig, FakeS3Client(data), None)
+    logfile.log_count
+    ranges = logfile.split_log_range(number)
+    assert len(ranges) == min(number, 8)
+    logs = [log for start, end in ranges for log in logfile.extract_logdata(start, end)]
+    assert [log["id"] for log in logs] == list(range(1, 9))
+    assert logfile.total_log_count == 8
+
+
+def test_logS3_split_log_range_csv():
+    data = "h1 h2\n" + "".join(f"a{i} b{i}\n" for i in range(1, 6))
+    logconfig = dict(LOGCONFIG, file_format="csv", max_log_count=100)
+    record = {"s3": {"bucket": {"name": "foo"}, "object": {"key": "bar"}}}
+    logfile = LogS3(record, "csv", logconfig, FakeS3Client(data.encode()), None)
+    logfile.log_count
+    assert logfile.split_log_range(2) == [(1, 4), (4, 6)]
+    assert list(logfile.extract_logdata(4, 6)) == ["a4 b4", "a5 b5"]
+
+
+def test_logS3_reopen_rawdata(MockLog):
+    spool = tempfile.TemporaryFile()
+    spool.write(b"foo\nbar\n")
+    MockLog.line_offsets = array("Q", [0, 4, 8])
+    rawdata = io.TextIOWrapper(spool, encoding="utf8")
+    MockLog._LogS3__rawdata = rawdata
+    MockLog.reopen_rawdata()
+    assert MockLog.rawdata.buffer is not spool
+    spool.seek(8)
+    assert list(MockLog.iter_lines(1)) == ["bar\n"]
+    assert spool.tell() == 8
+
+
 @pytest.fixture
 def MockParser(MockLog):
     logfile = MockLog
@@ -688,6 +954,58 @@ def test_parser_call(
     MockEnrich.assert_called_once()
 
 
+@patch("siem.logger")
+@patch.multiple(
+    "siem.LogParser",
+    is_excluded_by_raw_patterns=MagicMock(return_value=False),
+    logdata_to_dict=MagicMock(return_value={"@id": "id"}),
+    set_skip_normalization=MagicMock(),
+    get_timestamp=MagicMock(),
+    add_basic_field=MagicMock(),
+    clean_multi_type_field=MagicMock(),
+    transform_to_ecs=MagicMock(),
+    transform_by_script=MagicMock(),
+    enrich=MagicMock(),
+)
+@pytest.mark.parametrize("sample_rate,sampled", [(0, False), (1, True)])
+def test_parser_call_stage_durations(MockLogger, sample_rate, sampled, MockParser):
+    MockParser.record_sample_rate = sample_rate
+    MockParser({})
+    MockParser({})
+    stages = {"parse", "ecs", "script", "geoip"}
+    assert stages <= set(MockParser.logfile.stage_timer.durations)
+    assert MockLogger.info.called == sampled
+    if sampled:
+        message = MockLogger.info.call_args[0][0]
+        assert set(message["record_stage_durations_ms"]) == stages
+        assert message["doc_id"] == "id"
+
+
+@patch.multiple(
+    "siem.LogParser",
+    is_excluded_by_raw_patterns=MagicMock(return_value=False),
+    # __doc_id_suffix is set by sf_securityhub
+    logdata_to_dict=MagicMock(
+        side_effect=lambda logdata: {"@id": "id", "__doc_id_suffix": 1}
+    ),
+    set_skip_normalization=MagicMock(),
+    get_timestamp=MagicMock(),
+    add_basic_field=MagicMock(),
+    clean_multi_type_field=MagicMock(),
+    transform_to_ecs=MagicMock(),
+    transform_by_script=MagicMock(),
+    enrich=MagicMock(),
+)
+def test_parser_call_sampling_keeps_doc_id(MockParser):
+    MockParser.logconfig = {"doc_id_suffix": None}
+    doc_ids = []
+    for sample_rate in (0, 1):
+        MockParser.record_sample_rate = sample_rate
+        MockParser({})
+        doc_ids.append(MockParser.doc_id)
+    assert doc_ids == ["id_1", "id_1"]
+
+
 def test_parser_is_ignored_key(MockParser):
     MockParser._LogParser__logdata_dict = {"ignored_reason": "bar", "is_ignored": "foo"}
     assert MockParser.is_ignored == True
@@ -709,6 +1027,76 @@ def test_parser_is_ignored_logtype_no_match(MockParser):
     assert MockParser.is_ignored == False
 
 
+def test_parser_is_ignored_evaluated_once(MockParser):
+    MockParser._LogParser__logdata_dict = {"a": "foo"}
+    MockParser.logtype = "fizz"
+    excluder = MagicMock(spec=utils.LogExcluder)
+    excluder.match.return_value = (True, "{a: foo}")
+    MockParser.exclude_log_patterns = {"fizz": excluder}
+    assert MockParser.is_ignored == True
+    assert MockParser.is_ignored == True
+    excluder.match.assert_called_once_with({"a": "foo"}, None)
+    assert MockParser.ignored_reason == "matched {a: foo} with exclude_log_patterns"
+
+
+def test_parser_is_ignored_with_raw_text_log(MockParser):
+    MockParser.logdata = "x AesSiemEsLoader y"
+    MockParser._LogParser__logdata_dict = {"ua": "AesSiemEsLoader"}
+    MockParser.logformat = "text"
+    MockParser.via_firelens = False
+    MockParser.logtype = "fizz"
+    MockParser.exclude_log_patterns = utils.compile_exclude_log_patterns(
+        {"fizz": {"ua": re.compile(".*AesSiemEsLoader.*")}}
+    )
+    assert MockParser.check_ignored() == True
+
+
+@patch("siem.LogParser.logdata_to_dict")
+def test_parser_call_excluded_by_raw_patterns(MockLogtoDict, MockParser):
+    MockParser.logtype = "fizz"
+    MockParser.via_firelens = False
+    MockParser.exclude_log_patterns = utils.compile_exclude_log_patterns(
+        {"fizz": {utils.RAW_PATTERNS_KEY: [re.compile("athena")]}}
+    )
+    MockParser(utils.JsonRecord({"a": 1}, '{"eventSource":"athena.amazonaws.com"}'))
+    assert MockParser.is_ignored == True
+    assert MockParser.ignored_reason == (
+        "matched {@raw: athena} with exclude_log_patterns"
+    )
+    MockLogtoDict.assert_not_called()
+
+
+@patch.multiple(
+    "siem.LogParser",
+    is_excluded_by_raw_patterns=MagicMock(return_value=False),
+    set_skip_normalization=MagicMock(),
+    get_timestamp=MagicMock(),
+    add_basic_field=MagicMock(),
+    clean_multi_type_field=MagicMock(),
+    transform_by_script=MagicMock(),
+    enrich=MagicMock(),
+)
+@pytest.mark.parametrize("ip,excluded", [("10.0.0.1", True), ("10.0.0.2", False)])
+def test_parser_call_excluded_by_ecs_field(ip, excluded, MockParser):
+    MockParser.logtype = "fizz"
+    MockParser.logformat = "json"
+    MockParser.via_firelens = False
+    MockParser.exclude_log_patterns = utils.compile_exclude_log_patterns(
+        {"fizz": {"source": {"ip": re.compile(r"10\.0\.0\.1")}}}
+    )
+
+    def transform_to_ecs():
+        MockParser._LogParser__logdata_dict["source"] = {"ip": ip}
+
+    with patch.object(MockParser, "transform_to_ecs", transform_to_ecs):
+        MockParser({"srcaddr": ip})
+    assert MockParser.is_ignored == excluded
+    if excluded:
+        assert MockParser.ignored_reason == (
+            "matched {ip: 10.0.0.1} with exclude_log_patterns"
+        )
+
+
 def test_parser_timestamp(MockParser):
     MockParser._LogParser__timestamp = "foo"
     assert MockParser.timestamp == "foo"
@@ -800,24 +1188,12 @@ def test_parser_indexname_rotation(period, expected, MockParser):
     assert MockParser.indexname == "index-name" + time.strftime(expected)
 
 
-@patch("siem.LogParser.del_none")
-def test_parser_json(MockDelNone, MockParser):
-    MockParser._LogParser__logdata_dict = {"foo": "bar"}
-    MockDelNone.return_value = {"foo": "bar"}
-    assert MockParser.json == '{"foo": "bar"}'
-
-
-@patch("siem.LogParser.del_none")
-@patch("siem.LogParser.truncate_big_field")
-def test_parser_json_too_big(MockTruncateBig, MockDelNone, MockParser):
-    MockParser._LogParser__logdata_dict = {"foo": "bar"}
-    big_data = []
-    for _ in range(10_000):
-        big_data.append({"foo": "bar"})
-    MockDelNone.return_value = big_data
-    MockTruncateBig.return_value = {"foo": "bar"}
-    assert MockParser.json == '{"foo": "bar"}'
-    MockTruncateBig.assert_called_once_with(big_data)
+@patch("siem.LogParser.finalize_dict")
+def test_parser_json(MockFinalize, MockParser):
+    MockParser._LogParser__logdata_dict = {"foo": "bar", "baz": None}
+    MockFinalize.return_value = {"foo": "bar"}
+    assert json.loads(MockParser.json) == {"foo": "bar"}
+    MockFinalize.assert_called_once_with({"foo": "bar", "baz": None})
 
 
 @patch("siem.LogParser.get_log_and_meta_from_firelens")
@@ -874,9 +1250,7 @@ def test_parser_logdata_to_dict_using_multiline(MockConvert, MockParser):
     assert MockParser.logdata_to_dict({"data": "data"}) == {"data": "data"}
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_add_basic_field_with_json(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_add_basic_field_with_json(MockParser):
     MockParser.logformat = "json"
     MockParser.logdata = {"data": "data"}
     MockParser.logtype = "logtype"
@@ -899,9 +1273,26 @@ def test_parser_add_basic_field_with_json(MockMerge, MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_add_basic_field_string(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_add_basic_field_with_json_source(MockParser):
+    MockParser.logformat = "json"
+    MockParser.logdata = utils.JsonRecord({"data": "data"}, '{"data":"data"}')
+    MockParser.logtype = "logtype"
+    MockParser.loggroup = False
+    MockParser.logconfig = {"doc_id": None}
+    time = datetime.datetime.now()
+    MockParser._LogParser__timestamp = time
+    MockParser._LogParser__event_ingested = time
+    MockParser._LogParser__skip_normalization = False
+    MockParser._LogParser__logdata_dict = {}
+    MockParser.add_basic_field()
+    assert MockParser._LogParser__logdata_dict["@message"] == '{"data":"data"}'
+    assert (
+        MockParser._LogParser__logdata_dict["@id"]
+        == hashlib.md5(b'{"data":"data"}').hexdigest()
+    )
+
+
+def test_parser_add_basic_field_string(MockParser):
     MockParser.logformat = "text"
     MockParser.logdata = "data;data"
     MockParser.logtype = "logtype"
@@ -924,9 +1315,7 @@ def test_parser_add_basic_field_string(MockMerge, MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_add_basic_field_skip_normalization(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_add_basic_field_skip_normalization(MockParser):
     MockParser.logformat = "text"
     MockParser.logdata = "data;data"
     MockParser.logtype = "logtype"
@@ -949,9 +1338,7 @@ def test_parser_add_basic_field_skip_normalization(MockMerge, MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_add_basic_field_with_docid(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_add_basic_field_with_docid(MockParser):
     MockParser.logformat = "text"
     MockParser.logdata = {"abcd": "data;data"}
     MockParser.logtype = "logtype"
@@ -964,6 +1351,7 @@ def test_parser_add_basic_field_with_docid(MockMerge, MockParser):
     MockParser._LogParser__logdata_dict = {"abcd": "data;data"}
     MockParser.add_basic_field()
     assert MockParser._LogParser__logdata_dict == {
+        "abcd": "data;data",
         "@id": "data;data",
         "@log_s3bucket": "foo",
         "@log_s3key": "bar",
@@ -974,9 +1362,7 @@ def test_parser_add_basic_field_with_docid(MockMerge, MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_add_basic_field_with_loggroup(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_add_basic_field_with_loggroup(MockParser):
     MockParser.logformat = "text"
     MockParser.logdata = {"abcd": "data;data"}
     MockParser.logtype = "logtype"
@@ -990,6 +1376,7 @@ def test_parser_add_basic_field_with_loggroup(MockMerge, MockParser):
     MockParser._LogParser__logdata_dict = {"abcd": "data;data"}
     MockParser.add_basic_field()
     assert MockParser._LogParser__logdata_dict == {
+        "abcd": "data;data",
         "@id": "data;data",
         "@log_s3bucket": "foo",
         "@log_s3key": "bar",
@@ -1002,55 +1389,71 @@ def test_parser_add_basic_field_with_loggroup(MockMerge, MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_clean_multi_type_field_no_multifieldkeys(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_clean_multi_type_field_no_multifieldkeys(MockParser):
     MockParser._LogParser__logdata_dict = {}
     MockParser.logconfig = {"json_to_text": ""}
     MockParser.clean_multi_type_field()
     assert MockParser._LogParser__logdata_dict == {}
 
 
-@patch("siem.utils.merge_dicts")
-@patch("siem.utils.value_from_nesteddict_by_dottedkey")
-def test_parser_clean_multi_type_field_no_values(MockValues, MockMerge, MockParser):
-    MockValues.return_value = False
-    MockMerge.side_effect = lambda _x, y: y
-    MockParser._LogParser__logdata_dict = {}
+def test_parser_add_basic_field_merges_into_existing_event(MockParser):
+    MockParser.logformat = "text"
+    MockParser.logdata = "data"
+    MockParser.logtype = "logtype"
+    MockParser.loggroup = False
+    MockParser.logconfig = {"doc_id": None}
+    time = datetime.datetime.now()
+    MockParser._LogParser__timestamp = time
+    MockParser._LogParser__event_ingested = time
+    MockParser._LogParser__skip_normalization = False
+    MockParser._LogParser__logdata_dict = {"event": {"action": "foo"}}
+    MockParser.add_basic_field()
+    assert MockParser._LogParser__logdata_dict["event"] == {
+        "action": "foo",
+        "module": "logtype",
+        "ingested": time.isoformat(),
+    }
+    MockParser._LogParser__logdata_dict = {"event": "foo"}
+    MockParser.add_basic_field()
+    assert MockParser._LogParser__logdata_dict["event"] == {
+        "module": "logtype",
+        "ingested": time.isoformat(),
+    }
+
+
+def test_parser_clean_multi_type_field_no_values(MockParser):
+    MockParser._LogParser__logdata_dict = {"baz": 1}
     MockParser.logconfig = {"json_to_text": "foo bar"}
     MockParser.clean_multi_type_field()
-    assert MockParser._LogParser__logdata_dict == {}
-    MockValues.assert_has_calls([call({}, "foo"), call({}, "bar")])
+    assert MockParser._LogParser__logdata_dict == {"baz": 1}
 
 
 @pytest.mark.parametrize(
     "value,expected",
     [
-        (0, "{'foo': 0}"),
-        ("{'bar': '0'}", "{'foo': \"{'bar': '0'}\"}"),
-        ({"foo": {"bar": "0"}}, "{'foo': {'foo': {'bar': '0'}}}"),
+        (0, {"foo": 0}),
+        (1, {"foo": "1"}),
+        ("{'bar': '0'}", {"foo": "\"{'bar': '0'}\""}),
+        ({"bar": "0"}, {"foo": "{'bar': '0'}"}),
+        ([1, "a"], {"foo": "[1, 'a']"}),
     ],
 )
-@patch("siem.utils.merge_dicts")
-@patch("siem.utils.value_from_nesteddict_by_dottedkey")
-@patch("siem.utils.put_value_into_nesteddict")
-def test_parser_clean_multi_type_field_value_found(
-    MockPutValues,
-    MockValues,
-    MockMerge,
-    MockParser,
-    value,
-    expected,
-):
-    MockValues.return_value = {"foo": value}
-    MockMerge.side_effect = lambda _x, y: y
-    MockPutValues.side_effect = lambda _x, y: y
-    MockParser._LogParser__logdata_dict = {}
+def test_parser_clean_multi_type_field_value_found(MockParser, value, expected):
+    MockParser._LogParser__logdata_dict = {"foo": value}
     MockParser.logconfig = {"json_to_text": "foo"}
     MockParser.clean_multi_type_field()
     assert MockParser._LogParser__logdata_dict == expected
 
 
+def test_parser_clean_multi_type_field_nested_key(MockParser):
+    MockParser._LogParser__logdata_dict = {"a": {"b": [{"c": {"d": 1}}], "x": "y"}}
+    MockParser.logconfig = {"json_to_text": "a.b.0.c"}
+    MockParser.clean_multi_type_field()
+    assert MockParser._LogParser__logdata_dict == {
+        "a": {"b": {"0": {"c": "{'d': 1}"}}, "x": "y"}
+    }
+
+
 def test_parser_transform_to_ecs_no_keys(MockParser):
     data = {"cloud_provider": None, "ecs": "", "ecs_version": "foo", "static_ecs": None}
     MockParser._LogParser__logdata_dict = {}
@@ -1079,26 +1482,85 @@ def test_parser_transform_to_ecs_with_cloud_provider(MockParser):
     }
 
 
-@patch("siem.utils.merge_dicts")
-@patch("siem.utils.value_from_nesteddict_by_dottedkey")
-@patch("siem.utils.put_value_into_nesteddict")
-def test_parser_transform_to_ecs_with_ip_key(
-    MockPutValues, MockValues, MockMerge, MockParser
-):
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("127.0.0.1", {"foo": {"ip": "127.0.0.1"}}),
+        ("::1", {"foo": {"ip": "::1"}}),
+        ("foo", {}),
+    ],
+)
+def test_parser_transform_to_ecs_with_ip_key(MockParser, value, expected):
     data = {
-        "cloud_provider": "foo",
+        "cloud_provider": None,
         "ecs": "foo.ip",
         "ecs_version": "foo",
         "static_ecs": None,
-        "foo.ip": "127.0.0.1",
+        "foo.ip": "bar.addr",
     }
-    MockParser._LogParser__logdata_dict = {}
+    MockParser._LogParser__logdata_dict = {"bar": {"addr": value}}
     MockParser.logconfig = data
-    MockValues.side_effect = lambda _x, y: y
-    MockMerge.side_effect = lambda _x, y: y
-    MockPutValues.side_effect = lambda _x, y: {"ip": y}
     MockParser.transform_to_ecs()
-    assert MockParser._LogParser__logdata_dict == {"ip": "127.0.0.1"}
+    assert MockParser._LogParser__logdata_dict == {
+        "bar": {"addr": value},
+        "ecs": {"version": "foo"},
+        **expected,
+    }
+
+
+def test_parser_enrich_reuses_ip_parsed_in_transform_to_ecs(MockParser):
+    MockParser._LogParser__logdata_dict = {"addr": "1.1.1.1"}
+    MockParser.logconfig = {
+        "cloud_provider": None,
+        "ecs": "source.ip",
+        "ecs_version": "foo",
+        "static_ecs": None,
+        "source.ip": "addr",
+        "geoip": "source",
+    }
+    geodb = MagicMock()
+    geodb.check_ipaddress.return_value = (None, None)
+    MockParser.geodb_instance = geodb
+    MockParser.transform_to_ecs()
+    MockParser.enrich()
+    geodb.check_ipaddress.assert_called_once_with("1.1.1.1", (4, 16843009))
+
+
+def test_parser_transform_to_ecs_first_found_key(MockParser):
+    data = {
+        "cloud_provider": None,
+        "ecs": "event.action user.name",
+        "ecs_version": "foo",
+        "static_ecs": "event.module",
+        "event.module": "bar",
+        "event.action": "a b.0 c",
+        "user.name": "d e",
+    }
+    MockParser._LogParser__logdata_dict = {"a": "", "b": [["x", "y"]], "c": "z"}
+    MockParser.logconfig = data
+    MockParser.transform_to_ecs()
+    assert MockParser._LogParser__logdata_dict == {
+        "a": "",
+        "b": [["x", "y"]],
+        "c": "z",
+        "ecs": {"version": "foo"},
+        "event": {"action": "x, y", "module": "bar"},
+    }
+
+
+def test_parser_transform_to_ecs_with_compiled_plan(MockParser):
+    data = {
+        "cloud_provider": None,
+        "ecs": "event.action",
+        "ecs_version": "foo",
+        "static_ecs": None,
+        "event.action": "a",
+    }
+    MockParser._LogParser__logdata_dict = {"a": "x", "b": "y"}
+    MockParser.logconfig = {**data, "ecs_plan": utils.compile_ecs_plan(data)}
+    MockParser.logconfig["ecs_plan"]["ecs"] = [(("event", "action"), (("b",),), False)]
+    MockParser.transform_to_ecs()
+    assert MockParser._LogParser__logdata_dict["event"] == {"action": "y"}
 
 
 def test_parser_transform_to_ecs_with_account_id_set(MockParser):
@@ -1277,36 +1739,36 @@ def test_parser_transform_by_script_key_not_set(MockParser):
     module.transform.assert_not_called()
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_enrich_handles_key_errors(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_enrich_handles_key_errors(MockParser):
     MockParser.logconfig = {"geoip": "foo bar"}
     MockParser._LogParser__logdata_dict = {"foo": {"ip": "127.0.0.1"}}
     geodb = MagicMock()
     geodb.check_ipaddress.side_effect = [("Foo", "Bar")]
     MockParser.geodb_instance = geodb
     MockParser.enrich()
-    assert MockParser._LogParser__logdata_dict == {"foo": {"as": "Bar", "geo": "Foo"}}
-    geodb.check_ipaddress.assert_has_calls([call("127.0.0.1")])
+    assert MockParser._LogParser__logdata_dict == {
+        "foo": {"ip": "127.0.0.1", "as": "Bar", "geo": "Foo"}
+    }
+    geodb.check_ipaddress.assert_has_calls([call("127.0.0.1", None)])
 
 
-@patch("siem.utils.merge_dicts")
-def test_parser_enrich_handles_just_asn(MockMerge, MockParser):
-    MockMerge.side_effect = lambda _x, y: y
+def test_parser_enrich_handles_just_asn(MockParser):
     MockParser.logconfig = {"geoip": "foo bar"}
     MockParser._LogParser__logdata_dict = {"foo": {"ip": "127.0.0.1"}}
     geodb = MagicMock()
     geodb.check_ipaddress.side_effect = [(None, "Bar")]
     MockParser.geodb_instance = geodb
     MockParser.enrich()
-    assert MockParser._LogParser__logdata_dict == {"foo": {"as": "Bar"}}
-    geodb.check_ipaddress.assert_has_calls([call("127.0.0.1")])
+    assert MockParser._LogParser__logdata_dict == {
+        "foo": {"ip": "127.0.0.1", "as": "Bar"}
+    }
+    geodb.check_ipaddress.assert_has_calls([call("127.0.0.1", None)])
 
 
-@patch("siem.json")
+@patch("siem.utils.json_loads")
 def test_parser_get_log_and_meta_from_firelens_not_populated(MockJson, MockParser):
     data = {"log": "log"}
-    MockJson.loads.return_value = data
+    MockJson.return_value = data
     MockParser.logdata = data
     result_log, result_dic = MockParser.get_log_and_meta_from_firelens()
     assert result_log == "log"
@@ -1320,7 +1782,7 @@ def test_parser_get_log_and_meta_from_firelens_not_populated(MockJson, MockParse
     }
 
 
-@patch("siem.json")
+@patch("siem.utils.json_loads")
 def test_parser_get_log_and_meta_from_firelens(MockJson, MockParser):
     data = {
         "log": "log",
@@ -1332,7 +1794,7 @@ def test_parser_get_log_and_meta_from_firelens(MockJson, MockParser):
         "ecs_task_definition": "ecs_task_definition",
         "ec2_instance_id": "ec2_instance_id",
     }
-    MockJson.loads.return_value = data
+    MockJson.return_value = data
     MockParser.logdata = data
     result_log, result_dic = MockParser.get_log_and_meta_from_firelens()
     assert result_log == "log"
@@ -1496,31 +1958,38 @@ def test_parser_get_timestamp_good_value(MockGet, MockCovert, MockParser):
         ({"a": 1, "b": None}, {"a": 1}),
     ],
 )
-def test_parser_del_none(value, expected, MockParser):
-    assert MockParser.del_none(value) == expected
+def test_parser_finalize_dict_del_none(value, expected, MockParser):
+    assert MockParser.finalize_dict(value) == expected
 
 
-def test_parser_truncate_big_field_too_small(MockParser):
+def test_parser_finalize_dict_truncate_too_small(MockParser):
     data = {"foo": "bar"}
-    result = MockParser.truncate_big_field(data)
+    result = MockParser.finalize_dict(data)
     assert result == {"foo": "bar"}
 
 
-def test_parser_truncate_big_field_nested(MockParser):
+def test_parser_finalize_dict_truncate_nested(MockParser):
     data = {"foo": {"bar": "bazz"}}
-    result = MockParser.truncate_big_field(data)
+    result = MockParser.finalize_dict(data)
     assert result == {"foo": {"bar": "bazz"}}
 
 
-def test_parser_truncate_big_field_but_message(MockParser):
+def test_parser_finalize_dict_truncate_but_message(MockParser):
     data = {"@message": "x" * 32766}
-    result = MockParser.truncate_big_field(data)
+    result = MockParser.finalize_dict(data)
     assert result == {"@message": "x" * 32766}
 
 
-def test_parser_truncate_big_field_not_a_message(MockParser):
+def test_parser_finalize_dict_truncate_not_a_message(MockParser):
     data = {"@foo": "x" * 32766}
     MockParser._LogParser__logdata_dict = {"@id": "@id"}
-    MockParser.logconfig = {"doc_id_suffix": None}
-    result = MockParser.truncate_big_field(data)
+    result = MockParser.finalize_dict(data)
     assert result == {"@foo": "x" * 32753 + "<<TRUNCATED>>"}
+
+
+def test_parser_finalize_dict_truncate_multibyte(MockParser):
+    MockParser._LogParser__logdata_dict = {"@id": "@id"}
+    data = {"foo": {"bar": "あ" * 10923, "baz": "あ" * 10921}, "qux": ""}
+    result = MockParser.finalize_dict(data)
+    # 3 bytes per character and a character is not split
+    assert result == {"foo": {"bar": "あ" * 10917 + "<<TRUNCATED>>", "baz": "あ" * 10921}}
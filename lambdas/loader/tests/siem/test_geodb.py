@@ -1,10 +1,16 @@
 import datetime
+import ipaddress
 import pytest
 import os
 
-from siem import geodb
+from botocore.exceptions import ClientError
+from siem import geodb, utils
+from geoip2.errors import AddressNotFoundError
 from unittest.mock import MagicMock, patch
 
+IP = "1.1.1.1"
+PARSED_IP = utils.parse_ip(IP)
+
 
 @pytest.fixture(scope="session", autouse=True)
 def geoip2_mock():
@@ -36,7 +42,22 @@ def test_check_ipaddress(MockAsn, MockCity):
     db = geodb.GeoDB()
     assert db.check_ipaddress(None) == (None, None)
     assert db.check_ipaddress("") == (None, None)
-    assert db.check_ipaddress("127.0.0.1") == ("city", "asn")
+    assert db.check_ipaddress("1.1.1.1") == ("city", "asn")
+    MockCity.assert_called_with("1.1.1.1", (4, 16843009))
+    assert db.check_ipaddress("1.1.1.1", (4, 16843010)) == ("city", "asn")
+    MockCity.assert_called_with("1.1.1.1", (4, 16843010))
+
+
+@pytest.mark.parametrize(
+    "ip", ["127.0.0.1", "10.0.0.1", "192.168.1.1", "100.64.0.1", "fe80::1", "foo"]
+)
+@patch("siem.geodb.GeoDB._get_geo_city")
+@patch("siem.geodb.GeoDB._get_geo_asn")
+def test_check_ipaddress_reserved_or_invalid(MockAsn, MockCity, ip):
+    db = geodb.GeoDB()
+    assert db.check_ipaddress(ip) == (None, None)
+    MockCity.assert_not_called()
+    MockAsn.assert_not_called()
 
 
 @patch.dict(os.environ, {"GEOIP_BUCKET": "foo"}, clear=True)
@@ -82,37 +103,120 @@ def test_download_geoip_database_local_file_not_found_delete_error(MockOs, MockD
     assert db._download_geoip_database("foo", "bar") == False
 
 
-@patch("siem.geodb.GeoDB._delete_file_older_than_seconds")
-@patch("siem.geodb.os")
-def test_download_geoip_database_local_file_delete_error(MockOs, MockDelete):
-    MockOs.path.isfile.side_effect = [False, True]
-    MockDelete.return_value = False
-    db = geodb.GeoDB()
+@pytest.fixture
+def local_dir(tmp_path):
+    with patch.object(geodb.GeoDB, "LOCAL_DIR", f"{tmp_path}/"):
+        yield tmp_path
+
+
+def test_download_geoip_database_download_success(local_dir):
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {"ETag": '"etag"'}
+    db = geodb.GeoDB(s3_client)
+    assert db._download_geoip_database("foo", "bar") == True
+    s3_client.head_object.assert_called_once_with(Bucket="foo", Key="GeoLite2/bar")
+    s3_client.download_file.assert_called_once_with(
+        "foo", "GeoLite2/bar", f"{local_dir}/bar"
+    )
+    assert (local_dir / "bar.etag").read_text() == '"etag"'
+
+
+def test_download_geoip_database_etag_not_changed(local_dir):
+    (local_dir / "bar").write_text("mmdb")
+    (local_dir / "bar.etag").write_text('"etag"')
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {"ETag": '"etag"'}
+    db = geodb.GeoDB(s3_client)
     assert db._download_geoip_database("foo", "bar") == True
+    s3_client.download_file.assert_not_called()
 
 
-@patch("siem.geodb.os")
-@patch("siem.geodb.boto3")
-def test_download_geoip_database_local_file_download_success(MockBoto, MockOs):
-    MockOs.path.isfile.side_effect = [False, False, False]
-    db = geodb.GeoDB()
+def test_download_geoip_database_etag_changed(local_dir):
+    (local_dir / "bar").write_text("mmdb")
+    (local_dir / "bar.etag").write_text('"old"')
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {"ETag": '"new"'}
+    db = geodb.GeoDB(s3_client)
     assert db._download_geoip_database("foo", "bar") == True
-    MockBoto.resource.Bucket.download_file.assert_called_once
+    s3_client.download_file.assert_called_once()
+    assert (local_dir / "bar.etag").read_text() == '"new"'
 
 
-@patch("siem.geodb.os")
-@patch("siem.geodb.boto3")
-def test_download_geoip_database_local_file_download_failure(MockBoto, MockOs):
-    MockOs.path.isfile.side_effect = [False, False, False]
-    db = geodb.GeoDB()
-    MockBoto.resource.Bucket.download_file.side_effect = Exception("Boom!")
+def test_download_geoip_database_not_found(local_dir):
+    s3_client = MagicMock()
+    s3_client.head_object.side_effect = ClientError(
+        {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+    )
+    db = geodb.GeoDB(s3_client)
+    assert db._download_geoip_database("foo", "bar") == False
+    s3_client.download_file.assert_not_called()
+    assert (local_dir / "not_found_bar").exists()
+    # not found is kept for NOT_FILE_FRESH_DURATION
+    assert db._download_geoip_database("foo", "bar") == False
+    s3_client.head_object.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ClientError({"Error": {"Code": "SlowDown", "Message": ""}}, "HeadObject"),
+        ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadObject"),
+        Exception("Boom!"),
+    ],
+)
+def test_download_geoip_database_uses_local_file_on_error(error, local_dir):
+    (local_dir / "bar").write_text("mmdb")
+    (local_dir / "bar.etag").write_text('"etag"')
+    s3_client = MagicMock()
+    s3_client.head_object.side_effect = error
+    db = geodb.GeoDB(s3_client)
     assert db._download_geoip_database("foo", "bar") == True
-    MockBoto.resource.Bucket.download_file.assert_called_once
+    s3_client.download_file.assert_not_called()
+    assert not (local_dir / "not_found_bar").exists()
+
+
+def test_download_geoip_database_error_without_local_file(local_dir):
+    s3_client = MagicMock()
+    s3_client.head_object.side_effect = Exception("Boom!")
+    db = geodb.GeoDB(s3_client)
+    assert db._download_geoip_database("foo", "bar") == False
+    assert not (local_dir / "not_found_bar").exists()
+    # transient error is retried
+    assert db._download_geoip_database("foo", "bar") == False
+    assert s3_client.head_object.call_count == 2
+
+
+@patch("siem.geodb.GeoDB._get_geoip_buckent_name")
+@patch("siem.geodb.GeoDB._download_geoip_database")
+def test_geodb_reader_opened_lazily(MockDownload, MockBucketName, geoip2_mock):
+    MockDownload.return_value = True
+    MockBucketName.return_value = "foo"
+    geoip2_mock.database.Reader.reset_mock()
+    db = geodb.GeoDB()
+    MockDownload.assert_not_called()
+    reader = db._reader_asn
+    assert db._reader_asn is reader
+    MockDownload.assert_called_once_with("foo", "GeoLite2-ASN.mmdb")
+    geoip2_mock.database.Reader.assert_called_once_with("/tmp/GeoLite2-ASN.mmdb")
+
+
+def test_geodb_reopen_after_fork(geoip2_mock):
+    geoip2_mock.database.Reader.reset_mock()
+    db = geodb.GeoDB()
+    db._readers = {"city": MagicMock(), "asn": None}
+    lock = db._cache_city._lock
+    db.reopen_after_fork()
+    assert db._cache_city._lock is not lock
+    geoip2_mock.database.Reader.assert_called_once_with("/tmp/GeoLite2-City.mmdb")
+    assert db._readers == {
+        "city": geoip2_mock.database.Reader.return_value,
+        "asn": None,
+    }
 
 
 def test_get_geo_city_not_set():
     db = geodb.GeoDB()
-    assert db._get_geo_city("127.0.0.1") == None
+    assert db._get_geo_city(IP, PARSED_IP) == None
 
 
 def test_get_geo_city_exception():
@@ -120,7 +224,7 @@ def test_get_geo_city_exception():
     MockCity.city.side_effect = Exception("Boom!")
     db = geodb.GeoDB()
     db._reader_city = MockCity
-    assert db._get_geo_city("127.0.0.1") == None
+    assert db._get_geo_city(IP, PARSED_IP) == None
 
 
 def test_get_geo_city_full_data():
@@ -130,9 +234,10 @@ def test_get_geo_city_full_data():
     MockCity.city().country.name = "OO"
     MockCity.city().location.longitude = "12"
     MockCity.city().location.latitude = "34"
+    MockCity.city().traits.network = ipaddress.ip_network("1.0.0.0/8")
     db = geodb.GeoDB()
     db._reader_city = MockCity
-    assert db._get_geo_city("127.0.0.1") == {
+    assert db._get_geo_city(IP, PARSED_IP) == {
         "city_name": "Foo",
         "country_iso_code": "FO",
         "country_name": "OO",
@@ -142,7 +247,7 @@ def test_get_geo_city_full_data():
 
 def test_get_geo_asn_not_set():
     db = geodb.GeoDB()
-    assert db._get_geo_asn("127.0.0.1") == None
+    assert db._get_geo_asn(IP, PARSED_IP) == None
 
 
 def test_get_geo_asn_exception():
@@ -150,16 +255,98 @@ def test_get_geo_asn_exception():
     MockAsn.asn.side_effect = Exception("Boom!")
     db = geodb.GeoDB()
     db._reader_asn = MockAsn
-    assert db._get_geo_asn("127.0.0.1") == None
+    assert db._get_geo_asn(IP, PARSED_IP) == None
 
 
 def test_get_geo_asn_full_data():
     MockAsn = MagicMock()
     MockAsn.asn().autonomous_system_number = "Foo"
     MockAsn.asn().autonomous_system_organization = "Bar"
+    MockAsn.asn().network = ipaddress.ip_network("1.0.0.0/8")
     db = geodb.GeoDB()
     db._reader_asn = MockAsn
-    assert db._get_geo_asn("127.0.0.1") == {
+    assert db._get_geo_asn(IP, PARSED_IP) == {
         "number": "Foo",
         "organization": {"name": "Bar"},
     }
+
+
+def test_get_geo_city_cached_by_network():
+    MockCity = MagicMock()
+    MockCity.city().city.name = "Foo"
+    MockCity.city().traits.network = ipaddress.ip_network("1.0.0.0/8")
+    MockCity.city.reset_mock()
+    db = geodb.GeoDB()
+    db._reader_city = MockCity
+    geo = db._get_geo_city(IP, PARSED_IP)
+    assert db._get_geo_city("1.2.3.4", utils.parse_ip("1.2.3.4")) is geo
+    assert MockCity.city.call_count == 1
+    db._get_geo_city("2.0.0.1", utils.parse_ip("2.0.0.1"))
+    assert MockCity.city.call_count == 2
+    assert db.cache_info()["city"] == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_check_ipaddress_returns_copy_of_cache():
+    MockCity = MagicMock()
+    MockCity.city().city.name = "Foo"
+    MockCity.city().location.longitude = None
+    MockCity.city().traits.network = ipaddress.ip_network("1.0.0.0/8")
+    db = geodb.GeoDB()
+    db._reader_city = MockCity
+    geo, _ = db.check_ipaddress(IP)
+    del geo["city_name"]
+    del geo["location"]["lon"]
+    cached, _ = db.check_ipaddress("1.2.3.4")
+    assert cached is not geo
+    assert cached["city_name"] == "Foo"
+    assert cached["location"]["lon"] is None
+
+
+def test_get_geo_asn_not_found_cached_by_host():
+    MockAsn = MagicMock()
+    MockAsn.asn.side_effect = AddressNotFoundError("not found")
+    db = geodb.GeoDB()
+    db._reader_asn = MockAsn
+    assert db._get_geo_asn(IP, PARSED_IP) is None
+    assert db._get_geo_asn(IP, PARSED_IP) is None
+    assert db._get_geo_asn("1.1.1.2", utils.parse_ip("1.1.1.2")) is None
+    assert MockAsn.asn.call_count == 2
+    assert db.cache_info()["asn"] == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_check_ipaddress_invalid_ip():
+    db = geodb.GeoDB()
+    assert db.check_ipaddress("1.2.3") == (None, None)
+
+
+@pytest.mark.parametrize(
+    "network,ip,found",
+    [
+        ("10.0.0.0/8", "10.255.255.255", True),
+        ("10.0.0.0/8", "11.0.0.0", False),
+        ("10.1.2.3/32", "10.1.2.3", True),
+        ("10.1.2.3/32", "10.1.2.4", False),
+        ("2001:db8::/32", "2001:db8:ffff::1", True),
+        ("2001:db8::/32", "2001:db9::1", False),
+        ("0.0.0.0/0", "::1", False),
+    ],
+)
+def test_network_cache_get(network, ip, found):
+    network = ipaddress.ip_network(network)
+    cache = geodb.NetworkCache(10)
+    cache.put(utils.parse_ip(str(network.network_address)), network.prefixlen, "value")
+    assert cache.get(utils.parse_ip(ip)) == (found, "value" if found else None)
+
+
+def test_network_cache_evict_oldest():
+    cache = geodb.NetworkCache(2)
+    cache.put(utils.parse_ip("10.0.0.0"), 8, "a")
+    cache.put(utils.parse_ip("11.0.0.0"), 16, "b")
+    cache.put(utils.parse_ip("11.0.0.0"), 16, "b")
+    cache.put(utils.parse_ip("12.0.0.0"), 24, "c")
+    assert len(cache) == 2
+    assert cache.get(utils.parse_ip("10.0.0.1")) == (False, None)
+    assert cache.get(utils.parse_ip("11.0.0.1")) == (True, "b")
+    assert cache.get(utils.parse_ip("12.0.0.1")) == (True, "c")
+    assert cache._prefixlens == {4: {16: 1, 24: 1}, 6: {}}
+    assert (cache.hits, cache.misses) == (2, 1)
@@ -0,0 +1,120 @@
+import json
+import os
+import pytest
+import sys
+import threading
+import time
+import tracemalloc
+
+from siem import profiler
+from unittest.mock import MagicMock, patch
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    data = []
+    while time.perf_counter() < end:
+        data.append(str(len(data)))
+    return data
+
+
+def test_collapse_stack():
+    def inner():
+        return profiler.collapse_stack(sys._getframe(), {})
+
+    stack = inner().split(";")
+    assert stack[-2].startswith(f"{__name__}:")
+    assert stack[-2].endswith("test_collapse_stack")
+    assert stack[-1].startswith(f"{__name__}:")
+    assert stack[-1].endswith("inner")
+
+
+def test_stack_sampler():
+    thread = threading.Thread(target=busy, args=(0.2,))
+    thread.start()
+    sampler = profiler.StackSampler(thread.ident, interval=0.001).start()
+    thread.join()
+    sampler.stop()
+    assert sum(sampler.stacks.values()) > 0
+    assert any(stack.endswith(":busy") for stack in sampler.stacks)
+
+
+def test_record_profiler_writes_files(tmp_path):
+    with patch.object(profiler, "PROFILE_DIR", str(tmp_path)):
+        with profiler.RecordProfiler("alb", "AWSLogs/../a b.log.gz") as record_profiler:
+            busy(0.1)
+    assert not tracemalloc.is_tracing()
+    path = record_profiler.location
+    assert path.startswith(str(tmp_path / "profile" / "alb" / "AWSLogs" / "a b.log.gz"))
+    with open(f"{path}/stacks.txt") as f:
+        assert ":busy " in f.read()
+    with open(f"{path}/allocations.txt") as f:
+        assert "test_profiler.py" in f.read()
+    with open(f"{path}/summary.json") as f:
+        summary = json.load(f)
+    assert summary["logtype"] == "alb"
+    assert summary["s3_key"] == "AWSLogs/../a b.log.gz"
+    assert summary["samples"] > 0
+    assert summary["error"] is None
+
+
+def test_record_profiler_to_s3(tmp_path):
+    s3_client = MagicMock()
+    with patch.object(profiler, "PROFILE_DIR", str(tmp_path)):
+        with pytest.raises(ValueError):
+            with profiler.RecordProfiler(
+                "alb", "x.log.gz", s3_client, "bucket"
+            ) as record_profiler:
+                raise ValueError("Boom!")
+    assert record_profiler.location.startswith("s3://bucket/profile/alb/x.log.gz/")
+    keys = [c.kwargs["Key"] for c in s3_client.put_object.call_args_list]
+    assert [key.rsplit("/", 1)[1] for key in keys] == [
+        "stacks.txt",
+        "allocations.txt",
+        "summary.json",
+    ]
+    summary = json.loads(s3_client.put_object.call_args_list[2].kwargs["Body"])
+    assert summary["error"] == "ValueError('Boom!')"
+    # uploaded profile is removed from /tmp
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_record_profiler_write_error(tmp_path):
+    s3_client = MagicMock()
+    s3_client.put_object.side_effect = Exception("Boom!")
+    with patch.object(profiler, "PROFILE_DIR", str(tmp_path)):
+        with profiler.RecordProfiler(
+            "alb", "x", s3_client, "bucket"
+        ) as record_profiler:
+            pass
+    assert record_profiler.location is None
+
+
+def test_record_profiler_keeps_last_local_profiles(tmp_path):
+    locations = []
+    with patch.object(profiler, "PROFILE_DIR", str(tmp_path)), patch.object(
+        profiler, "MAX_LOCAL_PROFILES", 2
+    ):
+        for s3key in ["a/x.log", "a/y.log", "b/z.log"]:
+            with profiler.RecordProfiler("alb", s3key) as record_profiler:
+                pass
+            locations.append(record_profiler.location)
+    assert [os.path.isdir(path) for path in locations] == [False, True, True]
+    assert not (tmp_path / "profile" / "alb" / "a" / "x.log").exists()
+
+
+@pytest.mark.parametrize("tracing", [False, True])
+def test_record_profiler_without_reset_peak(tracing, tmp_path, monkeypatch):
+    # tracemalloc.reset_peak doesn't exist on Python 3.8
+    monkeypatch.delattr(tracemalloc, "reset_peak", raising=False)
+    if tracing:
+        tracemalloc.start()
+    try:
+        with patch.object(profiler, "PROFILE_DIR", str(tmp_path)):
+            with profiler.RecordProfiler("alb", "x") as record_profiler:
+                busy(0.1)
+        assert tracemalloc.is_tracing() == tracing
+    finally:
+        tracemalloc.stop()
+    with open(f"{record_profiler.location}/summary.json") as f:
+        assert json.load(f)["traced_memory_peak"] > 0
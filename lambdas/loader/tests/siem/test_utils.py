@@ -1,8 +1,14 @@
+import configparser
+import copy
 import datetime
+import gzip
+import io
+import json
 import logging
 import os
 import pytest
 import re
+from array import array
 from siem import utils
 from unittest.mock import call, MagicMock, mock_open, patch
 
@@ -89,6 +95,117 @@ def test_convert_underscore_field_into_dot_notation():
     assert result == {"foo": {"bar": "baz"}}
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize(
+    "obj",
+    [
+        {"foo": "bar", "baz": [1, 2.5, None, True]},
+        {"foo": "\u3042"},
+        {1: "int key"},
+        {"big": 2 ** 70},
+        {"surrogate": "\ud800"},
+    ],
+)
+def test_json_dumps(obj, use_orjson):
+    with patch("siem.utils.orjson", utils.orjson if use_orjson else None):
+        result = utils.json_dumps(obj)
+    assert isinstance(result, bytes)
+    assert json.loads(result) == json.loads(json.dumps(obj))
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ('{"foo": "bar"}\n', {"foo": "bar"}),
+        ('{"foo": NaN}', {"foo": float("nan")}),
+        ('{"big": 1180591620717411303424}', {"big": 2 ** 70}),
+    ],
+)
+def test_json_loads(text, expected, use_orjson):
+    with patch("siem.utils.orjson", utils.orjson if use_orjson else None):
+        result = utils.json_loads(text)
+    assert json.dumps(result) == json.dumps(expected)
+
+
+def test_json_loads_invalid():
+    with pytest.raises(json.JSONDecodeError):
+        utils.json_loads('{"foo": ')
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("", []),
+        ("  \n", []),
+        ('{"a": 1}\n', [{"a": 1}]),
+        ('{"a": 1}{"b": {"c": 2}}{"d": 3}\n', [{"a": 1}, {"b": {"c": 2}}, {"d": 3}]),
+        ('{"a": "}{"}{"b": 2}', [{"a": "}{"}, {"b": 2}]),
+        ('{"a": 1} {"b": 2}\n', [{"a": 1}, {"b": 2}]),
+        ('[1]{"a": NaN}', [[1], {"a": float("nan")}]),
+        ('{"a": 1}{"b": 1180591620717411303424}', [{"a": 1}, {"b": 2 ** 70}]),
+    ],
+)
+def test_json_loads_values(text, expected, use_orjson):
+    with patch("siem.utils.orjson", utils.orjson if use_orjson else None):
+        result = utils.json_loads_values(text)
+    assert json.dumps(result) == json.dumps(expected)
+
+
+def test_json_loads_values_invalid():
+    with pytest.raises(json.JSONDecodeError):
+        utils.json_loads_values('{"a": 1}{"b": ')
+
+
+def test_json_loads_values_with_source():
+    text = '{"a": 1}{"b": "}{"}\n'
+    assert utils.json_loads_values(text, with_source=True) == [
+        ({"a": 1}, '{"a": 1}'),
+        ({"b": "}{"}, '{"b": "}{"}'),
+    ]
+    assert utils.json_loads_values(' {"a": 1}\n', with_source=True) == [
+        ({"a": 1}, '{"a": 1}')
+    ]
+
+
+def test_json_record():
+    record = utils.JsonRecord({"a": 1}, '{"a":1}')
+    assert record == {"a": 1}
+    assert record.source == '{"a":1}'
+    assert json.loads(utils.json_dumps(record)) == {"a": 1}
+
+
+@pytest.mark.parametrize(
+    "key,value,expected",
+    [
+        ("r", [{"e": 1}, {"e": "]"}], '[{"e": 1}, {"e": "]"}]'),
+        ("r", [0], "[0]"),
+        ("d", {"r": [0]}, '{"r": [0]}'),
+        ("s", "x", None),
+        ("x", 1, None),
+    ],
+)
+def test_json_member_source(key, value, expected):
+    text = '{"d": {"r": [0]}, "s": "\\"r\\": [", "r" : [{"e": 1}, {"e": "]"}]}'
+    assert utils.json_member_source(text, key, value) == expected
+
+
+@pytest.mark.parametrize(
+    "values,expected",
+    [
+        ([{"e": 1}, {"e": "}", "f": [{}]}], ['{"e": 1}', '{"e": "}", "f": [{}]}']),
+        ([{"x": 1}], ['{"x": 1}']),
+        ([{"e": 1}], None),
+        ([{"e": 2}, {"e": "}", "f": [{}]}], None),
+    ],
+)
+def test_json_array_element_sources(values, expected):
+    text = '{"d": {"r": [{"x": 1}]}, "r": [ {"e": 1} , {"e": "}", "f": [{}]} ]}'
+    assert utils.json_array_element_sources(text, "r", values) == expected
+    assert utils.json_array_element_sources('{"r": []}', "r", []) == []
+
+
 def test_get_timestr_from_logdata_dict_no_nanotime_parse():
     data = {"log": {"timestamp": "2021-06-29T12:56:58Z"}}
     result = utils.get_timestr_from_logdata_dict(data, "log.timestamp", False)
@@ -196,6 +313,26 @@ def test_convert_syslog_to_datetime(time, tz, expected):
     assert utils.convert_syslog_to_datetime(time, tz) == expected
 
 
+@pytest.mark.parametrize(
+    "date,reference,expected",
+    [
+        ((6, 29, 12, 56), datetime.datetime(2021, 7, 1, 0, 0), 2021),
+        ((12, 31, 23, 59), datetime.datetime(2021, 1, 1, 0, 0), 2020),
+        # 12 hours ahead of the reference is acceptable
+        ((1, 1, 11, 0), datetime.datetime(2020, 12, 31, 23, 0), 2021),
+        ((1, 1, 11, 1), datetime.datetime(2020, 12, 31, 23, 0), 2020),
+        ((2, 29, 0, 0), datetime.datetime(2021, 3, 1, 0, 0), 2020),
+    ],
+)
+def test_resolve_syslog_year(date, reference, expected):
+    reference_hour = int(reference.replace(tzinfo=datetime.timezone.utc).timestamp())
+    reference_hour = reference_hour // 3600 - 1
+    assert (
+        utils.resolve_syslog_year(*date, datetime.timezone.utc, reference_hour)
+        == expected
+    )
+
+
 @pytest.mark.parametrize(
     "time,expected",
     [
@@ -249,6 +386,71 @@ def test_convert_custom_timeformat_to_datetime(time, format, expected):
     )
 
 
+@pytest.mark.parametrize(
+    "time,format,expected",
+    [
+        (
+            "29/Jun/2021:12:56:58 +0900",
+            "%d/%b/%Y:%H:%M:%S %z",
+            datetime.datetime(
+                2021,
+                6,
+                29,
+                12,
+                56,
+                58,
+                tzinfo=datetime.timezone(datetime.timedelta(hours=9)),
+            ),
+        ),
+        (
+            "29/Jun/2021:12:56:58 -05:30",
+            "%d/%b/%Y:%H:%M:%S %z",
+            datetime.datetime(
+                2021,
+                6,
+                29,
+                12,
+                56,
+                58,
+                tzinfo=datetime.timezone(-datetime.timedelta(hours=5, minutes=30)),
+            ),
+        ),
+        (
+            "20210629 12:56:58",
+            "%Y%m%d %H:%M:%S",
+            datetime.datetime(2021, 6, 29, 12, 56, 58, tzinfo=datetime.timezone.utc),
+        ),
+        (
+            "2021-06-29 12:56:58,12",
+            "%Y-%m-%d %H:%M:%S,%f",
+            datetime.datetime(
+                2021, 6, 29, 12, 56, 58, 120000, tzinfo=datetime.timezone.utc
+            ),
+        ),
+        ("1/Jun/2021:12:56:58 +0900", "%d/%b/%Y:%H:%M:%S %z", None),
+        ("29/JUN/2021:12:56:58 +0900", "%d/%b/%Y:%H:%M:%S %z", None),
+        ("2021-06-31 12:56:58,12", "%Y-%m-%d %H:%M:%S,%f", None),
+        ("2021-06-29 12:56:58,1234567", "%Y-%m-%d %H:%M:%S,%f", None),
+    ],
+)
+def test_timestamp_layout(time, format, expected):
+    layout = utils.TimestampLayout(format)
+    assert layout.parse(time, datetime.timezone.utc) == expected
+    # cached per minute
+    assert layout.parse(time, datetime.timezone.utc) == expected
+    if expected:
+        assert list(layout.minutes) == [time[: layout.prefix_len]]
+
+
+@pytest.mark.parametrize(
+    "format", ["%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S %Z", "%y%m%d %H:%M:%S", "%%%S"]
+)
+def test_timestamp_layout_unsupported_format(format):
+    with pytest.raises(ValueError):
+        utils.TimestampLayout(format)
+    assert utils.get_timestamp_layout(format) is None
+
+
 def test_convert_custom_timeformat_to_datetime_raise_error():
     with pytest.raises(ValueError):
         utils.convert_custom_timeformat_to_datetime(
@@ -256,6 +458,73 @@ def test_convert_custom_timeformat_to_datetime_raise_error():
         )
 
 
+@pytest.mark.parametrize(
+    "rotation,dt,expected,boundaries",
+    [
+        (
+            "daily",
+            datetime.datetime(2021, 6, 29, 12, 56),
+            "-2021-06-29",
+            ((2021, 6, 29), (2021, 6, 30)),
+        ),
+        (
+            "weekly",
+            datetime.datetime(2021, 6, 29, 12, 56),
+            "-2021-w26",
+            ((2021, 6, 28), (2021, 7, 5)),
+        ),
+        (
+            "weekly",
+            datetime.datetime(2020, 12, 31, 12, 56),
+            "-2020-w52",
+            ((2020, 12, 28), (2021, 1, 1)),
+        ),
+        (
+            "monthly",
+            datetime.datetime(2021, 12, 29, 12, 56),
+            "-2021-12",
+            ((2021, 12, 1), (2022, 1, 1)),
+        ),
+        (
+            "annually",
+            datetime.datetime(2021, 6, 29, 12, 56),
+            "-2021",
+            ((2021, 1, 1), (2022, 1, 1)),
+        ),
+    ],
+)
+def test_index_name_resolver(rotation, dt, expected, boundaries):
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    resolver = utils.IndexNameResolver(rotation, tz)
+    dt = dt.replace(tzinfo=tz)
+    assert resolver.resolve("log-foo", dt) == "log-foo" + expected
+    start, end = boundaries
+    assert resolver.bucket[1:] == (
+        datetime.datetime(*start, tzinfo=tz).timestamp(),
+        datetime.datetime(*end, tzinfo=tz).timestamp(),
+        expected,
+    )
+    # in the same bucket
+    with patch.object(resolver, "get_bucket_boundaries") as MockBoundaries:
+        assert resolver.resolve("log-bar", dt) == "log-bar" + expected
+        MockBoundaries.assert_not_called()
+
+
+def test_index_name_resolver_index_tz():
+    resolver = utils.IndexNameResolver("daily", datetime.timezone.utc)
+    dt = datetime.datetime(
+        2021, 6, 30, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=9))
+    )
+    assert resolver.resolve("log-foo", dt) == "log-foo-2021-06-29"
+    resolver = utils.IndexNameResolver("daily")
+    assert resolver.resolve("log-foo", dt) == "log-foo-2021-06-30"
+    # the same instant in another timezone is not in the bucket
+    assert (
+        resolver.resolve("log-foo", dt.astimezone(datetime.timezone.utc))
+        == "log-foo-2021-06-29"
+    )
+
+
 @patch.dict(os.environ, {"ES_ENDPOINT": "foo"}, clear=True)
 def test_get_es_hostname_with_os_var():
     assert utils.get_es_hostname() == "foo"
@@ -305,6 +574,123 @@ def test_get_logtype_from_s3key_match():
     )
 
 
+@pytest.mark.parametrize(
+    "pattern,expected",
+    [
+        ("CloudTrail", "CloudTrail"),
+        (
+            r"elasticloadbalancing_.*T\d{4}Z_[0-9a-z]{8}\.log\.gz$",
+            "elasticloadbalancing_",
+        ),
+        (r"/20\d{2}-[01]\d-\d{2}", "/20"),
+        (r"(^|\/)[0-9A-Z]{13,14}\.20\d{2}-\d{2}", ".20"),
+        ("(MySQL|mysql).*(audit)", ""),
+        ("/[Ll]inux.*[Ss]ecure", "ecure"),
+        ("abc?d", "ab"),
+        ("abcd*", "abc"),
+        ("abc{0,2}d", "ab"),
+        ("ab+cde", "cde"),
+        ("foo|bar", ""),
+        (r"a\(b\)", "a(b)"),
+        ("", ""),
+        (r"ab\x41cdef", "cdef"),
+        (r"abcd\x41ef", "abcd"),
+        (r"ab\u0041cdef", "cdef"),
+        (r"ab\U00000041cdef", "cdef"),
+        (r"ab\N{LATIN CAPITAL LETTER A}cdef", "cdef"),
+        (r"ab\101cdef", "cdef"),
+        (r"ab\0cdef", "cdef"),
+        (r"(ab)\1cdef", "cdef"),
+        (r"abc\x41?", "abc"),
+        (r"[]x]abcd", "abcd"),
+        (r"ab[^]]cdef", "cdef"),
+        (r"(a[)])bcd", "bcd"),
+        (r"(a[)]\))bcd", "bcd"),
+        (r"ab[\]]cdef", "cdef"),
+        (r"(?#x)abc", ""),
+    ],
+)
+def test_extract_required_literal(pattern, expected):
+    assert utils.extract_required_literal(pattern) == expected
+
+
+@pytest.mark.parametrize(
+    "pattern,text",
+    [(r"[]x]Agent", "xAgent"), (r"[^]]Agent", "xAgent"), (r"(a[)])Agent", "a)Agent")],
+)
+def test_character_classes_with_bracket_are_not_skipped(pattern, text):
+    router = utils.LogtypeRouter({"foo": re.compile(pattern)})
+    assert router.get_logtype(text) == "foo"
+    excluder = utils.compile_exclude_log_patterns({"foo": {"ua": re.compile(pattern)}})
+    assert excluder["foo"].match({"ua": text}, raw=text) == (True, f"{{ua: {text}}}")
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [r"\x41", r"\u0041", r"\U00000041", r"\N{LATIN CAPITAL LETTER A}", r"\101"],
+)
+def test_escapes_are_not_required_literal(pattern):
+    router = utils.LogtypeRouter({"foo": re.compile(pattern + "BC")})
+    assert router.get_logtype("ABC") == "foo"
+    excluder = utils.LogExcluder({"a": re.compile(pattern + "BC")})
+    assert excluder.match({"a": "ABC"}, raw="ABC") == (True, "{a: ABC}")
+
+
+def test_logtype_router_same_as_loop():
+    etl_config = utils.parse_etl_config()
+    logtype_s3key_dict = utils.create_logtype_s3key_dict(etl_config)
+    router = utils.LogtypeRouter(logtype_s3key_dict)
+    s3keys = [
+        "AWSLogs/123456789012/CloudTrail/us-east-1/2021/01/01/"
+        "123456789012_CloudTrail_us-east-1_20210101T0000Z_abc.json.gz",
+        "AWSLogs/123456789012/elasticloadbalancing/us-east-1/2021/01/01/"
+        "123456789012_elasticloadbalancing_us-east-1_app.lb.1234_"
+        "20210101T0000Z_10.0.0.1_abcdefgh.log.gz",
+        "logs/2021-01-01-00-00-00-0123456789ABCDEF",
+        "cf/E2ABCDEFGHIJK.2021-01-01-00.abcdef12.gz",
+        "rds/MySQL/audit/log.gz",
+        "ec2/Linux/secure.gz",
+        "ec2/linux/messages.gz",
+        "unknown/key.gz",
+    ]
+    for s3key in s3keys:
+        assert router.get_logtype(s3key) == utils.get_logtype_from_s3key(
+            s3key, logtype_s3key_dict
+        )
+    assert router.get_logtype("unknown/key.gz") == "unknown"
+    assert router.get_logtype.cache_info().currsize == len(s3keys)
+
+
+def test_logtype_router_ignorecase():
+    router = utils.LogtypeRouter({"foo": re.compile("(?i)foo")})
+    assert router.get_logtype("FOO/bar") == "foo"
+
+
+def test_logtype_router_find_ambiguous_logtypes():
+    router = utils.LogtypeRouter(
+        {
+            "cloudtrail": re.compile("CloudTrail"),
+            "cloudtrail-insight": re.compile("CloudTrail-Insight"),
+            "linux": re.compile("/[Ll]inux/"),
+            "linux2": re.compile("/[Ll]inux/"),
+            "waf": re.compile("aws-waf-logs-"),
+        }
+    )
+    assert router.find_ambiguous_logtypes() == [
+        ("cloudtrail-insight", "cloudtrail"),
+        ("linux2", "linux"),
+    ]
+
+
+def test_create_logtype_router_warns_ambiguous_logtypes(caplog):
+    router = utils.create_logtype_router(
+        {"foo": re.compile("foo"), "foobar": re.compile("foobar")}
+    )
+    assert utils.get_logtype_from_s3key("foobar/baz", router) == "foo"
+    assert utils.get_logtype_from_s3key("foobar/", router) == "nodata"
+    assert "s3_key of foobar is also matched by s3_key of foo" in caplog.text
+
+
 def test_sqs_queue_no_url():
     assert utils.sqs_queue(None) == None
 
@@ -322,6 +708,44 @@ def test_sqs_queue_fails_connection(MockBoto):
         utils.sqs_queue("foo")
 
 
+@pytest.mark.parametrize(
+    "cpu_max,expected",
+    [("max 100000\n", 8), ("200000 100000\n", 2), ("150000 100000\n", 1)],
+)
+def test_get_cpu_limit_cgroup_v2(tmp_path, cpu_max, expected):
+    (tmp_path / "cpu.max").write_text(cpu_max)
+    with patch("siem.utils.CGROUP_CPU_MAX", str(tmp_path / "cpu.max")):
+        with patch("siem.utils.os.sched_getaffinity", return_value=set(range(8))):
+            assert utils.get_cpu_limit() == expected
+
+
+@pytest.mark.parametrize("quota,expected", [("-1", 8), ("300000", 3)])
+def test_get_cpu_limit_cgroup_v1(tmp_path, quota, expected):
+    (tmp_path / "cpu.cfs_quota_us").write_text(quota)
+    (tmp_path / "cpu.cfs_period_us").write_text("100000")
+    with patch("siem.utils.CGROUP_CPU_MAX", str(tmp_path / "cpu.max")), patch(
+        "siem.utils.CGROUP_CPU_CFS_QUOTA", str(tmp_path / "cpu.cfs_quota_us")
+    ), patch("siem.utils.CGROUP_CPU_CFS_PERIOD", str(tmp_path / "cpu.cfs_period_us")):
+        with patch("siem.utils.os.sched_getaffinity", return_value=set(range(8))):
+            assert utils.get_cpu_limit() == expected
+
+
+def test_write_dead_letters_to_s3():
+    s3_client = MagicMock()
+    path = utils.write_dead_letters(
+        [(b'{"index": {}}\n{"a": 1}\n', {"type": "foo"})], s3_client, "bucket"
+    )
+    s3_client.put_object.assert_called_once()
+    key = s3_client.put_object.call_args.kwargs["Key"]
+    assert key.startswith("dead_letter/")
+    assert path == f"s3://bucket/{key}"
+    body = gzip.decompress(s3_client.put_object.call_args.kwargs["Body"])
+    assert json.loads(body) == {
+        "error": {"type": "foo"},
+        "entry": '{"index": {}}\n{"a": 1}\n',
+    }
+
+
 @patch("siem.utils.boto3")
 @patch("siem.utils.AWS4Auth")
 @patch("siem.utils.Elasticsearch")
@@ -409,6 +833,74 @@ def test_get_etl_config(MockTimeStr, MockConfigParser):
     MockTimeStr.assert_has_calls([call("foo"), call("bar")])
 
 
+def test_hash_etl_config_files(tmp_path):
+    ini = tmp_path / "a.ini"
+    missing = str(tmp_path / "b.ini")
+    ini.write_text("[DEFAULT]\nfoo = 1\n")
+    config_hash = utils.hash_etl_config_files((str(ini), missing))
+    assert config_hash == utils.hash_etl_config_files((str(ini), missing))
+    ini.write_text("[DEFAULT]\nfoo = 2\n")
+    assert config_hash != utils.hash_etl_config_files((str(ini), missing))
+
+
+def _etl_config(text):
+    etl_config = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation()
+    )
+    etl_config.read_string(text)
+    return etl_config
+
+
+def test_etl_config_artifact(tmp_path):
+    etl_config = _etl_config(
+        "[DEFAULT]\ndoc_id = foo\nindex_name = log-${name}\nname = default\n"
+        "[cloudtrail]\nname = aws\ns3_key = CloudTrail/\nvia_cwl = False\n"
+    )
+    artifact = utils.create_etl_config_artifact(etl_config, "hash")
+    assert artifact["sections"]["cloudtrail"]["index_name"] == "log-aws"
+    filename = tmp_path / "etl_config.json"
+    filename.write_bytes(utils.json_dumps(artifact))
+    loaded = utils.load_etl_config_artifact(str(filename), "hash")
+    assert loaded.sections() == ["cloudtrail"]
+    assert dict(loaded["DEFAULT"]) == dict(etl_config["DEFAULT"])
+    assert dict(loaded["cloudtrail"]) == dict(etl_config["cloudtrail"])
+    assert loaded["cloudtrail"].getboolean("via_cwl") is False
+
+
+def test_etl_config_artifact_invalid_regex():
+    etl_config = _etl_config("[DEFAULT]\ndoc_id = foo\n[foo]\nlog_pattern = [a-z\n")
+    with pytest.raises(Exception, match="invalid regex pattern for log_pattern"):
+        utils.create_etl_config_artifact(etl_config, "hash")
+
+
+def test_load_etl_config_artifact_not_used(tmp_path):
+    filename = tmp_path / "etl_config.json"
+    assert utils.load_etl_config_artifact(str(filename), "hash") is None
+    filename.write_text('{"hash": "old", "sections": {}}')
+    assert utils.load_etl_config_artifact(str(filename), "hash") is None
+    filename.write_text("{")
+    assert utils.load_etl_config_artifact(str(filename), "hash") is None
+
+
+@patch("siem.utils.parse_etl_config")
+@patch("siem.utils.load_etl_config_artifact")
+def test_get_etl_config_from_artifact(MockLoad, MockParse):
+    assert utils.get_etl_config() == MockLoad.return_value
+    MockParse.assert_not_called()
+    MockLoad.return_value = None
+    assert utils.get_etl_config() == MockParse.return_value
+
+
+def test_write_etl_config_artifact(tmp_path):
+    filename = str(tmp_path / "etl_config.json")
+    assert utils.write_etl_config_artifact(filename) == filename
+    etl_config = utils.load_etl_config_artifact(filename, utils.hash_etl_config_files())
+    parsed = utils.parse_etl_config()
+    assert etl_config.sections() == parsed.sections()
+    for section in parsed:
+        assert dict(etl_config[section]) == dict(parsed[section])
+
+
 @patch("siem.utils.importlib")
 def test_load_modules_on_memory_no_script(MockImport):
     utils.load_modules_on_memory({"foo": {}}, [])
@@ -439,6 +931,12 @@ def test_load_sf_module_no_script(MockImport):
     MockImport.assert_not_called()
 
 
+@patch("siem.utils.importlib")
+def test_load_sf_module_empty_script(MockImport):
+    assert utils.load_sf_module({}, {"script_ecs": ""}, []) == None
+    MockImport.assert_not_called()
+
+
 @patch("siem.utils.importlib")
 def test_load_sf_module_mod(MockImport):
     logfile = MagicMock()
@@ -496,9 +994,8 @@ def test_get_exclude_log_patterns_csv_filename_os_geoip(MockBoto, MockOs):
     MockOs.environ.__contains__.return_value = True
     MockOs.environ.get.return_value = "bucket"
     assert utils.get_exclude_log_patterns_csv_filename(config) == "/tmp/filename"
-    MockBoto.resource().Bucket.assert_called_once_with("bucket")
-    MockBoto.resource().Bucket().download_file.assert_called_once_with(
-        "filename", "/tmp/filename"
+    MockBoto.client().download_file.assert_called_once_with(
+        "bucket", "filename", "/tmp/filename"
     )
 
 
@@ -518,9 +1015,8 @@ def test_get_exclude_log_patterns_csv_filename_config_geoip(
     MockConfigParser.ConfigParser.return_value = result
 
     assert utils.get_exclude_log_patterns_csv_filename(config) == "/tmp/filename"
-    MockBoto.resource().Bucket.assert_called_once_with("bucket")
-    MockBoto.resource().Bucket().download_file.assert_called_once_with(
-        "filename", "/tmp/filename"
+    MockBoto.client().download_file.assert_called_once_with(
+        "bucket", "filename", "/tmp/filename"
     )
 
 
@@ -539,8 +1035,7 @@ def test_get_exclude_log_patterns_csv_filename_config_none(
     MockConfigParser.ConfigParser.return_value = result
 
     assert utils.get_exclude_log_patterns_csv_filename(config) == None
-    MockBoto.resource().Bucket.assert_not_called()
-    MockBoto.resource().Bucket().download_file.assert_not_called()
+    MockBoto.client().download_file.assert_not_called()
 
 
 @patch("siem.utils.os")
@@ -550,10 +1045,28 @@ def test_get_exclude_log_patterns_csv_filename_os_exception(MockBoto, MockOs):
     config.__getitem__.return_value.get.return_value = "filename"
     MockOs.environ.__contains__.return_value = True
     MockOs.environ.get.return_value = "bucket"
-    MockBoto.resource().Bucket().download_file.side_effect = Exception("Boom!")
+    MockBoto.client().download_file.side_effect = Exception("Boom!")
     assert utils.get_exclude_log_patterns_csv_filename(config) == None
 
 
+@patch("siem.utils.os")
+@patch("siem.utils.boto3")
+def test_get_exclude_log_patterns_csv_filename_with_s3_client(MockBoto, MockOs):
+    config = MagicMock()
+    config.__getitem__.return_value.get.return_value = "filename"
+    MockOs.environ.__contains__.return_value = True
+    MockOs.environ.get.return_value = "bucket"
+    s3_client = MagicMock()
+    assert (
+        utils.get_exclude_log_patterns_csv_filename(config, s3_client)
+        == "/tmp/filename"
+    )
+    s3_client.download_file.assert_called_once_with(
+        "bucket", "filename", "/tmp/filename"
+    )
+    MockBoto.client.assert_not_called()
+
+
 def test_merge_dotted_key_value_into_dict():
     result = utils.merge_dotted_key_value_into_dict(None, "foo.bar.baz", "quxx")
     assert result == {"foo": {"bar": {"baz": "quxx"}}}
@@ -605,6 +1118,18 @@ def test_merge_csv_into_log_patterns_non_text_pattern(MockMergeDotted, MockCsv):
         MockMergeDotted.assert_called_with({}, "bar", re.compile("foo$"))
 
 
+@patch("siem.utils.csv")
+def test_merge_csv_into_log_patterns_raw_pattern(MockCsv):
+    with patch("builtins.open", mock_open(read_data="data")):
+        MockCsv.DictReader.return_value = [
+            {"field": "", "log_type": "foo", "pattern_type": "raw", "pattern": "a"},
+            {"field": "", "log_type": "foo", "pattern_type": "RAW", "pattern": "b"},
+        ]
+        assert utils.merge_csv_into_log_patterns({}, "foo.csv") == {
+            "foo": {utils.RAW_PATTERNS_KEY: [re.compile("a"), re.compile("b")]}
+        }
+
+
 @patch("siem.utils.botocore")
 def test_make_s3_session_config_with_user_agent(MockBoto):
     config = MagicMock()
@@ -660,6 +1185,138 @@ def test_get_mime_type(data, expected):
     assert utils.get_mime_type(data) == expected
 
 
+@patch("siem.utils.DECOMPRESS_CHUNK_SIZE", 3)
+def test_iter_decompressed_chunks_gzip():
+    data = gzip.compress(b"abcdefgh") + gzip.compress(b"ijkl")
+    body = io.BytesIO(data[2:])
+    chunks = utils.iter_decompressed_chunks(body, "gzip", data[:2])
+    assert b"".join(chunks) == b"abcdefghijkl"
+
+
+@patch("siem.utils.DECOMPRESS_CHUNK_SIZE", 5)
+def test_iter_decompressed_chunks_gzip_members():
+    member1 = gzip.compress(b"abcdefgh")
+    member2 = gzip.compress(b"ijkl")
+    data = member1 + b"\x00\x00" + member2
+    members = []
+    chunks = utils.iter_decompressed_chunks(io.BytesIO(data), "gzip", b"", members)
+    assert b"".join(chunks) == b"abcdefghijkl"
+    assert members == [(0, 0), (len(member1) + 2, 8)]
+    resumed = utils.iter_decompressed_chunks(io.BytesIO(data[members[1][0] :]), "gzip")
+    assert b"".join(resumed) == b"ijkl"
+
+
+@pytest.mark.parametrize(
+    "start,end,expected",
+    [
+        (0, 9, [b"abc", b"def", b"ghi"]),
+        (1, 5, [b"bc", b"de"]),
+        (3, 6, [b"def"]),
+        (4, 4, []),
+        (7, 20, [b"hi"]),
+    ],
+)
+def test_slice_chunks(start, end, expected):
+    chunks = iter([b"abc", b"def", b"ghi"])
+    assert list(utils.slice_chunks(chunks, start, end)) == expected
+
+
+def test_iter_decompressed_chunks_text():
+    body = io.BytesIO(b"cdef")
+    chunks = utils.iter_decompressed_chunks(body, "text", b"ab")
+    assert b"".join(chunks) == b"abcdef"
+
+
+def test_iter_decompressed_chunks_unknown():
+    with pytest.raises(ValueError):
+        list(utils.iter_decompressed_chunks(io.BytesIO(b""), "binary"))
+
+
+def test_stage_timer_exclusive():
+    timer = utils.StageTimer()
+    with patch("siem.utils.time.perf_counter", side_effect=[0.0, 1.0, 3.0, 10.0]):
+        with timer.measure("outer"):
+            with timer.measure("inner"):
+                pass
+    assert timer.durations == {"inner": 2.0, "outer": 8.0}
+    assert timer.total == 10.0
+
+
+def test_stage_timer_merge_and_reset():
+    timer = utils.StageTimer()
+    timer.add("parse", 1.0)
+    timer.merge({"parse": 2.0, "geoip": 0.5})
+    assert timer.durations == {"parse": 3.0, "geoip": 0.5}
+    # durations of other processes are not subtracted from enclosing stages
+    assert timer.total == 1.0
+    timer.reset()
+    assert timer.durations == {}
+    assert timer.total == 0.0
+
+
+def test_timed_reader():
+    timer = utils.StageTimer()
+    reader = utils.TimedReader(io.BytesIO(b"abcdef"), timer, "download")
+    assert reader.read(2) == b"ab"
+    assert reader.read() == b"cdef"
+    assert set(timer.durations) == {"download"}
+    reader.close()
+    assert reader.raw.closed
+
+
+def test_spool_chunks_in_memory():
+    spool = utils.spool_chunks([b"abc", b"def"], max_memory_size=10)
+    assert isinstance(spool, io.BytesIO)
+    assert spool.read() == b"abcdef"
+
+
+@pytest.mark.parametrize(
+    "chunks,expected",
+    [
+        ([], [0]),
+        ([b"a\nbc", b"\n\nd"], [0, 2, 5, 6, 7]),
+        ([b"a\n", b"b\n"], [0, 2, 4]),
+    ],
+)
+def test_spool_chunks_line_offsets(chunks, expected):
+    line_offsets = array("Q", [0])
+    utils.spool_chunks(chunks, line_offsets=line_offsets)
+    assert list(line_offsets) == expected
+
+
+@patch("siem.utils.has_spool_space", return_value=True)
+def test_spool_chunks_spill_to_file(_MockHasSpace):
+    spool = utils.spool_chunks([b"abc", b"def", b"ghi"], max_memory_size=4)
+    assert not isinstance(spool, io.BytesIO)
+    assert spool.tell() == 0
+    assert spool.read() == b"abcdefghi"
+
+
+@patch("siem.utils.has_spool_space", return_value=False)
+def test_spool_chunks_kept_in_memory_without_space(MockHasSpace):
+    spool = utils.spool_chunks([b"abc", b"def", b"ghi"], max_memory_size=4)
+    assert isinstance(spool, io.BytesIO)
+    assert spool.read() == b"abcdefghi"
+    MockHasSpace.assert_called_once_with(6)
+
+
+@patch("siem.utils.has_spool_space", side_effect=[True, False])
+def test_spool_chunks_moved_back_to_memory(MockHasSpace):
+    spool = utils.spool_chunks([b"abc", b"def", b"ghi", b"jkl"], max_memory_size=4)
+    assert isinstance(spool, io.BytesIO)
+    assert spool.tell() == 0
+    assert spool.read() == b"abcdefghijkl"
+    assert MockHasSpace.call_args_list == [call(6), call(3)]
+
+
+@pytest.mark.parametrize("free,expected", [(10 + 100, True), (10 + 99, False)])
+def test_has_spool_space(free, expected):
+    with patch("siem.utils.SPOOL_MIN_FREE_SPACE", 100), patch(
+        "siem.utils.shutil.disk_usage", return_value=MagicMock(free=free)
+    ):
+        assert utils.has_spool_space(10) == expected
+
+
 @pytest.mark.parametrize(
     "data,key,expected",
     [
@@ -705,6 +1362,138 @@ def test_put_value_into_nesteddict(key, value, expected):
     assert utils.put_value_into_nesteddict(key, value) == expected
 
 
+@pytest.mark.parametrize(
+    "ip,expected",
+    [
+        ("192.0.2.1", (4, 3221225985)),
+        ("0.0.0.0", (4, 0)),
+        ("::1", (6, 1)),
+        ("2001:db8::", (6, 0x20010DB8 << 96)),
+        ("::ffff:192.0.2.1", (6, 0xFFFF << 32 | 3221225985)),
+        ("192.0.2", None),
+        ("192.0.2.256", None),
+        ("01.2.3.4", None),
+        (" 192.0.2.1", None),
+        ("192.0.2.1\x00", None),
+        ("foo", None),
+        ("", None),
+        (None, None),
+        (3221225985, None),
+    ],
+)
+def test_parse_ip(ip, expected):
+    assert utils.parse_ip(ip) == expected
+
+
+@pytest.mark.parametrize(
+    "ip,expected",
+    [
+        ("0.0.0.0", True),
+        ("9.255.255.255", False),
+        ("10.0.0.0", True),
+        ("10.255.255.255", True),
+        ("11.0.0.0", False),
+        ("100.64.0.1", True),
+        ("100.128.0.1", False),
+        ("172.31.255.255", True),
+        ("172.32.0.0", False),
+        ("192.168.10.1", True),
+        ("203.0.113.1", True),
+        ("255.255.255.255", True),
+        ("8.8.8.8", False),
+        ("::", True),
+        ("::1", True),
+        ("::2", False),
+        ("fd12:3456::1", True),
+        ("fe80::1", True),
+        ("2600:1f18::1", False),
+    ],
+)
+def test_is_reserved_ip(ip, expected):
+    assert utils.is_reserved_ip(utils.parse_ip(ip)) is expected
+
+
+@pytest.mark.parametrize(
+    "data,keys,expected",
+    [
+        ({"a": {"b": [{"c": 123}]}}, ("a", "b", 0, "c"), 123),
+        ({"a": {"b": [{"c": 123}]}}, ("a", "b", 1, "c"), None),
+        ({"a": {"b": "c"}}, ("a", "b", "c"), None),
+        ({"a": {"0": "c"}}, ("a", 0), None),
+        ({"a": ""}, ("a",), None),
+    ],
+)
+def test_value_from_nesteddict_by_keys(data, keys, expected):
+    assert utils.value_from_nesteddict_by_keys(data, keys) == expected
+
+
+@pytest.mark.parametrize(
+    "data,key,value",
+    [
+        ({}, "a.b.c", "123"),
+        ({"a": {"x": 1}}, "a.b", "123"),
+        ({"a": "x"}, "a.b", "123"),
+        ({"a": {"b": {"x": 1}}}, "a.b", {"y": 2}),
+        ({"a": {"b": {"x": 1}}}, "a.b", "123"),
+    ],
+)
+def test_merge_value_into_nesteddict(data, key, value):
+    expected = utils.merge_dicts(
+        copy.deepcopy(data), utils.put_value_into_nesteddict(key, value)
+    )
+    utils.merge_value_into_nesteddict(data, tuple(key.split(".")), value)
+    assert data == expected
+
+
+@pytest.mark.parametrize(
+    "data,key,value",
+    [
+        ({}, "a.b.c", 123),
+        ({"a": {"x": 1}}, "a.b", [1, 2]),
+        ({"a": "x"}, "a.b", None),
+        ({"a": {"b": {"x": 1}}}, "a.b", {"y": 2}),
+    ],
+)
+def test_merge_value_into_nesteddict_by_dottedkey(data, key, value):
+    expected = utils.merge_dicts(
+        copy.deepcopy(data), utils.put_value_into_nesteddict(key, value)
+    )
+    assert utils.merge_value_into_nesteddict_by_dottedkey(data, key, value) is data
+    assert data == expected
+
+
+def test_compile_ecs_plan():
+    logconfig = {
+        "ecs": "source.ip event.action",
+        "source.ip": "sourceIPAddress",
+        "event.action": "eventName a.0.b",
+        "static_ecs": "event.kind",
+        "event.kind": ["event", "alert"],
+        "json_to_text": "requestParameters.filter",
+        "geoip": "source destination",
+    }
+    assert utils.compile_ecs_plan(logconfig) == {
+        "ecs": [
+            (("source", "ip"), (("sourceIPAddress",),), True),
+            (("event", "action"), (("eventName",), ("a", 0, "b")), False),
+        ],
+        "static_ecs": [(("event", "kind"), "event, alert")],
+        "json_to_text": [
+            (("requestParameters", "filter"), ("requestParameters", "filter"))
+        ],
+        "geoip": ["source", "destination"],
+    }
+
+
+def test_compile_ecs_plan_empty():
+    assert utils.compile_ecs_plan({"ecs": "", "static_ecs": None}) == {
+        "ecs": [],
+        "static_ecs": [],
+        "json_to_text": [],
+        "geoip": [],
+    }
+
+
 @pytest.mark.parametrize(
     "input,expected",
     [
@@ -740,6 +1529,87 @@ def test_match_log_with_exclude_patterns(dict, expected):
     assert utils.match_log_with_exclude_patterns(dict, patterns) == expected
 
 
+@pytest.mark.parametrize(
+    "dict,expected",
+    [
+        ({"x": {"y": {"z": 222}}, "a": 111}, (True, "{a: 111}")),
+        ({"x": {"y": {"z": 111}}, "a": 222}, (True, "{z: 111}")),
+        ({"l": [111], "a": 111}, (True, "{a: 111}")),
+        ({"x": "111", "a": "a111"}, (False, None)),
+    ],
+)
+def test_match_log_with_exclude_patterns_checks_siblings(dict, expected):
+    patterns = {
+        "x": {"y": {"z": re.compile("^111$")}},
+        "l": re.compile("^111$"),
+        "a": re.compile("^111$"),
+    }
+    assert utils.match_log_with_exclude_patterns(dict, patterns) == expected
+    excluder = utils.LogExcluder(patterns)
+    assert excluder.match(dict) == expected
+
+
+@pytest.mark.parametrize(
+    "log_dict,expected",
+    [
+        (
+            {"userAgent": "[AesSiemEsLoader/2.3.2]"},
+            (True, "{userAgent: [AesSiemEsLoader/2.3.2]}"),
+        ),
+        ({"userAgent": "aws-cli"}, (False, None)),
+        ({"userAgent": "aws-cli\nAesSiemEsLoader"}, (False, None)),
+        (
+            {"eventSource": "athena.amazonaws.com"},
+            (True, "{eventSource: athena.amazonaws.com}"),
+        ),
+        ({"eventSource": "athena.amazonaws.com.x"}, (False, None)),
+        (
+            {"userIdentity": {"invokedBy": "ec2.amazonaws.com"}},
+            (True, "{invokedBy: ec2.amazonaws.com}"),
+        ),
+        ({"userIdentity": "ec2.amazonaws.com"}, (False, None)),
+    ],
+)
+def test_log_excluder_match(log_dict, expected):
+    patterns = {
+        "userAgent": re.compile(".*" + re.escape("AesSiemEsLoader") + ".*"),
+        "eventSource": re.compile(re.escape("athena.amazonaws.com") + "$"),
+        "userIdentity": {"invokedBy": re.compile(r".*\.amazonaws.com$")},
+    }
+    excluder = utils.LogExcluder(patterns)
+    assert [literal for _, _, literal in excluder.rules] == [
+        "AesSiemEsLoader",
+        "athena.amazonaws.com",
+        ".amazonaws",
+    ]
+    assert excluder.match(log_dict) == expected
+    assert utils.match_log_with_exclude_patterns(log_dict, patterns) == expected
+
+
+def test_log_excluder_match_with_raw():
+    excluder = utils.LogExcluder({"a": re.compile(".*foo.*"), "b": re.compile("bar$")})
+    assert excluder.match({"a": "xfoo"}, raw="xfoo") == (True, "{a: xfoo}")
+    # no literal in raw log. rules are not evaluated
+    assert excluder.match({"a": "xfoo"}, raw="baz") == (False, None)
+    excluder = utils.LogExcluder({"a": re.compile(".*foo.*"), "b": re.compile("[ab]$")})
+    assert excluder.literals is None
+    assert excluder.match({"a": "xfoo"}, raw="baz") == (True, "{a: xfoo}")
+
+
+def test_log_excluder_match_raw():
+    excluder = utils.LogExcluder(
+        {utils.RAW_PATTERNS_KEY: [re.compile('"foo":"ba[rz]"')]}
+    )
+    assert excluder.rules == []
+    assert excluder.match_raw('{"foo":"baz"}') == (True, '{@raw: "foo":"ba[rz]"}')
+    assert excluder.match_raw('{"foo":"qux"}') == (False, None)
+
+
+def test_compile_exclude_log_patterns():
+    compiled = utils.compile_exclude_log_patterns({"foo": {"a": re.compile("b")}})
+    assert isinstance(compiled["foo"], utils.LogExcluder)
+
+
 @pytest.mark.parametrize(
     "dicta,dictb,expected",
     [
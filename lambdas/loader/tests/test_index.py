@@ -1,6 +1,8 @@
+import json
 import logging
 import pytest
 import re
+import threading
 import time
 
 
@@ -21,7 +23,11 @@ with patch("siem.utils") as MockUtils:
             etl_config.getboolean.return_value = "bar"
             etl_config.getint.return_value = "bar"
 
+            default_config = MagicMock()
+            default_config.getint.return_value = 1
+
             MockUtils.get_etl_config.return_value = {
+                "DEFAULT": default_config,
                 "Bool": etl_config,
                 "Int": etl_config,
                 "None": {"foo": "bar"},
@@ -61,6 +67,27 @@ def test_extract_logfile_from_s3(MockUtils, MockSiem, MockCreate):
     assert index.extract_logfile_from_s3(data) == "logfile"
 
 
+def test_s3_key_filter_per_thread():
+    handler = index.logger.handlers[0]
+    barrier = threading.Barrier(2)
+    formatted = {}
+
+    def log(s3_key):
+        index.s3_key_filter.set_s3_key(s3_key)
+        barrier.wait()
+        record = logging.LogRecord("siem.utils", logging.INFO, "", 0, "x", None, None)
+        assert handler.filter(record)
+        formatted[s3_key] = json.loads(handler.format(record))
+
+    threads = [threading.Thread(target=log, args=(key,)) for key in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert formatted["a"]["s3_key"] == "a"
+    assert formatted["b"]["s3_key"] == "b"
+
+
 def test_get_value_from_etl_config_none_type():
     assert index.get_value_from_etl_config("None", "foo", None) == "bar"
 
@@ -96,6 +123,15 @@ def test_get_value_from_etl_config_unknown_exception():
         assert index.get_value_from_etl_config("Raise", "foo", None)
 
 
+def test_get_bulk_action_prefix():
+    with patch.object(index.utils, "json_dumps") as MockJsonDumps:
+        MockJsonDumps.side_effect = lambda obj: json.dumps(obj).encode()
+        prefix = index.get_bulk_action_prefix("log-foo-2021")
+    assert json.loads(prefix + b'"id"}}') == {
+        "index": {"_index": "log-foo-2021", "_id": "id"}
+    }
+
+
 @pytest.mark.parametrize(
     "value,expected",
     [
@@ -128,6 +164,8 @@ def test_get_value_from_etl_config_unknown_exception():
 @patch("index.get_value_from_etl_config")
 def test_create_logconfig(MockGetValue, value, expected):
     MockGetValue.side_effect = lambda _x, _y, z=None: z
+    if expected:
+        expected = {**expected, "ecs_plan": index.utils.compile_ecs_plan.return_value}
     assert index.create_logconfig(value) == expected
 
 
@@ -141,21 +179,23 @@ def test_get_es_entries(MockLogParser, MockLoadSFModule, MockCreateLogfile):
     logparser = MagicMock(
         doc_id="doc_id",
         indexname="indexname",
-        json="json",
+        json=b'"json"',
         ignored_reason="Foo is ignored",
     )
     logparser.is_ignored.__bool__.side_effect = [True, False]
     MockLogParser.return_value = logparser
-    a = [x for x in index.get_es_entries(logfile, patterns)]
-    assert a == [{"index": {"_id": "doc_id", "_index": "indexname"}}, "json"]
+    with patch.object(index.utils, "json_dumps") as MockJsonDumps:
+        MockJsonDumps.side_effect = lambda obj: json.dumps(obj).encode()
+        a = [x for x in index.get_es_entries(logfile, patterns)]
+    assert a == [b'{"index":{"_index":"indexname","_id":"doc_id"}}\n"json"\n']
     MockCreateLogfile.assert_called_once_with(logfile.logtype)
 
 
 @pytest.mark.parametrize(
     "results,expected",
     [
-        ({"errors": None, "items": [1, 2], "took": 100}, (100, 2, 0, [])),
-        ({"errors": [], "items": [1, 2], "took": 100}, (100, 2, 0, [])),
+        ({"errors": None, "items": [1, 2], "took": 100}, (100, 2, [], [])),
+        ({"errors": [], "items": [1, 2], "took": 100}, (100, 2, [], [])),
         (
             {
                 "errors": [1],
@@ -165,7 +205,34 @@ def test_get_es_entries(MockLogParser, MockLoadSFModule, MockCreateLogfile):
                 ],
                 "took": 100,
             },
-            (100, 1, 1, ["foo"]),
+            (100, 1, [], [(1, "foo")]),
+        ),
+        (
+            {
+                "errors": True,
+                "items": [
+                    {"index": {"status": 429, "error": {"type": "foo"}}},
+                    {
+                        "index": {
+                            "status": 503,
+                            "error": {"type": "es_rejected_execution_exception"},
+                        }
+                    },
+                    {"index": {"status": 400, "error": {"type": "bar"}}},
+                    {"index": {"status": 503}},
+                ],
+                "took": 100,
+            },
+            (
+                100,
+                0,
+                [
+                    (0, {"type": "foo"}),
+                    (1, {"type": "es_rejected_execution_exception"}),
+                    (3, None),
+                ],
+                [(2, {"type": "bar"})],
+            ),
         ),
     ],
 )
@@ -176,91 +243,291 @@ def test_check_es_results(results, expected):
 def test_bulkloads_into_elasticsearch_empty():
     es_entries = []
     collected_metrics = {}
-    result = index.bulkloads_into_elasticsearch(es_entries, collected_metrics)
+    result = index.bulkloads_into_elasticsearch(
+        es_entries, collected_metrics, {"es_bulk_concurrency": 2}
+    )
     assert result == (
         {
             "total_output_size": 0,
             "total_log_load_count": 0,
             "success_count": 0,
             "error_count": 0,
+            "retry_count": 0,
+            "dead_letter_count": 0,
             "es_response_time": 0,
+            "bulk_sizes": [],
+            "bulk_latencies": [],
         },
         [],
     )
 
 
 @patch("index.check_es_results")
-def test_bulkloads_into_elasticsearch_lte_6000000(MockCheckESResults):
-    MockCheckESResults.return_value = (100, 1, 0, [])
-    es_entries = ["a" * 6000000]
+def test_bulkloads_into_elasticsearch_lte_bulk_size(MockCheckESResults):
+    MockCheckESResults.return_value = (100, 2, [], [])
+    es_entries = [b"a" * 3, b"b" * 3]
     collected_metrics = {}
-    result = index.bulkloads_into_elasticsearch(es_entries, collected_metrics)
+    with patch.object(index.es_conn, "bulk") as MockBulk:
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 2, "es_bulk_size": 6}
+        )
+    MockBulk.assert_called_once_with(b"aaabbb", filter_path=ANY)
     assert result == (
         {
-            "total_output_size": 6000000,
-            "total_log_load_count": 1,
-            "success_count": 1,
+            "total_output_size": 6,
+            "total_log_load_count": 2,
+            "success_count": 2,
             "error_count": 0,
+            "retry_count": 0,
+            "dead_letter_count": 0,
             "es_response_time": 100,
+            "bulk_sizes": [6],
+            "bulk_latencies": [100],
         },
         [],
     )
 
 
 @patch("index.check_es_results")
-def test_bulkloads_into_elasticsearch_lte_6000000_with_error(MockCheckESResults):
-    MockCheckESResults.return_value = (100, 1, 1, ["foo"])
-    es_entries = ["a" * 6000000, "b" * 6000000]
+def test_bulkloads_into_elasticsearch_greater_than_bulk_size_with_error(
+    MockCheckESResults,
+):
+    MockCheckESResults.return_value = (100, 1, [], [(0, "foo")])
+    es_entries = [b"a" * 4, b"b" * 4, b"c" * 4, b"d" * 4]
     collected_metrics = {}
-    result = index.bulkloads_into_elasticsearch(es_entries, collected_metrics)
+    with patch.object(index.es_conn, "bulk") as MockBulk:
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 2, "es_bulk_size": 8}
+        )
+    assert MockBulk.call_args_list == [
+        call(b"aaaabbbb", filter_path=ANY),
+        call(b"ccccdddd", filter_path=ANY),
+    ]
     assert result == (
         {
-            "total_output_size": 12000000,
-            "total_log_load_count": 2,
-            "success_count": 1,
-            "error_count": 1,
-            "es_response_time": 100,
+            "total_output_size": 16,
+            "total_log_load_count": 4,
+            "success_count": 2,
+            "error_count": 2,
+            "retry_count": 0,
+            "dead_letter_count": 0,
+            "es_response_time": 200,
+            "bulk_sizes": [8, 8],
+            "bulk_latencies": [100, 100],
         },
-        [["foo"]],
+        [["foo"], ["foo"]],
     )
 
 
 @patch("index.check_es_results")
-def test_bulkloads_into_elasticsearch_greater_than_6000000(MockCheckESResults):
-    MockCheckESResults.return_value = (100, 1, 0, [])
-    es_entries = ["a" * (6000000 + 1)]
+def test_bulkloads_into_elasticsearch_entry_greater_than_bulk_size(
+    MockCheckESResults,
+):
+    MockCheckESResults.return_value = (100, 1, [], [])
+    es_entries = [b"a" * 10, b"b"]
     collected_metrics = {}
-    result = index.bulkloads_into_elasticsearch(es_entries, collected_metrics)
+    with patch.object(index.es_conn, "bulk") as MockBulk:
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 1, "es_bulk_size": 8}
+        )
+    assert MockBulk.call_args_list == [
+        call(b"a" * 10, filter_path=ANY),
+        call(b"b", filter_path=ANY),
+    ]
+    assert result[0]["total_output_size"] == 11
+    assert result[0]["success_count"] == 2
+
+
+@patch("index.check_es_results")
+def test_bulkloads_into_elasticsearch_counts_utf8_bytes(MockCheckESResults):
+    MockCheckESResults.return_value = (100, 1, [], [])
+    es_entries = ["\u3042\u3042\n".encode("utf-8"), b"ab\n"]
+    collected_metrics = {}
+    with patch.object(index.es_conn, "bulk") as MockBulk:
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 1, "es_bulk_size": 8}
+        )
+    assert MockBulk.call_count == 2
+    assert result[0]["total_output_size"] == 10
+
+
+@patch("index.check_es_results")
+def test_bulkloads_into_elasticsearch_bounded_in_flight(MockCheckESResults):
+    MockCheckESResults.side_effect = lambda results: results
+    in_flight, max_in_flight = 0, 0
+    lock = threading.Lock()
+
+    def bulk(body, filter_path=None):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        return (10, 0, [], [(0, body[:1].decode())])
+
+    es_entries = [c.encode() * 4 for c in "abcde"]
+    collected_metrics = {}
+    with patch.object(index.es_conn, "bulk", side_effect=bulk):
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 2, "es_bulk_size": 4}
+        )
+    assert max_in_flight == 2
     assert result == (
         {
-            "total_output_size": 6000001,
-            "total_log_load_count": 1,
-            "success_count": 1,
-            "error_count": 0,
-            "es_response_time": 100,
+            "total_output_size": 20,
+            "total_log_load_count": 5,
+            "success_count": 0,
+            "error_count": 5,
+            "retry_count": 0,
+            "dead_letter_count": 0,
+            "es_response_time": 50,
+            "bulk_sizes": [4, 4, 4, 4, 4],
+            "bulk_latencies": [10, 10, 10, 10, 10],
         },
-        [],
+        [["a"], ["b"], ["c"], ["d"], ["e"]],
     )
 
 
 @patch("index.check_es_results")
-def test_bulkloads_into_elasticsearch_greater_than_6000000_with_error(
-    MockCheckESResults,
+@patch("index.time.sleep")
+def test_bulkloads_into_elasticsearch_retries_rejected_items(
+    MockSleep, MockCheckESResults
 ):
-    MockCheckESResults.return_value = (100, 1, 1, ["foo"])
-    es_entries = ["a" * (6000000 + 1), "b" * (6000000 + 1)]
+    MockCheckESResults.side_effect = [
+        (100, 1, [(1, "foo")], []),
+        (100, 1, [], []),
+        (100, 2, [], []),
+        (100, 1, [], []),
+        (100, 1, [], []),
+    ]
+    es_entries = [c.encode() * 4 for c in "abcdef"]
     collected_metrics = {}
-    result = index.bulkloads_into_elasticsearch(es_entries, collected_metrics)
-    assert result == (
-        {
-            "total_output_size": 12000002,
-            "total_log_load_count": 2,
-            "success_count": 2,
-            "error_count": 2,
-            "es_response_time": 200,
-        },
-        [["foo"], ["foo"]],
-    )
+    with patch.object(index.es_conn, "bulk") as MockBulk:
+        result = index.bulkloads_into_elasticsearch(
+            es_entries,
+            collected_metrics,
+            {
+                "es_bulk_concurrency": 1,
+                "es_bulk_size": 8,
+                "es_bulk_min_size": 4,
+                "es_bulk_took_target": 1000,
+            },
+        )
+    assert MockBulk.call_args_list == [
+        call(b"aaaabbbb", filter_path=ANY),
+        call(b"bbbb", filter_path=ANY),
+        call(b"ccccdddd", filter_path=ANY),
+        call(b"eeee", filter_path=ANY),
+        call(b"ffff", filter_path=ANY),
+    ]
+    MockSleep.assert_called_once_with(0.1)
+    assert result[0]["success_count"] == 6
+    assert result[0]["error_count"] == 0
+    assert result[0]["retry_count"] == 1
+    assert result[0]["bulk_sizes"] == [8, 8, 4, 4]
+    assert result[0]["bulk_latencies"] == [100, 100, 100, 100, 100]
+
+
+def bulk_results(*statuses):
+    items = []
+    for status in statuses:
+        if status >= 300:
+            items.append({"index": {"status": status, "error": {"type": status}}})
+        else:
+            items.append({"index": {"status": status}})
+    return {"took": 100, "errors": any(s >= 300 for s in statuses), "items": items}
+
+
+@patch("index.time.sleep")
+@patch("index.DEAD_LETTER_BUCKET", "bucket")
+def test_bulkloads_into_elasticsearch_dead_letters_permanent_errors(MockSleep):
+    es_entries = [b"a", b"b", b"c", b"d"]
+    collected_metrics = {}
+    with patch.object(index.es_conn, "bulk") as MockBulk, patch.object(
+        index.utils, "write_dead_letters"
+    ) as MockWrite:
+        MockBulk.side_effect = [
+            bulk_results(201, 429, 400, 503),
+            bulk_results(201, 503),
+            bulk_results(201),
+        ]
+        MockWrite.return_value = "s3://bucket/dead_letter/foo.json.gz"
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 1}
+        )
+    assert MockBulk.call_args_list == [
+        call(b"abcd", filter_path=ANY),
+        call(b"bd", filter_path=ANY),
+        call(b"d", filter_path=ANY),
+    ]
+    MockWrite.assert_called_once_with([(b"c", {"type": 400})], ANY, "bucket")
+    assert result[0]["success_count"] == 3
+    assert result[0]["error_count"] == 1
+    assert result[0]["retry_count"] == 3
+    assert result[0]["dead_letter_count"] == 1
+    assert result[1] == [[{"type": 400}]]
+
+
+@patch("index.time.sleep")
+@patch("index.DEAD_LETTER_BUCKET", None)
+def test_bulkloads_into_elasticsearch_permanent_errors_without_bucket(MockSleep):
+    es_entries = [b"a", b"b"]
+    collected_metrics = {}
+    with patch.object(index.es_conn, "bulk") as MockBulk, patch.object(
+        index.utils, "write_dead_letters"
+    ) as MockWrite:
+        MockBulk.return_value = bulk_results(201, 400)
+        result = index.bulkloads_into_elasticsearch(
+            es_entries, collected_metrics, {"es_bulk_concurrency": 1}
+        )
+    MockWrite.assert_not_called()
+    # the record fails and is retried because the errors are not dead letters
+    assert result[0]["error_count"] == 1
+    assert result[0]["dead_letter_count"] == 0
+
+
+@patch("index.time.sleep")
+def test_bulkloads_into_elasticsearch_retry_exhausted(MockSleep):
+    es_entries = [b"a", b"b"]
+    collected_metrics = {}
+    with patch.object(index.es_conn, "bulk") as MockBulk, patch.object(
+        index.utils, "write_dead_letters"
+    ) as MockWrite:
+        MockBulk.side_effect = [bulk_results(201, 429), bulk_results(429)]
+        result = index.bulkloads_into_elasticsearch(
+            es_entries,
+            collected_metrics,
+            {"es_bulk_concurrency": 1, "es_bulk_max_retries": 1},
+        )
+    assert MockBulk.call_count == 2
+    MockWrite.assert_not_called()
+    assert result[0]["success_count"] == 1
+    assert result[0]["error_count"] == 1
+    assert result[0]["dead_letter_count"] == 0
+    assert result[1] == [[{"type": 429}]]
+
+
+@pytest.mark.parametrize(
+    "results,expected_size,expected_backoff",
+    [
+        ([(100, 0)], 1000, 0),
+        ([(600, 0)], 800, 0),
+        ([(2000, 0)], 400, 0),
+        ([(100, 1)], 400, 0.1),
+        ([(100, 1), (100, 1)], 200, 0.2),
+        ([(100, 1), (100, 1), (100, 1)], 200, 0.4),
+        ([(100, 1), (100, 0)], 500, 0),
+    ],
+)
+def test_bulk_size_controller(results, expected_size, expected_backoff):
+    controller = index.BulkSizeController(200, 1000, 1000)
+    controller.size = 800
+    for took, rejected in results:
+        controller.update(took, rejected)
+    assert controller.size == expected_size
+    assert controller.backoff == expected_backoff
 
 
 @patch("index.os")
@@ -283,6 +550,10 @@ def test_output_metrics(MockOs):
         "success_count": 2,
         "error_count": 2,
         "es_response_time": 200,
+        "bulk_sizes": [6000001, 6000001],
+        "bulk_latencies": [100, 100],
+        "geoip_cache_hit_count": 90,
+        "geoip_cache_miss_count": 10,
         "start_time": time.perf_counter(),
     }
 
@@ -302,6 +573,18 @@ def test_output_metrics(MockOs):
             call.add_metric(
                 name="EsResponseTime", unit=MetricUnit.Milliseconds, value=200
             ),
+            call.add_metric(name="BulkSize", unit=MetricUnit.Bytes, value=6000001),
+            call.add_metric(name="BulkSize", unit=MetricUnit.Bytes, value=6000001),
+            call.add_metric(
+                name="BulkLatency", unit=MetricUnit.Milliseconds, value=100
+            ),
+            call.add_metric(
+                name="BulkLatency", unit=MetricUnit.Milliseconds, value=100
+            ),
+            call.add_metric(name="GeoIpCacheHitCount", unit=MetricUnit.Count, value=90),
+            call.add_metric(
+                name="GeoIpCacheMissCount", unit=MetricUnit.Count, value=10
+            ),
             call.add_metric(name="TotalLogFileCount", unit=MetricUnit.Count, value=1),
             call.add_metric(
                 name="TotalLogCount", unit=MetricUnit.Count, value="total_log_count"
@@ -311,6 +594,72 @@ def test_output_metrics(MockOs):
     )
 
 
+@patch("index.os")
+def test_output_metrics_stage_durations(MockOs):
+    MockOs.environ.get.return_value = True
+    metrics = MagicMock()
+    record = {"s3": {"object": {"key": "foo", "size": 100}}}
+    logfile = MagicMock(logtype="logtype", total_log_count=2)
+    logfile.stage_timer.durations = {"bulk": 0.5, "download": 0.0012345}
+    collected_metrics = {
+        "total_output_size": 1,
+        "success_count": 2,
+        "error_count": 0,
+        "es_response_time": 100,
+        "start_time": time.perf_counter(),
+    }
+    index.output_metrics(metrics, record, logfile, collected_metrics)
+    metrics.assert_has_calls(
+        [
+            call.add_metric(
+                name="S3DownloadTime", unit=MetricUnit.Milliseconds, value=1.234
+            ),
+            call.add_metric(name="BulkTime", unit=MetricUnit.Milliseconds, value=500),
+        ]
+    )
+
+
+def test_count_geoip_cache():
+    cache_info = {
+        "city": {"hits": 3, "misses": 1, "size": 1},
+        "asn": {"hits": 2, "misses": 2, "size": 2},
+    }
+    with patch.object(index.geodb_instance, "cache_info", return_value=cache_info):
+        assert index.count_geoip_cache() == (5, 3)
+
+
+def test_init_phase():
+    with patch.dict(index.init_timings, clear=True):
+        assert index.init_phase("foo", lambda x, y=0: x + y, 1, y=2) == 3
+        with pytest.raises(ValueError):
+            index.init_phase("bar", int, "x")
+        assert set(index.init_timings) == {"foo", "bar"}
+
+
+@patch("index.single_metric")
+@patch("index.os")
+def test_output_init_metrics(MockOs, MockSingleMetric):
+    MockOs.environ.get.return_value = True
+    index.output_init_metrics({"config": 10, "total": 100})
+    MockSingleMetric.assert_has_calls(
+        [
+            call(name="InitDuration", unit=MetricUnit.Milliseconds, value=10),
+            call().__enter__().add_dimension(name="phase", value="config"),
+            call().__enter__().add_dimension(name="version", value=index.__version__),
+        ],
+        any_order=True,
+    )
+    assert MockSingleMetric.call_count == 2
+
+
+@patch("index.single_metric")
+@patch("index.os")
+def test_output_init_metrics_not_in_lambda(MockOs, MockSingleMetric):
+    MockOs.environ.get.return_value = False
+    index.output_init_metrics({"config": 10})
+    MockSingleMetric.assert_not_called()
+
+
 @patch("index.os")
 def test_observability_decorator_switcher_in_local(MockOs):
     MockOs.environ.get.return_value = False
@@ -388,6 +737,28 @@ def test_lambda_handler_error_count(
     assert "1 of logs were NOT loaded into Amazon ES" in caplog.text
 
 
+@patch("index.extract_logfile_from_s3")
+@patch("index.get_es_entries")
+@patch("index.bulkloads_into_elasticsearch")
+@patch("index.output_metrics")
+def test_lambda_handler_dead_letters_only(
+    MockOutput, MockBulkload, MockGetESEntries, MockExtract, caplog
+):
+    logfile = MagicMock(is_ignored=False)
+    MockExtract.return_value = logfile
+
+    MockBulkload.return_value = (
+        {"error_count": 1, "dead_letter_count": 1},
+        [["bar_error"]],
+    )
+
+    records = {"Records": ["foo"]}
+    with caplog.at_level(logging.ERROR):
+        assert index.lambda_handler({"Records": records}, {}) == None
+    assert "bar_error" in caplog.text
+    assert "NOT loaded" not in caplog.text
+
+
 @patch("index.extract_logfile_from_s3")
 @patch("index.get_es_entries")
 @patch("index.bulkloads_into_elasticsearch")
@@ -428,3 +799,209 @@ def test_lambda_handler_no_logs_warning(
     MockBulkload.assert_called_once()
     MockOutput.assert_called_once()
     assert "No entries were successed to load" in caplog.text
+
+
+@patch("index.process_record")
+def test_process_records_concurrently(MockProcess):
+    records = [{"messageId": str(i)} for i in range(5)]
+    MockProcess.side_effect = lambda record: int(record["messageId"]) % 2 and 1 / 0
+    with patch.object(index, "record_concurrency", 4):
+        assert index.process_records(records) == [records[1], records[3]]
+    assert MockProcess.call_count == 5
+
+
+@patch("index.process_record")
+def test_process_records_sequentially(MockProcess):
+    records = [{"messageId": "1"}, {"messageId": "2"}]
+    MockProcess.side_effect = [Exception("Boom!"), None]
+    with patch.object(index, "record_concurrency", 1):
+        assert index.process_records(records) == [records[0]]
+    MockProcess.assert_has_calls([call(records[0]), call(records[1])])
+
+
+@pytest.mark.parametrize(
+    "env,record,expected",
+    [
+        (False, {"s3": {}}, False),
+        (True, {"s3": {}}, True),
+        (False, {"body": '{"s3": {}, "profile": true}'}, True),
+        (False, {"body": '{"s3": {}, "profile": "yes"}'}, False),
+        (False, {"body": "not json"}, False),
+    ],
+)
+def test_is_profiled_record(env, record, expected):
+    with patch.object(index, "PROFILE_RECORDS", env):
+        assert index.is_profiled_record(record) == expected
+
+
+@patch("index.profiler.RecordProfiler")
+def test_profiler_switcher(MockProfiler):
+    func = MagicMock(return_value="result")
+    record = {"body": '{"s3": {"object": {"key": "a+b%3D"}}, "profile": true}'}
+    with patch.object(index, "PROFILE_BUCKET", "bucket"):
+        assert index.profiler_switcher(func)(record) == "result"
+    func.assert_called_once_with(record)
+    MockProfiler.assert_called_once_with(ANY, "a b=", index.s3_client, "bucket")
+    MockProfiler.return_value.__enter__.assert_called_once()
+
+
+@patch("index.profiler.RecordProfiler")
+def test_profiler_switcher_not_profiled(MockProfiler):
+    func = MagicMock(return_value="result")
+    assert index.profiler_switcher(func)({"s3": {}}) == "result"
+    MockProfiler.assert_not_called()
+
+
+@patch("index.process_record")
+def test_process_records_profiled_sequentially(MockProcess):
+    records = [{"messageId": "1", "body": '{"profile": true}'}, {"messageId": "2"}]
+    with patch.object(index, "record_concurrency", 4):
+        with patch.object(index, "ThreadPoolExecutor") as MockExecutor:
+            assert index.process_records(records) == []
+    MockExecutor.assert_not_called()
+    MockProcess.assert_has_calls([call(records[0]), call(records[1])])
+
+
+@patch("index.process_records")
+def test_lambda_handler_sqs_batch_item_failures(MockProcess):
+    records = [{"messageId": "1", "body": "{}"}, {"messageId": "2", "body": "{}"}]
+    MockProcess.return_value = [records[1]]
+    assert index.lambda_handler({"Records": records}, {}) == {
+        "batchItemFailures": [{"itemIdentifier": "2"}]
+    }
+
+
+@patch("index.process_records")
+def test_lambda_handler_s3_failures_raise(MockProcess):
+    records = [{"s3": {}}, {"s3": {}}]
+    MockProcess.return_value = [records[0]]
+    with pytest.raises(Exception, match="1 of 2 records were failed"):
+        index.lambda_handler({"Records": records}, {})
+
+
+def test_publish_metrics(capsys):
+    record_metrics = MagicMock(metric_set={"foo": 1})
+    record_metrics.serialize_metric_set.return_value = {"_aws": {}}
+    index.publish_metrics(record_metrics)
+    assert json.loads(capsys.readouterr().out) == {"_aws": {}}
+    record_metrics = MagicMock(metric_set={})
+    index.publish_metrics(record_metrics)
+    assert capsys.readouterr().out == ""
+    record_metrics.serialize_metric_set.assert_not_called()
+
+
+class FakeLogFile:
+    def __init__(self, logs):
+        self.logs = logs
+        self.stage_timer = utils.StageTimer()
+
+    def split_log_range(self, number):
+        size = -(-len(self.logs) // number)
+        return [
+            (x, min(x + size, len(self.logs))) for x in range(0, len(self.logs), size)
+        ]
+
+    def extract_logdata(self, start, end):
+        for log in self.logs[start:end]:
+            if log == "boom":
+                raise ValueError("Boom!")
+            yield log
+
+    def reopen_rawdata(self):
+        pass
+
+
+class FakeLogParser:
+    is_ignored = False
+    indexname = "index"
+    ecs_plan = {"geoip": []}
+
+    def __init__(self, logfile):
+        self.geodb_instance = MagicMock()
+        self.stage_timer = logfile.stage_timer
+
+    def __call__(self, logdata):
+        self.doc_id = logdata
+        self.json = json.dumps({"log": logdata}).encode()
+
+
+@pytest.fixture
+def MockJsonDumps():
+    with patch.object(index.utils, "json_dumps") as MockJsonDumps:
+        MockJsonDumps.side_effect = lambda obj: json.dumps(obj).encode()
+        yield MockJsonDumps
+
+
+@pytest.mark.parametrize("processes", [1, 2, 3])
+def test_get_es_entries_in_processes(MockJsonDumps, processes):
+    logs = [f"log{i}" for i in range(10)]
+    logfile = FakeLogFile(logs)
+    with patch.object(index, "PARSE_WORKER_CHUNK_SIZE", 100):
+        entries = list(
+            index.get_es_entries_in_processes(
+                logfile, FakeLogParser(logfile), processes
+            )
+        )
+    assert sorted(entries) == sorted(
+        b'{"index":{"_index":"index","_id":"%s"}}\n{"log": "%s"}\n'
+        % (log.encode(), log.encode())
+        for log in logs
+    )
+    # durations of workers are merged
+    assert set(logfile.stage_timer.durations) == {"parse", "serialize", "worker_wait"}
+
+
+def test_get_es_entries_in_processes_worker_error(MockJsonDumps):
+    logs = ["log0", "log1", "boom", "log3"]
+    logfile = FakeLogFile(logs)
+    with pytest.raises(Exception, match="failed to parse logs 3-4 in worker"):
+        list(index.get_es_entries_in_processes(logfile, FakeLogParser(logfile), 2))
+
+
+def test_make_es_entries_stage_durations(MockJsonDumps):
+    logfile = FakeLogFile(["log0", "log1"])
+    logparser = FakeLogParser(logfile)
+    entries = index.make_es_entries(logparser, logfile.extract_logdata(0, 2))
+    next(entries)
+    time.sleep(0.05)
+    list(entries)
+    durations = logfile.stage_timer.durations
+    assert set(durations) == {"parse", "serialize"}
+    # time while the caller holds an entry is not counted
+    assert durations["parse"] + durations["serialize"] < 0.05
+
+
+def test_count_parse_processes():
+    logfile = MagicMock(
+        is_ignored=False,
+        is_split_into_sqs=False,
+        rawdata_size=100,
+        logconfig={"parse_process_min_size": 100},
+    )
+    with patch.object(index, "parse_processes", 1):
+        assert index.count_parse_processes(logfile) == 1
+    with patch.object(index, "parse_processes", 4):
+        assert index.count_parse_processes(logfile) == 4
+        logfile.rawdata_size = 99
+        assert index.count_parse_processes(logfile) == 1
+        logfile.rawdata_size = 100
+        logfile.is_split_into_sqs = True
+        assert index.count_parse_processes(logfile) == 1
+
+
+def test_count_parse_processes_with_other_threads():
+    logfile = MagicMock(
+        is_ignored=False,
+        is_split_into_sqs=False,
+        rawdata_size=100,
+        logconfig={"parse_process_min_size": 100},
+    )
+    stopped = threading.Event()
+    thread = threading.Thread(target=stopped.wait)
+    thread.start()
+    try:
+        with patch.object(index, "parse_processes", 4):
+            assert index.count_parse_processes(logfile) == 1
+    finally:
+        stopped.set()
+        thread.join()